@@ -3,14 +3,28 @@ ASGI config for criminal_face_app project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Served through ASGI (e.g. ``uvicorn criminal_face_app.asgi:application``),
+background generation jobs run as asyncio tasks on the server's event loop
+instead of in a thread pool, see face_generator.jobs.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'criminal_face_app.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after the app registry is ready
+from face_generator.jobs import attach_event_loop  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Django's ASGI app, handing the server's event loop to the job runner."""
+    attach_event_loop(asyncio.get_running_loop())
+    await django_application(scope, receive, send)
@@ -25,6 +25,46 @@ BFL_API_KEY = os.getenv("BFL_API_KEY")
 BFL_TEXT2IMG_MODEL = os.getenv("BFL_TEXT2IMG_MODEL", "flux-dev")
 BFL_IMG2IMG_MODEL = os.getenv("BFL_IMG2IMG_MODEL", "flux-kontext-dev")
 
+# Background threads per web process running queued BFL generation jobs
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+
+# Keep-alive connections per BFL host, and retries for failed BFL requests
+BFL_HTTP_POOL_SIZE = int(os.getenv("BFL_HTTP_POOL_SIZE", "10"))
+BFL_HTTP_RETRIES = int(os.getenv("BFL_HTTP_RETRIES", "3"))
+
+# Public base URL of this app (e.g. https://sketch.example.org). When set,
+# generations are submitted with a webhook URL and BFL notifies us when they
+# finish; polling only runs as a fallback sweep every BFL_WEBHOOK_SWEEP_INTERVAL
+# seconds for jobs whose notification never arrived.
+BFL_WEBHOOK_BASE_URL = os.getenv("BFL_WEBHOOK_BASE_URL", "").rstrip("/")
+BFL_WEBHOOK_SWEEP_INTERVAL = int(os.getenv("BFL_WEBHOOK_SWEEP_INTERVAL", "30"))
+
+# BFL submission limits, per model and per process: submissions per second
+# (bursting up to BFL_SUBMIT_BURST) and tasks in flight at once
+BFL_SUBMIT_RATE = float(os.getenv("BFL_SUBMIT_RATE", "2"))
+BFL_SUBMIT_BURST = int(os.getenv("BFL_SUBMIT_BURST", "4"))
+BFL_MAX_IN_FLIGHT = int(os.getenv("BFL_MAX_IN_FLIGHT", "24"))
+
+# Opt-in cache of BFL results for identical requests (off unless a directory
+# is given), bounded to GENERATION_CACHE_MAX_MB with least-recently-used eviction
+GENERATION_CACHE_DIR = os.getenv("GENERATION_CACHE_DIR", "")
+GENERATION_CACHE_MAX_MB = int(os.getenv("GENERATION_CACHE_MAX_MB", "512"))
+
+# Seconds the cached feature catalogue is served before being rebuilt, even
+# if no invalidation reached this process (see face_generator.catalogue)
+CATALOGUE_CACHE_TIMEOUT = int(os.getenv("CATALOGUE_CACHE_TIMEOUT", "3600"))
+
+# Criminal matching cascade: coarse stage ("histogram", "ssim32" or "none")
+# and how many candidates survive it into full-resolution SSIM
+FACE_MATCH_CASCADE = os.getenv("FACE_MATCH_CASCADE", "histogram")
+FACE_MATCH_CASCADE_KEEP = int(os.getenv("FACE_MATCH_CASCADE_KEEP", "100"))
+
+# Long-lived shard processes per web worker for criminal matching (0 = in-process)
+FACE_MATCH_SHARDS = int(os.getenv("FACE_MATCH_SHARDS", "0"))
+
+# Most query images accepted by one bulk matching request
+FACE_MATCH_BATCH_LIMIT = int(os.getenv("FACE_MATCH_BATCH_LIMIT", "64"))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -86,11 +126,68 @@ WSGI_APPLICATION = "criminal_face_app.wsgi.application"
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
+# DB_ENGINE=postgresql (needs psycopg) for deployments with concurrent
+# writers; SQLite, the default, lets one writer in at a time. DB_CONN_MAX_AGE
+# keeps connections open between requests and jobs (seconds, 0 = per request).
+
+DB_ENGINE = os.getenv("DB_ENGINE", "sqlite")
+
+if DB_ENGINE == "postgresql":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.getenv("DB_NAME", "criminal_face_app"),
+            "USER": os.getenv("DB_USER", ""),
+            "PASSWORD": os.getenv("DB_PASSWORD", ""),
+            "HOST": os.getenv("DB_HOST", ""),
+            "PORT": os.getenv("DB_PORT", ""),
+            "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "60")),
+            "CONN_HEALTH_CHECKS": True,
+        }
+    }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.getenv("DB_NAME", str(BASE_DIR / "db.sqlite3")),
+            "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "0")),
+            "OPTIONS": {
+                # WAL lets readers run alongside the writer; NORMAL sync is
+                # safe under WAL; temp tables and a 20 MB page cache in memory
+                "init_command": (
+                    "PRAGMA journal_mode=WAL;"
+                    "PRAGMA synchronous=NORMAL;"
+                    "PRAGMA temp_store=MEMORY;"
+                    "PRAGMA cache_size=-20000;"
+                    "PRAGMA mmap_size=134217728;"
+                ),
+                # Take the write lock when a transaction starts, so concurrent
+                # writers wait (up to `timeout` seconds) instead of failing to
+                # upgrade a read lock
+                "transaction_mode": "IMMEDIATE",
+                "timeout": 20,
+            },
+            # Tests drive background job threads; an in-memory test database
+            # fails their concurrent writes with "table is locked" instead of
+            # waiting, so use a file
+            "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+        }
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# The in-process default suits a single web process. With several, point
+# CACHE_BACKEND/CACHE_LOCATION at a shared cache (e.g.
+# django.core.cache.backends.redis.RedisCache, redis://127.0.0.1:6379) so
+# catalogue invalidations from admin edits and populate_features reach them all.
 
-DATABASES = {
+CACHES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "BACKEND": os.getenv(
+            "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("CACHE_LOCATION", ""),
     }
 }
 
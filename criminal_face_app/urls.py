@@ -26,6 +26,7 @@ router = DefaultRouter()
 router.register(r"categories", views.FaceFeatureCategoryViewSet)
 router.register(r"features", views.FaceFeatureViewSet)
 router.register(r"compositions", views.FaceCompositionViewSet)
+router.register(r"jobs", views.GenerationJobViewSet)
 
 urlpatterns = (
     [
@@ -0,0 +1,124 @@
+"""
+Approximate Nearest-Neighbour Index
+Inverted-file (IVF) index over unit-length descriptors, implemented in NumPy.
+
+Descriptors are clustered with spherical k-means; each cluster's members are
+stored contiguously so a query only scores the rows of the few clusters whose
+centroids are closest to it. Used by face_matcher to shortlist criminal DB
+candidates before the exact SSIM + histogram re-rank.
+
+An IVF index is three arrays:
+    centroids: (nlist, dim) float32 unit vectors
+    order:     (N,) int64 gallery rows grouped by cluster
+    offsets:   (nlist + 1,) int64 — cluster i owns order[offsets[i]:offsets[i+1]]
+"""
+
+import numpy as np
+
+# Training uses at most this many descriptors per centroid
+TRAIN_SAMPLES_PER_LIST = 256
+TRAIN_ITERATIONS = 15
+
+# Rows scored per step when assigning descriptors to centroids
+ASSIGN_CHUNK_SIZE = 8192
+
+
+def default_nlist(count: int) -> int:
+    """Number of clusters for a gallery of `count` rows (~sqrt(N))."""
+    return int(max(1, min(4096, round(np.sqrt(count)))))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def _nearest_centroid(descriptors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the most similar centroid for every descriptor."""
+    labels = np.empty(len(descriptors), dtype=np.int64)
+    for start in range(0, len(descriptors), ASSIGN_CHUNK_SIZE):
+        chunk = np.asarray(descriptors[start : start + ASSIGN_CHUNK_SIZE])
+        labels[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def train_ivf(descriptors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means over (a sample of) the descriptors.
+
+    Returns (nlist, dim) float32 unit-length centroids.
+    """
+    rng = np.random.default_rng(seed)
+    count = len(descriptors)
+    nlist = min(nlist, count)
+
+    sample_size = min(count, nlist * TRAIN_SAMPLES_PER_LIST)
+    sample_rows = np.sort(rng.choice(count, sample_size, replace=False))
+    sample = np.asarray(descriptors[sample_rows], dtype=np.float32)
+
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(TRAIN_ITERATIONS):
+        labels = _nearest_centroid(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+
+        # Re-seed empty clusters from random samples so nlist stays fixed
+        empty = np.bincount(labels, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        centroids = _normalize(sums)
+
+    return centroids
+
+
+def assign_ivf(
+    descriptors: np.ndarray, centroids: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Group gallery rows by nearest centroid.
+
+    Returns (order, offsets), see module docstring.
+    """
+    labels = _nearest_centroid(descriptors, centroids)
+    order = np.argsort(labels, kind="stable")
+    counts = np.bincount(labels, minlength=len(centroids))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return order, offsets
+
+
+def search_ivf(
+    query: np.ndarray,
+    descriptors: np.ndarray,
+    centroids: np.ndarray,
+    order: np.ndarray,
+    offsets: np.ndarray,
+    k: int,
+    nprobe: int,
+) -> np.ndarray:
+    """
+    Approximate top-k gallery rows for a unit-length query descriptor.
+
+    Probes the `nprobe` closest clusters, and keeps probing further ones until
+    at least `k` candidates have been collected.
+
+    Returns row indices sorted by descriptor similarity (highest first).
+    """
+    probe_order = np.argsort(-(centroids @ query))
+
+    rows = []
+    collected = 0
+    for probed, cluster in enumerate(probe_order):
+        if probed >= nprobe and collected >= k:
+            break
+        members = order[offsets[cluster] : offsets[cluster + 1]]
+        rows.append(members)
+        collected += len(members)
+
+    candidates = np.sort(np.concatenate(rows))
+    scores = np.asarray(descriptors[candidates]) @ query
+
+    if len(candidates) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(candidates))
+    return candidates[top[np.argsort(-scores[top], kind="stable")]]
@@ -0,0 +1,398 @@
+"""
+Black Forest Labs Flux API - asyncio Client
+Async counterparts of the bfl_flux generation helpers, so one event loop can
+track hundreds of outstanding BFL tasks instead of parking a thread in
+time.sleep() for every generation.
+
+Polling backs off adaptively: the interval starts at POLL_MIN_INTERVAL and
+grows by POLL_BACKOFF (up to POLL_MAX_INTERVAL) while a task keeps reporting
+the same status, and drops back to the minimum whenever the status changes.
+Every task has its own deadline covering submit, polling and download.
+
+Requests follow bfl_session's policy: the per-kind TIMEOUTS (cut short by
+the deadline), its retries (see bfl_session.async_transport) and its
+session_stats() counters.
+
+generate_sketch(), revise_sketch() and colorize_sketch() take the same
+arguments as their bfl_flux namesakes. They are used by the job runner when
+the app is served through criminal_face_app.asgi (see jobs).
+"""
+
+import asyncio
+import inspect
+import os
+import weakref
+from typing import Callable
+
+import httpx
+from django.conf import settings as django_settings
+
+from .bfl_flux import (
+    BFL_RESULT_ENDPOINT,
+    DOWNLOAD_CHUNK_SIZE,
+    MUGSHOT_HEIGHT,
+    MUGSHOT_WIDTH,
+    TASK_NOT_FOUND_PATIENCE,
+    UPLOAD_CHUNK_SIZE,
+    _ImagePayload,
+    _ImageWriter,
+    _check_rate_limit,
+    _colorize_prompt,
+    _expected_size,
+    _log_upload_saving,
+    _prepare_upload,
+    _get_api_key,
+    _get_img2img_endpoint,
+    _get_text2img_endpoint,
+    _reference_sketch_prompt,
+    _revision_prompt,
+    _sketch_prompt,
+)
+from .bfl_session import TIMEOUTS, async_transport
+
+# Adaptive polling interval bounds (seconds) and growth factor
+POLL_MIN_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 8.0
+POLL_BACKOFF = 1.5
+
+# Deadline for a whole generation: submit + polling + download (seconds)
+GENERATION_TIMEOUT = 180
+
+# Concurrent connections to BFL per event loop
+MAX_CONNECTIONS = 100
+
+# One client (and connection pool) per event loop
+_clients = weakref.WeakKeyDictionary()
+
+
+def _get_client() -> httpx.AsyncClient:
+    """The HTTP client bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(transport=async_transport(MAX_CONNECTIONS))
+        _clients[loop] = client
+    return client
+
+
+def _timeout(kind: str, deadline: float) -> httpx.Timeout:
+    """bfl_session.TIMEOUTS[kind], but never past the task deadline."""
+    connect, read = TIMEOUTS[kind]
+    remaining = max(0.1, deadline - asyncio.get_running_loop().time())
+    return httpx.Timeout(min(read, remaining), connect=min(connect, remaining))
+
+
+async def _report(progress: Callable | None, message: str):
+    """Pass a progress message to a sync or async callback, if any."""
+    if progress:
+        result = progress(message)
+        if inspect.isawaitable(result):
+            await result
+
+
+async def _poll_for_result(
+    request_id: str,
+    deadline: float,
+    polling_url: str | None = None,
+    progress: Callable | None = None,
+) -> dict:
+    """
+    Poll BFL API for generation result without blocking the event loop.
+
+    Args:
+        request_id: The task ID returned from generation request
+        deadline: Event loop time by which the task must be Ready
+        polling_url: Optional polling URL returned by the submit response
+        progress: Optional callback receiving a message when the status changes
+
+    Returns:
+        Result dict with image URL
+    """
+    client = _get_client()
+    api_key = _get_api_key()
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+
+    # httpx replaces a URL's query string with `params`, so pass none at all
+    # for polling_url (it already carries the task id)
+    poll_endpoint = polling_url or BFL_RESULT_ENDPOINT
+    poll_params = None if polling_url else {"id": request_id}
+
+    interval = POLL_MIN_INTERVAL
+    last_status = None
+
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise Exception(
+                f"Generation timed out after {loop.time() - start_time:.0f} seconds"
+            )
+        await asyncio.sleep(min(interval, remaining))
+
+        try:
+            response = await client.get(
+                poll_endpoint,
+                headers={"x-key": api_key},
+                params=poll_params,
+                timeout=_timeout("poll", deadline),
+            )
+            result = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"[BFL Async] Poll error for {request_id}: {e}, retrying...")
+            interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+            continue
+
+        poll_status = result.get("status")
+        elapsed = loop.time() - start_time
+
+        if poll_status == "Ready":
+            return result
+        elif poll_status in ["Error", "Failed", "Request Moderated"]:
+            raise Exception(f"Generation failed ({poll_status}): {result}")
+        elif poll_status == "Task not found" and elapsed > TASK_NOT_FOUND_PATIENCE:
+            raise Exception(
+                f"Task not found after {elapsed:.0f}s — job may have failed silently"
+            )
+
+        # Still queued / pending: back off while nothing changes
+        if poll_status == last_status:
+            interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+        else:
+            interval = POLL_MIN_INTERVAL
+            last_status = poll_status
+            print(f"[BFL Async] {request_id}: {poll_status} ({elapsed:.0f}s)")
+            await _report(progress, f"{poll_status} ({elapsed:.0f}s)")
+
+
+async def _stream_payload(body: _ImagePayload):
+    """Yield an _ImagePayload chunk by chunk, reading the file off the loop"""
+    try:
+        while chunk := await asyncio.to_thread(body.read, UPLOAD_CHUNK_SIZE):
+            yield chunk
+    finally:
+        body.close()
+
+
+async def _submit(
+    endpoint: str, payload: dict, deadline: float, image_path: str | None = None
+) -> tuple[str, str]:
+    """
+    Submit a generation request; returns (request_id, polling_url).
+
+    With image_path, the image is normalized (see bfl_flux._prepare_upload)
+    and streamed into the body as payload's "input_image" (see
+    bfl_flux._ImagePayload).
+    """
+    headers = {"x-key": _get_api_key(), "Content-Type": "application/json"}
+    if not image_path:
+        response = await _get_client().post(
+            endpoint,
+            headers=headers,
+            json=payload,
+            timeout=_timeout("submit", deadline),
+        )
+    else:
+        upload_path = await asyncio.to_thread(_prepare_upload, image_path)
+        body = _ImagePayload(payload, "input_image", upload_path)
+        # An explicit Content-Length keeps httpx from chunking the body
+        headers["Content-Length"] = str(len(body))
+        loop = asyncio.get_running_loop()
+        try:
+            started = loop.time()
+            response = await _get_client().post(
+                endpoint,
+                headers=headers,
+                content=_stream_payload(body),
+                timeout=_timeout("submit", deadline),
+            )
+            _log_upload_saving(image_path, body, loop.time() - started)
+        finally:
+            body.close()
+            if upload_path != image_path:
+                os.remove(upload_path)
+
+    _check_rate_limit(response.status_code, response.headers)
+    if response.status_code != 200:
+        error_msg = response.text
+        print(f"[BFL Async] Error ({response.status_code}): {error_msg[:300]}")
+        raise Exception(f"BFL API request failed ({response.status_code}): {error_msg}")
+
+    result = response.json()
+    request_id = result.get("id")
+    if not request_id:
+        raise Exception(f"No request ID in response: {result}")
+    return request_id, result.get("polling_url")
+
+
+async def _download_image(url: str, output_path: str, deadline: float) -> str:
+    """Stream image from URL to local path"""
+    client = _get_client()
+    async with client.stream(
+        "GET", url, timeout=_timeout("download", deadline)
+    ) as response:
+        if response.status_code != 200:
+            raise Exception(f"Failed to download image: {response.status_code}")
+
+        writer = await asyncio.to_thread(_ImageWriter, output_path)
+        try:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(writer.write, chunk)
+            checksum = await asyncio.to_thread(
+                writer.commit, _expected_size(response.headers)
+            )
+        except BaseException:
+            await asyncio.to_thread(writer.abort)
+            raise
+
+    print(f"[BFL Async] Downloaded {writer.size / 1024:.0f} KB, sha256 {checksum[:16]}")
+    return output_path
+
+
+async def _generate(
+    label: str,
+    endpoint: str,
+    payload: dict,
+    output_path: str,
+    timeout: float,
+    progress: Callable | None,
+    image_path: str | None = None,
+) -> str:
+    """Submit, poll and download one generation within its deadline."""
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    deadline = start_time + timeout
+
+    try:
+        await _report(progress, f"Submitting to {label}")
+        request_id, polling_url = await _submit(
+            endpoint, payload, deadline, image_path=image_path
+        )
+        print(f"[BFL Async] Request submitted, ID: {request_id}")
+        await _report(progress, "Submitted, waiting for result")
+
+        result = await _poll_for_result(
+            request_id, deadline, polling_url=polling_url, progress=progress
+        )
+        image_url = result.get("result", {}).get("sample")
+        if not image_url:
+            raise Exception(f"No image URL in result: {result}")
+
+        await _report(progress, "Downloading result")
+        await _download_image(image_url, output_path, deadline)
+
+    except httpx.TimeoutException:
+        raise Exception("BFL API request timed out. Check your internet connection.")
+    except httpx.ConnectError:
+        raise Exception("Could not connect to BFL API. Check your internet connection.")
+
+    print(
+        f"[BFL Async] {label} completed in {loop.time() - start_time:.1f}s: {output_path}"
+    )
+    return output_path
+
+
+async def _run_dev_generate(
+    prompt: str,
+    output_path: str,
+    width: int = MUGSHOT_WIDTH,
+    height: int = MUGSHOT_HEIGHT,
+    timeout: float = GENERATION_TIMEOUT,
+    progress: Callable | None = None,
+    seed: int | None = None,
+) -> str:
+    """Async bfl_flux._run_dev_generate(); timeout bounds the whole task."""
+    payload = {"prompt": prompt, "width": width, "height": height}
+    if seed is not None:
+        payload["seed"] = seed
+    return await _generate(
+        django_settings.BFL_TEXT2IMG_MODEL,
+        _get_text2img_endpoint(),
+        payload,
+        output_path,
+        timeout,
+        progress,
+    )
+
+
+async def _run_kontext_generate(
+    prompt: str,
+    output_path: str,
+    init_image_path: str,
+    timeout: float = GENERATION_TIMEOUT,
+    progress: Callable | None = None,
+    seed: int | None = None,
+) -> str:
+    """Async bfl_flux._run_kontext_generate(); timeout bounds the whole task."""
+    if not os.path.exists(init_image_path):
+        raise Exception(f"Source image not found: {init_image_path}")
+
+    payload = {"prompt": prompt, "output_format": "png"}
+    if seed is not None:
+        payload["seed"] = seed
+    return await _generate(
+        django_settings.BFL_IMG2IMG_MODEL,
+        _get_img2img_endpoint(),
+        payload,
+        output_path,
+        timeout,
+        progress,
+        image_path=init_image_path,
+    )
+
+
+async def generate_sketch(
+    features_description: str,
+    output_path: str,
+    user_prompt: str = "",
+    reference_image_path: str | None = None,
+    progress: Callable | None = None,
+    seed: int | None = None,
+) -> str:
+    """Async bfl_flux.generate_sketch()"""
+    if reference_image_path and os.path.exists(reference_image_path):
+        return await _run_kontext_generate(
+            prompt=_reference_sketch_prompt(features_description, user_prompt),
+            output_path=output_path,
+            init_image_path=reference_image_path,
+            progress=progress,
+            seed=seed,
+        )
+    return await _run_dev_generate(
+        prompt=_sketch_prompt(features_description, user_prompt),
+        output_path=output_path,
+        progress=progress,
+        seed=seed,
+    )
+
+
+async def revise_sketch(
+    edit_instruction: str,
+    init_image_path: str,
+    output_path: str,
+    conversation_history: list[str] | None = None,
+    progress: Callable | None = None,
+    **kwargs,
+) -> str:
+    """Async bfl_flux.revise_sketch()"""
+    return await _run_kontext_generate(
+        prompt=_revision_prompt(edit_instruction, conversation_history),
+        output_path=output_path,
+        init_image_path=init_image_path,
+        progress=progress,
+    )
+
+
+async def colorize_sketch(
+    features_description: str,
+    sketch_path: str,
+    output_path: str,
+    progress: Callable | None = None,
+    **kwargs,
+) -> str:
+    """Async bfl_flux.colorize_sketch()"""
+    return await _run_kontext_generate(
+        prompt=_colorize_prompt(features_description),
+        output_path=output_path,
+        init_image_path=sketch_path,
+        progress=progress,
+    )
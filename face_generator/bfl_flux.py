@@ -16,10 +16,16 @@ Supports three modes:
 
 import os
 import time
+import hashlib
+import json
+import tempfile
 import requests
 import base64
-from typing import Optional
+from typing import Callable, Optional
 from django.conf import settings as django_settings
+from PIL import Image, ImageOps
+
+from .bfl_session import request, session_stats
 
 
 # BFL API endpoints - correct base URL
@@ -43,13 +49,54 @@ def _get_img2img_endpoint() -> str:
     return f"{BFL_API_BASE}/{model}"
 
 
-# Request timeout (connect, read) in seconds
-REQUEST_TIMEOUT = (15, 60)
-
 # Image dimensions - portrait mugshot, under 1MP (786,432 pixels)
 MUGSHOT_WIDTH = 768
 MUGSHOT_HEIGHT = 1024
 
+# Downloads are written to disk in chunks of this size (bytes)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Source image bytes base64-encoded per step of an upload; a multiple of 3,
+# so the encoded chunks concatenate into one valid base64 string
+UPLOAD_CHUNK_SIZE = 48 * 1024
+
+# Kontext inputs are re-encoded as JPEG at this quality before upload
+UPLOAD_JPEG_QUALITY = 90
+
+
+class RateLimited(Exception):
+    """BFL refused a submission with 429 Too Many Requests."""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _check_rate_limit(status_code: int, headers):
+    """Raise RateLimited for a 429 response (see bfl_scheduler)."""
+    if status_code != 429:
+        return
+    try:
+        retry_after = float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        retry_after = None
+    raise RateLimited("BFL API rate limit reached (429)", retry_after)
+
+
+def _report(progress: Callable[[str], None] | None, message: str):
+    """Pass a progress message to the caller's callback, if any."""
+    if progress:
+        progress(message)
+
+
+def _log_session_stats():
+    stats = session_stats()
+    print(
+        f"[BFL API] Connections: {stats['requests']} requests, "
+        f"{stats['reused']} on reused connections ({stats['reuse_rate']:.0%}), "
+        f"{stats['retries']} retries"
+    )
+
 
 def _get_api_key() -> str:
     """Get BFL API key from Django settings"""
@@ -60,7 +107,10 @@ def _get_api_key() -> str:
 
 
 def _poll_for_result(
-    request_id: str, timeout: int = 180, polling_url: str | None = None
+    request_id: str,
+    timeout: int = 180,
+    polling_url: str | None = None,
+    progress: Callable[[str], None] | None = None,
 ) -> dict:
     """
     Poll BFL API for generation result.
@@ -69,6 +119,7 @@ def _poll_for_result(
         request_id: The task ID returned from generation request
         timeout: Maximum time to wait in seconds
         polling_url: Optional polling URL returned by the submit response
+        progress: Optional callback receiving a short status message per poll
 
     Returns:
         Result dict with image URL
@@ -84,11 +135,12 @@ def _poll_for_result(
 
     while time.time() - start_time < timeout:
         try:
-            response = requests.get(
+            response = request(
+                "poll",
+                "GET",
                 poll_endpoint,
                 headers={"x-key": api_key},
                 params=poll_params,
-                timeout=REQUEST_TIMEOUT,
             )
         except requests.exceptions.RequestException as e:
             print(f"[BFL API] Poll request error: {e}, retrying...")
@@ -125,29 +177,237 @@ def _poll_for_result(
 
         # Pending / Processing — keep waiting
         print(f"[BFL API] Status: {poll_status} ({time.time() - start_time:.0f}s)")
+        _report(progress, f"{poll_status} ({time.time() - start_time:.0f}s)")
         time.sleep(2)
 
     raise Exception(f"Generation timed out after {timeout} seconds")
 
 
-def _download_image(url: str, output_path: str) -> str:
-    """Download image from URL to local path"""
-    response = requests.get(url, timeout=REQUEST_TIMEOUT)
+class _ImagePayload:
+    """
+    JSON request body {**fields, image_field: base64(image file)}, produced
+    incrementally as it is sent.
+
+    Only UPLOAD_CHUNK_SIZE bytes of the image are in memory at a time; the
+    full length is known up front, so the request still carries a
+    Content-Length. Rewinding (seek(0)) lets a retried request resend it.
+    """
+
+    def __init__(self, fields: dict, image_field: str, image_path: str):
+        head = json.dumps(fields)[:-1]
+        separator = ", " if fields else ""
+        self._head = f'{head}{separator}"{image_field}": "'.encode()
+        self._tail = b'"}'
+        self._image_path = image_path
+
+        image_size = os.path.getsize(image_path)
+        self.encoded_size = 4 * ((image_size + 2) // 3)
+        self._length = len(self._head) + self.encoded_size + len(self._tail)
+        self._file = None
+        self.seek(0)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if offset or whence:
+            raise OSError("_ImagePayload can only be rewound to the start")
+        self.close()
+        self._buffer = bytearray(self._head)
+        self._position = 0
+        self._done = False
+        return 0
+
+    def _fill(self):
+        if self._file is None:
+            self._file = open(self._image_path, "rb")
+        chunk = self._file.read(UPLOAD_CHUNK_SIZE)
+        if chunk:
+            self._buffer += base64.b64encode(chunk)
+        else:
+            self._buffer += self._tail
+            self.close()
+            self._done = True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _ImageWriter:
+    """
+    Write a downloaded image to output_path chunk by chunk, computing its
+    SHA-256 on the way. Data goes to a .part file that only replaces
+    output_path once the download is complete.
+    """
+
+    def __init__(self, output_path: str):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        self.output_path = output_path
+        self._partial_path = f"{output_path}.part"
+        self._file = open(self._partial_path, "wb")
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        self._digest.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self, expected_size: int | None = None) -> str:
+        """Move the finished file into place; returns its SHA-256 hex digest."""
+        self._file.close()
+        if expected_size is not None and self.size != expected_size:
+            self.abort()
+            raise Exception(
+                f"Image download truncated: {self.size} of {expected_size} bytes"
+            )
+        os.replace(self._partial_path, self.output_path)
+        return self._digest.hexdigest()
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._partial_path):
+            os.remove(self._partial_path)
+
+
+def _expected_size(headers) -> int | None:
+    """Content-Length of a download, if it describes the bytes we'll receive"""
+    if headers.get("Content-Encoding") or not headers.get("Content-Length"):
+        return None
+    return int(headers["Content-Length"])
+
+
+def _prepare_upload(image_path: str) -> str:
+    """
+    Normalize a Kontext input before upload: downscale it to the model's
+    working resolution (MUGSHOT_WIDTH x MUGSHOT_HEIGHT pixels, keeping the
+    aspect ratio) and re-encode it as JPEG.
+
+    Returns the file to upload: a temporary JPEG (remove it after use), or
+    image_path itself if it is within the working resolution and already
+    smaller than the JPEG.
+    """
+    started = time.time()
+    original_size = os.path.getsize(image_path)
+
+    with Image.open(image_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            # Flatten transparency onto white paper, like the sketches
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        scale = ((MUGSHOT_WIDTH * MUGSHOT_HEIGHT) / (img.width * img.height)) ** 0.5
+        original_dims = img.size
+        if scale < 1:
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            img = img.resize(size, Image.LANCZOS)
+
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+            img.save(f, format="JPEG", quality=UPLOAD_JPEG_QUALITY, optimize=True)
+            upload_path = f.name
+        width, height = img.size
+
+    upload_size = os.path.getsize(upload_path)
+    if scale >= 1 and upload_size >= original_size:
+        os.remove(upload_path)
+        upload_path = image_path
+        upload_size = original_size
+        width, height = original_dims
+
+    print(
+        f"[BFL API] Upload image: {original_size / 1024:.0f} KB -> "
+        f"{upload_size / 1024:.0f} KB ({width}x{height}) "
+        f"in {(time.time() - started) * 1000:.0f} ms"
+    )
+    return upload_path
+
+
+def _log_upload_saving(original_path: str, body: "_ImagePayload", seconds: float):
+    """Log how long the submit took and the upload time preprocessing saved."""
+    saved = 4 * ((os.path.getsize(original_path) + 2) // 3) - body.encoded_size
+    rate = len(body) / seconds if seconds > 0 else 0
+    if saved > 0 and rate:
+        print(
+            f"[BFL API] Submitted {len(body) / 1024:.0f} KB in {seconds:.2f}s, "
+            f"~{saved / rate:.2f}s saved by shrinking the upload"
+        )
+
+
+def _submit(
+    endpoint: str, payload: dict, image_path: str | None = None
+) -> tuple[str, str | None]:
+    """
+    Submit a generation request; returns (request_id, polling_url).
+
+    With image_path, the image is normalized (see _prepare_upload) and
+    streamed into the body as payload's "input_image" (see _ImagePayload).
+    """
+    headers = {"x-key": _get_api_key(), "Content-Type": "application/json"}
+    if image_path:
+        upload_path = _prepare_upload(image_path)
+        body = _ImagePayload(payload, "input_image", upload_path)
+        try:
+            started = time.time()
+            response = request("submit", "POST", endpoint, headers=headers, data=body)
+            _log_upload_saving(image_path, body, time.time() - started)
+        finally:
+            body.close()
+            if upload_path != image_path:
+                os.remove(upload_path)
+    else:
+        response = request("submit", "POST", endpoint, headers=headers, json=payload)
+
+    _check_rate_limit(response.status_code, response.headers)
     if response.status_code != 200:
-        raise Exception(f"Failed to download image: {response.status_code}")
+        error_msg = response.text
+        print(f"[BFL API] Error ({response.status_code}): {error_msg[:300]}")
+        raise Exception(f"BFL API request failed ({response.status_code}): {error_msg}")
 
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    result = response.json()
+    request_id = result.get("id")
+    if not request_id:
+        raise Exception(f"No request ID in response: {result}")
 
-    with open(output_path, "wb") as f:
-        f.write(response.content)
+    print(f"[BFL API] Request submitted, ID: {request_id}")
+    return request_id, result.get("polling_url")
 
-    return output_path
 
+def _download_image(url: str, output_path: str) -> str:
+    """Stream image from URL to local path"""
+    with request("download", "GET", url, stream=True) as response:
+        if response.status_code != 200:
+            raise Exception(f"Failed to download image: {response.status_code}")
 
-def _image_to_base64(image_path: str) -> str:
-    """Convert image file to base64 string"""
-    with open(image_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        writer = _ImageWriter(output_path)
+        try:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        checksum = writer.commit(_expected_size(response.headers))
+
+    print(f"[BFL API] Downloaded {writer.size / 1024:.0f} KB, sha256 {checksum[:16]}")
+    return output_path
 
 
 def _run_dev_generate(
@@ -155,6 +415,8 @@ def _run_dev_generate(
     output_path: str,
     width: int = MUGSHOT_WIDTH,
     height: int = MUGSHOT_HEIGHT,
+    progress: Callable[[str], None] | None = None,
+    seed: int | None = None,
 ) -> str:
     """
     Run BFL Flux Dev API for text-to-image generation.
@@ -164,11 +426,12 @@ def _run_dev_generate(
         output_path: Where to save the generated image
         width: Image width (default: 768)
         height: Image height (default: 1024)
+        progress: Optional callback receiving short status messages
+        seed: Optional seed, for reproducible variants
 
     Returns:
         Path to generated image
     """
-    api_key = _get_api_key()
     endpoint = _get_text2img_endpoint()
     model_name = django_settings.BFL_TEXT2IMG_MODEL
 
@@ -181,43 +444,31 @@ def _run_dev_generate(
         "width": width,
         "height": height,
     }
+    if seed is not None:
+        payload["seed"] = seed
 
-    try:
-        response = requests.post(
-            endpoint,
-            headers={"x-key": api_key, "Content-Type": "application/json"},
-            json=payload,
-            timeout=REQUEST_TIMEOUT,
-        )
+    _report(progress, f"Submitting to {model_name}")
 
-        if response.status_code != 200:
-            error_msg = response.text
-            print(f"[BFL API] Error: {error_msg}")
-            raise Exception(
-                f"BFL API request failed ({response.status_code}): {error_msg}"
-            )
-
-        result = response.json()
-        request_id = result.get("id")
-        polling_url = result.get("polling_url")
-
-        if not request_id:
-            raise Exception(f"No request ID in response: {result}")
-
-        print(f"[BFL API] Request submitted, ID: {request_id}")
+    try:
+        request_id, polling_url = _submit(endpoint, payload)
+        _report(progress, "Submitted, waiting for result")
 
-        result = _poll_for_result(request_id, polling_url=polling_url)
+        result = _poll_for_result(
+            request_id, polling_url=polling_url, progress=progress
+        )
         image_url = result.get("result", {}).get("sample")
 
         if not image_url:
             raise Exception(f"No image URL in result: {result}")
 
+        _report(progress, "Downloading result")
         _download_image(image_url, output_path)
 
         elapsed = time.time() - start_time
         file_size = os.path.getsize(output_path) / 1024 / 1024
         print(f"[BFL API] Generation completed in {elapsed:.1f}s")
         print(f"[BFL API] Output: {output_path} ({file_size:.2f} MB)")
+        _log_session_stats()
 
         return output_path
 
@@ -234,6 +485,8 @@ def _run_kontext_generate(
     prompt: str,
     output_path: str,
     init_image_path: str,
+    progress: Callable[[str], None] | None = None,
+    seed: int | None = None,
 ) -> str:
     """
     Run BFL Flux Kontext Pro API for image editing/transformation.
@@ -242,11 +495,12 @@ def _run_kontext_generate(
         prompt: Text prompt describing the edit/transformation
         output_path: Where to save the generated image
         init_image_path: Path to the source image to edit
+        progress: Optional callback receiving short status messages
+        seed: Optional seed, for reproducible variants
 
     Returns:
         Path to generated image
     """
-    api_key = _get_api_key()
     endpoint = _get_img2img_endpoint()
     model_name = django_settings.BFL_IMG2IMG_MODEL
 
@@ -257,52 +511,40 @@ def _run_kontext_generate(
     if not os.path.exists(init_image_path):
         raise Exception(f"Source image not found: {init_image_path}")
 
-    image_b64 = _image_to_base64(init_image_path)
-    img_size_mb = len(image_b64) * 3 / 4 / 1024 / 1024
-    print(f"[BFL API] Input image: {init_image_path} ({img_size_mb:.2f} MB base64)")
+    img_size_mb = os.path.getsize(init_image_path) / 1024 / 1024
+    print(f"[BFL API] Input image: {init_image_path} ({img_size_mb:.2f} MB)")
 
     payload = {
         "prompt": prompt,
-        "input_image": image_b64,
         "output_format": "png",
     }
+    if seed is not None:
+        payload["seed"] = seed
+
+    _report(progress, f"Submitting to {model_name}")
 
     try:
-        response = requests.post(
-            endpoint,
-            headers={"x-key": api_key, "Content-Type": "application/json"},
-            json=payload,
-            timeout=REQUEST_TIMEOUT,
+        request_id, polling_url = _submit(
+            endpoint, payload, image_path=init_image_path
         )
+        _report(progress, "Submitted, waiting for result")
 
-        if response.status_code != 200:
-            error_msg = response.text
-            print(f"[BFL API] Error ({response.status_code}): {error_msg[:300]}")
-            raise Exception(
-                f"BFL API request failed ({response.status_code}): {error_msg}"
-            )
-
-        result = response.json()
-        request_id = result.get("id")
-        polling_url = result.get("polling_url")
-
-        if not request_id:
-            raise Exception(f"No request ID in response: {result}")
-
-        print(f"[BFL API] Request submitted, ID: {request_id}")
-
-        result = _poll_for_result(request_id, polling_url=polling_url)
+        result = _poll_for_result(
+            request_id, polling_url=polling_url, progress=progress
+        )
         image_url = result.get("result", {}).get("sample")
 
         if not image_url:
             raise Exception(f"No image URL in result: {result}")
 
+        _report(progress, "Downloading result")
         _download_image(image_url, output_path)
 
         elapsed = time.time() - start_time
         file_size = os.path.getsize(output_path) / 1024 / 1024
         print(f"[BFL API] Edit completed in {elapsed:.1f}s")
         print(f"[BFL API] Output: {output_path} ({file_size:.2f} MB)")
+        _log_session_stats()
 
         return output_path
 
@@ -329,11 +571,78 @@ SKETCH_SYSTEM_PROMPT = (
 )
 
 
+def _sketch_prompt(features_description: str, user_prompt: str = "") -> str:
+    """Text-to-image prompt for a sketch from selected features"""
+    # Build the person description from features + optional user text
+    person_desc = f"The sketch shows an Indian person with the following features: {features_description}."
+    if user_prompt:
+        person_desc += f" Additional details from witness: {user_prompt}."
+
+    return f"{SKETCH_SYSTEM_PROMPT} {person_desc}"
+
+
+def _reference_sketch_prompt(features_description: str, user_prompt: str = "") -> str:
+    """Image-to-image prompt recreating a reference photo as a sketch"""
+    reference_prompt = (
+        f"Recreate this person as a hand-drawn police forensic pencil sketch. "
+        f"Accurately capture the facial structure, proportions, and features visible in this image. "
+        f"The person has: {features_description}. "
+    )
+    if user_prompt:
+        reference_prompt += f"Additional details: {user_prompt}. "
+    return reference_prompt + SKETCH_SYSTEM_PROMPT
+
+
+def _revision_prompt(
+    edit_instruction: str, conversation_history: list[str] | None = None
+) -> str:
+    """Kontext prompt applying an edit while keeping the sketch style"""
+    # Build context from conversation history if available
+    context_prefix = ""
+    if conversation_history:
+        past_edits = "; ".join(conversation_history)
+        context_prefix = (
+            f"Previous edits already applied to this sketch: [{past_edits}]. "
+            f"Now additionally: "
+        )
+
+    # IMPORTANT: Strong style enforcement at the END of the prompt so the model
+    # doesn't drift toward photorealism or lose the sketch aesthetic.
+    revision_prompt = (
+        f"{context_prefix}{edit_instruction}. "
+        f"CRITICAL STYLE RULES — the output MUST remain a raw pencil sketch on paper: "
+        f"visible graphite pencil strokes, crosshatching, paper texture, smudge marks, "
+        f"black and white only, NO color, NO photorealism, NO digital rendering. "
+        f"Only change what was requested — preserve the sketch style and all other details exactly as-is."
+    )
+    return revision_prompt
+
+
+def _colorize_prompt(features_description: str) -> str:
+    """Kontext prompt turning a sketch into a realistic mugshot photo"""
+    color_prompt = (
+        f"Transform this pencil sketch into a real unedited police booking photograph. "
+        f"The person is an Indian suspect with these features: {features_description}. "
+        f"Wearing a plain white collared shirt. "
+        f"This must look like a real raw mugshot photo taken at an Indian police station - "
+        f"unflattering harsh fluorescent overhead light, washed out, slightly grainy, "
+        f"plain dirty gray wall background, no retouching or beautification. "
+        f"Realistic imperfect skin with pores, blemishes, uneven tone. "
+        f"Natural South Asian skin color, real hair texture. "
+        f"The person looks tired with a blank neutral expression, direct eye contact. "
+        f"Preserve the exact face shape, nose, eyes, mouth, and all features from the sketch. "
+        f"NOT idealized, NOT stylized, NOT a portrait photo - this is a gritty criminal booking photo."
+    )
+    return color_prompt
+
+
 def generate_sketch(
     features_description: str,
     output_path: str,
     user_prompt: str = "",
     reference_image_path: str | None = None,
+    progress: Callable[[str], None] | None = None,
+    seed: int | None = None,
 ) -> str:
     """
     Generate a police-style pencil sketch mugshot.
@@ -343,39 +652,30 @@ def generate_sketch(
         output_path: Output file path
         user_prompt: Optional free-form user description (extra details)
         reference_image_path: Optional path to a reference photo (CCTV, blurry, etc.)
+        progress: Optional callback receiving short status messages
+        seed: Optional seed; the same description with different seeds gives
+            different candidate sketches
 
     Returns:
         Path to generated image
     """
-    # Build the person description from features + optional user text
-    person_desc = f"The sketch shows an Indian person with the following features: {features_description}."
-    if user_prompt:
-        person_desc += f" Additional details from witness: {user_prompt}."
-
-    full_prompt = f"{SKETCH_SYSTEM_PROMPT} {person_desc}"
-
     if reference_image_path and os.path.exists(reference_image_path):
         # Use Kontext (img2img) to recreate sketch from reference photo
-        reference_prompt = (
-            f"Recreate this person as a hand-drawn police forensic pencil sketch. "
-            f"Accurately capture the facial structure, proportions, and features visible in this image. "
-            f"The person has: {features_description}. "
-        )
-        if user_prompt:
-            reference_prompt += f"Additional details: {user_prompt}. "
-        reference_prompt += SKETCH_SYSTEM_PROMPT
-
         print(f"[BFL API] Generating sketch FROM reference image...")
         return _run_kontext_generate(
-            prompt=reference_prompt,
+            prompt=_reference_sketch_prompt(features_description, user_prompt),
             output_path=output_path,
             init_image_path=reference_image_path,
+            progress=progress,
+            seed=seed,
         )
     else:
         # Text-to-image generation (no reference)
         return _run_dev_generate(
-            prompt=full_prompt,
+            prompt=_sketch_prompt(features_description, user_prompt),
             output_path=output_path,
+            progress=progress,
+            seed=seed,
         )
 
 
@@ -384,6 +684,7 @@ def revise_sketch(
     init_image_path: str,
     output_path: str,
     conversation_history: list[str] | None = None,
+    progress: Callable[[str], None] | None = None,
     **kwargs,
 ) -> str:
     """
@@ -394,28 +695,12 @@ def revise_sketch(
         init_image_path: Path to the sketch to revise
         output_path: Output file path
         conversation_history: List of previous revision prompts for context
+        progress: Optional callback receiving short status messages
 
     Returns:
         Path to revised image
     """
-    # Build context from conversation history if available
-    context_prefix = ""
-    if conversation_history:
-        past_edits = "; ".join(conversation_history)
-        context_prefix = (
-            f"Previous edits already applied to this sketch: [{past_edits}]. "
-            f"Now additionally: "
-        )
-
-    # IMPORTANT: Strong style enforcement at the END of the prompt so the model
-    # doesn't drift toward photorealism or lose the sketch aesthetic.
-    revision_prompt = (
-        f"{context_prefix}{edit_instruction}. "
-        f"CRITICAL STYLE RULES — the output MUST remain a raw pencil sketch on paper: "
-        f"visible graphite pencil strokes, crosshatching, paper texture, smudge marks, "
-        f"black and white only, NO color, NO photorealism, NO digital rendering. "
-        f"Only change what was requested — preserve the sketch style and all other details exactly as-is."
-    )
+    revision_prompt = _revision_prompt(edit_instruction, conversation_history)
 
     print(f"[BFL API] Revising sketch with Kontext Pro...")
 
@@ -423,6 +708,7 @@ def revise_sketch(
         prompt=revision_prompt,
         output_path=output_path,
         init_image_path=init_image_path,
+        progress=progress,
     )
 
 
@@ -430,6 +716,7 @@ def colorize_sketch(
     features_description: str,
     sketch_path: str,
     output_path: str,
+    progress: Callable[[str], None] | None = None,
     **kwargs,
 ) -> str:
     """
@@ -439,23 +726,12 @@ def colorize_sketch(
         features_description: Facial features for color accuracy
         sketch_path: Path to the B&W sketch
         output_path: Output file path
+        progress: Optional callback receiving short status messages
 
     Returns:
         Path to colorized image
     """
-    color_prompt = (
-        f"Transform this pencil sketch into a real unedited police booking photograph. "
-        f"The person is an Indian suspect with these features: {features_description}. "
-        f"Wearing a plain white collared shirt. "
-        f"This must look like a real raw mugshot photo taken at an Indian police station - "
-        f"unflattering harsh fluorescent overhead light, washed out, slightly grainy, "
-        f"plain dirty gray wall background, no retouching or beautification. "
-        f"Realistic imperfect skin with pores, blemishes, uneven tone. "
-        f"Natural South Asian skin color, real hair texture. "
-        f"The person looks tired with a blank neutral expression, direct eye contact. "
-        f"Preserve the exact face shape, nose, eyes, mouth, and all features from the sketch. "
-        f"NOT idealized, NOT stylized, NOT a portrait photo - this is a gritty criminal booking photo."
-    )
+    color_prompt = _colorize_prompt(features_description)
 
     print(f"[BFL API] Colorizing sketch with Kontext Pro...")
 
@@ -463,4 +739,127 @@ def colorize_sketch(
         prompt=color_prompt,
         output_path=output_path,
         init_image_path=sketch_path,
+        progress=progress,
+    )
+
+
+# ── Webhook mode: submit now, collect the result when BFL calls back ──
+
+# Statuses BFL reports for a finished task (polling uses "Ready", webhook
+# notifications "SUCCESS") and for one that will never produce an image
+READY_STATUSES = ("Ready", "SUCCESS")
+FAILED_STATUSES = ("Error", "Failed", "FAILED", "Request Moderated", "Content Moderated")
+
+
+def _generation_request(name: str, kwargs: dict) -> tuple[str, dict, str | None]:
+    """
+    Endpoint, payload and source image (streamed as "input_image", see
+    _submit) of generate_sketch/revise_sketch/colorize_sketch(**kwargs)
+    """
+    if name == "generate_sketch":
+        reference_image_path = kwargs.get("reference_image_path")
+        if reference_image_path and os.path.exists(reference_image_path):
+            prompt = _reference_sketch_prompt(
+                kwargs["features_description"], kwargs.get("user_prompt", "")
+            )
+            init_image_path = reference_image_path
+        else:
+            prompt = _sketch_prompt(
+                kwargs["features_description"], kwargs.get("user_prompt", "")
+            )
+            payload = {"prompt": prompt, "width": MUGSHOT_WIDTH, "height": MUGSHOT_HEIGHT}
+            if kwargs.get("seed") is not None:
+                payload["seed"] = kwargs["seed"]
+            return _get_text2img_endpoint(), payload, None
+    elif name == "revise_sketch":
+        prompt = _revision_prompt(
+            kwargs["edit_instruction"], kwargs.get("conversation_history")
+        )
+        init_image_path = kwargs["init_image_path"]
+    elif name == "colorize_sketch":
+        prompt = _colorize_prompt(kwargs["features_description"])
+        init_image_path = kwargs["sketch_path"]
+    else:
+        raise ValueError(f"Unknown generation: {name}")
+
+    if not os.path.exists(init_image_path):
+        raise Exception(f"Source image not found: {init_image_path}")
+    payload = {"prompt": prompt, "output_format": "png"}
+    if kwargs.get("seed") is not None:
+        payload["seed"] = kwargs["seed"]
+    return _get_img2img_endpoint(), payload, init_image_path
+
+
+def describe_generation(name: str, kwargs: dict) -> dict:
+    """
+    What generate_sketch/revise_sketch/colorize_sketch(**kwargs) would ask
+    BFL for, without sending anything.
+
+    Returns:
+        {model, prompt, input_path, width, height, seed}: every field that
+        determines the result (see generation_cache.cache_key)
+    """
+    _, payload, image_path = _generation_request(name, kwargs)
+    if image_path:
+        model = django_settings.BFL_IMG2IMG_MODEL
+    else:
+        model = django_settings.BFL_TEXT2IMG_MODEL
+    return {
+        "model": model,
+        "prompt": payload["prompt"],
+        "input_path": image_path,
+        "width": payload.get("width"),
+        "height": payload.get("height"),
+        "seed": payload.get("seed"),
+    }
+
+
+def submit_generation(
+    name: str, kwargs: dict, webhook_url: str, webhook_secret: str | None = None
+) -> tuple[str, str | None]:
+    """
+    Submit a generation without waiting for it; BFL POSTs the outcome to
+    webhook_url when the task finishes.
+
+    Args:
+        name: "generate_sketch", "revise_sketch" or "colorize_sketch"
+        kwargs: Arguments that function would take (output_path is not used)
+        webhook_url: Where BFL should send the completion notification
+        webhook_secret: Optional secret BFL signs the notification with
+
+    Returns:
+        (request_id, polling_url) for fetch_result() should the webhook not arrive
+    """
+    endpoint, payload, image_path = _generation_request(name, kwargs)
+    payload["webhook_url"] = webhook_url
+    if webhook_secret:
+        payload["webhook_secret"] = webhook_secret
+
+    try:
+        return _submit(endpoint, payload, image_path=image_path)
+    except requests.exceptions.Timeout:
+        raise Exception("BFL API request timed out. Check your internet connection.")
+    except requests.exceptions.ConnectionError:
+        raise Exception("Could not connect to BFL API. Check your internet connection.")
+
+
+def fetch_result(request_id: str, polling_url: str | None = None) -> dict:
+    """Check a submitted task's status once (see _poll_for_result for the loop)"""
+    response = request(
+        "poll",
+        "GET",
+        polling_url or BFL_RESULT_ENDPOINT,
+        headers={"x-key": _get_api_key()},
+        params=None if polling_url else {"id": request_id},
     )
+    return response.json()
+
+
+def download_result(result: dict, output_path: str) -> str:
+    """Save the image of a finished task (from a poll or a webhook) to output_path"""
+    image_url = (result.get("result") or {}).get("sample")
+    if not image_url:
+        raise Exception(f"No image URL in result: {result}")
+    _download_image(image_url, output_path)
+    print(f"[BFL API] Output: {output_path}")
+    return output_path
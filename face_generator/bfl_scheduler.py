@@ -0,0 +1,259 @@
+"""
+BFL Submission Scheduler
+Decides when a generation job may submit to BFL, so a burst of jobs queues
+here instead of all hitting the API at once and failing on 429s.
+
+Each model (BFL_TEXT2IMG_MODEL, BFL_IMG2IMG_MODEL) has its own limits:
+- a token bucket of BFL_SUBMIT_RATE submissions per second, bursting up to
+  BFL_SUBMIT_BURST;
+- at most BFL_MAX_IN_FLIGHT tasks holding a slot (submitted and not yet
+  finished) at a time.
+
+Waiting jobs are served by lane first (LANES: interactive work ahead of
+batch work), then fairly across users: each job is tagged one step after
+its user's previous job (start-time fair queuing), so users take turns and
+one operator's burst can't starve everyone else.
+
+When BFL answers 429 anyway, throttled() halves the model's rate and pauses
+it for the Retry-After period; the rate then climbs back to BFL_SUBMIT_RATE
+by RATE_RECOVERY per second, so throughput settles just under the provider's
+limit instead of collapsing.
+
+Limits apply per process. A slot is held until release(job_id), and expires
+after LEASE_SECONDS in case a job never reports back. A webhook job may be
+completed by another process, so the process holding its slot watches for
+that through held_slots() (see jobs.release_finished_slots). Used by jobs.
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+
+from django.conf import settings
+
+# Lower lanes are served first
+LANES = {"interactive": 0, "batch": 1}
+
+# Slots not released within this long are reclaimed (seconds)
+LEASE_SECONDS = 900
+
+# Pause after a 429 without a Retry-After header (seconds)
+THROTTLE_PAUSE = 5.0
+
+# Floor for the adaptive rate, as a fraction of BFL_SUBMIT_RATE, and how fast
+# (submissions/s per second) it recovers after a 429
+MIN_RATE_FRACTION = 0.1
+RATE_RECOVERY = 0.25
+
+_cond = threading.Condition()
+_models = {}
+_slots = {}  # job_id -> (model, user, lease expiry)
+_waiters = []
+_sequence = itertools.count()
+_dispatcher = None
+
+
+class _Waiter:
+    __slots__ = ("job_id", "model", "lane", "user", "seq", "tag", "grant")
+
+    def __init__(self, job_id, model, lane, user, grant):
+        self.job_id = job_id
+        self.model = model
+        self.lane = LANES[lane]
+        self.user = user
+        self.seq = next(_sequence)
+        self.tag = 0
+        self.grant = grant
+
+
+class _ModelLimits:
+    """Token bucket and in-flight count of one model."""
+
+    def __init__(self):
+        self.max_rate = settings.BFL_SUBMIT_RATE
+        self.rate = self.max_rate
+        self.burst = settings.BFL_SUBMIT_BURST
+        self.max_in_flight = settings.BFL_MAX_IN_FLIGHT
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.throttled = 0
+        # Fair queuing: tag of the last granted job, and each user's last tag
+        self.virtual_time = 0
+        self.user_tags = {}
+
+    def tag(self, user: str) -> int:
+        tag = max(self.virtual_time, self.user_tags.get(user, 0)) + 1
+        self.user_tags[user] = tag
+        return tag
+
+    def refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        self.rate = min(self.max_rate, self.rate + RATE_RECOVERY * elapsed)
+        if now >= self.paused_until:
+            self.tokens = min(float(self.burst), self.tokens + self.rate * elapsed)
+
+    def ready(self, now: float) -> bool:
+        return (
+            now >= self.paused_until
+            and self.tokens >= 1
+            and self.in_flight < self.max_in_flight
+        )
+
+    def next_ready(self, now: float) -> float | None:
+        """Time when a token is next available, if in-flight room allows"""
+        if self.in_flight >= self.max_in_flight:
+            return None
+        if now < self.paused_until:
+            return self.paused_until
+        return now + (1 - self.tokens) / self.rate
+
+
+def _limits(model: str) -> _ModelLimits:
+    limits = _models.get(model)
+    if limits is None:
+        limits = _models[model] = _ModelLimits()
+    return limits
+
+
+def _dispatch(now: float) -> float | None:
+    """Grant every slot that can be granted; returns when to look again."""
+    for job_id, (model, _, expires) in list(_slots.items()):
+        if expires <= now:
+            print(f"[Scheduler] Slot of job {job_id} expired, reclaiming")
+            del _slots[job_id]
+            _limits(model).in_flight -= 1
+
+    wake = [expires for _, _, expires in _slots.values()]
+    for model in {waiter.model for waiter in _waiters}:
+        limits = _limits(model)
+        limits.refill(now)
+        while limits.ready(now):
+            waiting = [w for w in _waiters if w.model == model]
+            if not waiting:
+                break
+            waiter = min(waiting, key=lambda w: (w.lane, w.tag, w.seq))
+            _waiters.remove(waiter)
+            limits.tokens -= 1
+            limits.in_flight += 1
+            limits.virtual_time = max(limits.virtual_time, waiter.tag)
+            _slots[waiter.job_id] = (model, waiter.user, now + LEASE_SECONDS)
+            waiter.grant()
+
+        if any(w.model == model for w in _waiters):
+            next_ready = limits.next_ready(now)
+            if next_ready is not None:
+                wake.append(next_ready)
+
+    return min(wake) if wake else None
+
+
+def _dispatch_forever():
+    with _cond:
+        while True:
+            wake = _dispatch(time.monotonic())
+            _cond.wait(None if wake is None else max(0.0, wake - time.monotonic()))
+
+
+def _enqueue(waiter: _Waiter):
+    global _dispatcher
+
+    with _cond:
+        if _dispatcher is None:
+            _dispatcher = threading.Thread(
+                target=_dispatch_forever, name="bfl-scheduler", daemon=True
+            )
+            _dispatcher.start()
+        waiter.tag = _limits(waiter.model).tag(waiter.user)
+        _waiters.append(waiter)
+        _cond.notify_all()
+
+
+def acquire(job_id: int, model: str, lane: str = "interactive", user: str = ""):
+    """
+    Block until job_id may submit to BFL with `model`.
+
+    Args:
+        job_id: The GenerationJob taking the slot (see release())
+        model: BFL model name the job submits to
+        lane: Key of LANES
+        user: Requesting user, for fair queuing
+    """
+    granted = threading.Event()
+    _enqueue(_Waiter(job_id, model, lane, user, granted.set))
+    granted.wait()
+
+
+async def acquire_async(
+    job_id: int, model: str, lane: str = "interactive", user: str = ""
+):
+    """acquire() for a task on the running event loop; holds no thread while waiting"""
+    loop = asyncio.get_running_loop()
+    granted = loop.create_future()
+
+    def grant():
+        loop.call_soon_threadsafe(
+            lambda: granted.done() or granted.set_result(None)
+        )
+
+    waiter = _Waiter(job_id, model, lane, user, grant)
+    _enqueue(waiter)
+    try:
+        await granted
+    except asyncio.CancelledError:
+        with _cond:
+            if waiter in _waiters:
+                _waiters.remove(waiter)
+        release(job_id)
+        raise
+
+
+def release(job_id: int):
+    """Give back job_id's slot, if it holds one in this process."""
+    with _cond:
+        slot = _slots.pop(job_id, None)
+        if slot is not None:
+            _limits(slot[0]).in_flight -= 1
+            _cond.notify_all()
+
+
+def held_slots() -> list[int]:
+    """Ids of the jobs holding a slot in this process."""
+    with _cond:
+        return list(_slots)
+
+
+def throttled(model: str, retry_after: float | None = None):
+    """BFL rejected a submission with 429: slow `model` down and pause it."""
+    with _cond:
+        limits = _limits(model)
+        now = time.monotonic()
+        limits.refill(now)
+        limits.rate = max(limits.max_rate * MIN_RATE_FRACTION, limits.rate / 2)
+        limits.tokens = 0.0
+        limits.paused_until = max(
+            limits.paused_until, now + (retry_after or THROTTLE_PAUSE)
+        )
+        limits.throttled += 1
+        print(
+            f"[Scheduler] {model} throttled by BFL: rate now {limits.rate:.2f}/s, "
+            f"paused {retry_after or THROTTLE_PAUSE:.0f}s"
+        )
+        _cond.notify_all()
+
+
+def scheduler_info() -> dict:
+    """Per-model rate, slots in flight, queue length and 429 count."""
+    with _cond:
+        return {
+            model: {
+                "rate": round(limits.rate, 3),
+                "in_flight": limits.in_flight,
+                "waiting": sum(1 for w in _waiters if w.model == model),
+                "throttled": limits.throttled,
+            }
+            for model, limits in _models.items()
+        }
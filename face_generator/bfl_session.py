@@ -0,0 +1,234 @@
+"""
+Pooled HTTP Session for the BFL API
+One keep-alive requests.Session per process, shared by every bfl_flux call,
+so the dozens of polls behind a generation reuse a connection instead of
+paying a TCP + TLS handshake each.
+
+- Up to BFL_HTTP_POOL_SIZE connections are kept open per host (enough for
+  every GENERATION_WORKERS thread to hold one).
+- Failed connects, and GETs answered with 429/5xx, are retried up to
+  BFL_HTTP_RETRIES times with jittered exponential backoff. A submit (POST)
+  is only retried when it never reached BFL, so a generation is never
+  billed twice.
+- Each kind of call has its own (connect, read) timeout, see TIMEOUTS.
+
+bfl_async's httpx clients get the same policy through async_transport():
+the same retries, backoff and counters, with bfl_async passing TIMEOUTS per
+call. Their pools are sized per event loop, not by BFL_HTTP_POOL_SIZE.
+
+session_stats() reports how many requests went out over a reused
+connection, counting both clients.
+"""
+
+import asyncio
+import random
+import threading
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds per kind of call
+TIMEOUTS = {
+    # Submitting a generation; Kontext uploads a base64 image
+    "submit": (10, 60),
+    # Status checks answer immediately
+    "poll": (5, 15),
+    # Result images are a few MB from the BFL CDN
+    "download": (10, 120),
+}
+
+# Backoff between retries: RETRY_BACKOFF * 2^(retry - 1), plus up to
+# RETRY_JITTER seconds of random jitter so workers don't retry in lockstep
+RETRY_BACKOFF = 0.5
+RETRY_JITTER = 1.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+_stats = {"requests": 0, "connections": 0, "retries": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+class _JitterRetry(Retry):
+    """urllib3 Retry with jittered backoff and a retry counter."""
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, RETRY_JITTER) if backoff else 0
+
+    def increment(self, *args, **kwargs):
+        _count("retries")
+        return super().increment(*args, **kwargs)
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count("connections")
+        return super()._new_conn()
+
+    def _make_request(self, *args, **kwargs):
+        _count("requests")
+        return super()._make_request(*args, **kwargs)
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count("connections")
+        return super()._new_conn()
+
+    def _make_request(self, *args, **kwargs):
+        _count("requests")
+        return super()._make_request(*args, **kwargs)
+
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools count requests and new connections."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def _backoff(retry: int) -> float:
+    """Delay before the retry-th retry, as _JitterRetry computes it."""
+    if retry <= 1:
+        return 0
+    return RETRY_BACKOFF * 2 ** (retry - 1) + random.uniform(0, RETRY_JITTER)
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    try:
+        return max(0.0, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+
+async def _trace(event: str, info: dict):
+    if event == "connection.connect_tcp.complete":
+        _count("connections")
+
+
+class _RetryingAsyncTransport(httpx.AsyncBaseTransport):
+    """httpx transport with get_session()'s retry policy and counters."""
+
+    def __init__(self, limits: httpx.Limits):
+        self._transport = httpx.AsyncHTTPTransport(limits=limits)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions = {**request.extensions, "trace": _trace}
+        retries = settings.BFL_HTTP_RETRIES
+        for retry in range(1, retries + 2):
+            try:
+                response = await self._transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # Nothing was sent yet, so even a submit can go again
+                if retry > retries:
+                    raise
+                delay = _backoff(retry)
+            else:
+                _count("requests")
+                if (
+                    retry > retries
+                    or request.method != "GET"
+                    or response.status_code not in RETRY_STATUSES
+                ):
+                    return response
+                # Drain the error body so the connection goes back to the pool
+                await response.aread()
+                await response.aclose()
+                delay = _retry_after(response)
+                if delay is None:
+                    delay = _backoff(retry)
+            _count("retries")
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def async_transport(max_connections: int) -> httpx.AsyncBaseTransport:
+    """
+    Transport for an httpx.AsyncClient talking to BFL.
+
+    Args:
+        max_connections: Pool size (connections kept alive as well)
+
+    Returns:
+        A transport retrying like get_session() and counted in session_stats()
+    """
+    return _RetryingAsyncTransport(
+        httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+    )
+
+
+def get_session() -> requests.Session:
+    """This process's BFL session, created on first use."""
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retries = _JitterRetry(
+                total=settings.BFL_HTTP_RETRIES,
+                backoff_factor=RETRY_BACKOFF,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset({"GET"}),
+                raise_on_status=False,
+                respect_retry_after_header=True,
+            )
+            adapter = _PooledAdapter(
+                pool_connections=4,
+                pool_maxsize=settings.BFL_HTTP_POOL_SIZE,
+                max_retries=retries,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            print(
+                f"[BFL HTTP] Session ready: pool {settings.BFL_HTTP_POOL_SIZE}, "
+                f"{settings.BFL_HTTP_RETRIES} retries"
+            )
+        return _session
+
+
+def request(kind: str, method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Send a request over the shared session.
+
+    Args:
+        kind: Key into TIMEOUTS ("submit", "poll" or "download")
+        method: HTTP method
+        url: Request URL
+        **kwargs: Passed on to requests.Session.request()
+
+    Returns:
+        The response (retries already applied)
+    """
+    kwargs.setdefault("timeout", TIMEOUTS[kind])
+    return get_session().request(method, url, **kwargs)
+
+
+def session_stats() -> dict:
+    """Requests sent, connections opened and reused, and retries so far."""
+    with _stats_lock:
+        stats = dict(_stats)
+    reused = max(0, stats["requests"] - stats["connections"])
+    stats["reused"] = reused
+    stats["reuse_rate"] = round(reused / stats["requests"], 3) if stats["requests"] else 0.0
+    return stats
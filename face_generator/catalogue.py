@@ -0,0 +1,78 @@
+"""
+Feature Catalogue Cache
+The categories-with-features catalogue every page load fetches, rendered to
+JSON once and kept in Django's cache until the catalogue changes.
+
+Each cached entry carries a strong ETag (SHA-256 of the body) and the time it
+was built, for conditional GETs (304 Not Modified). invalidate() is called
+from signals on any save or delete of a FaceFeatureCategory or FaceFeature,
+which covers admin edits and populate_features; queryset.update() bypasses
+signals and needs an explicit invalidate().
+
+Entries are stored under a generation number that invalidate() bumps, so a
+catalogue built from rows read before an edit can never overwrite the newer
+one. Used by FaceFeatureCategoryViewSet.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from .models import FaceFeatureCategory
+from .serializers import FaceFeatureCategorySerializer
+
+GENERATION_KEY = "face_generator:catalogue:generation"
+
+
+def _generation() -> int:
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 0, None)
+        generation = cache.get(GENERATION_KEY, 0)
+    return generation
+
+
+def _entry_key(generation: int) -> str:
+    return f"face_generator:catalogue:{generation}"
+
+
+def get_catalogue() -> dict:
+    """
+    The catalogue, from the cache or freshly built.
+
+    Returns:
+        {"body": JSON bytes, "etag": quoted strong ETag,
+         "last_modified": aware datetime the entry was built}
+    """
+    generation = _generation()
+    entry = cache.get(_entry_key(generation))
+    if entry is not None:
+        return entry
+
+    categories = FaceFeatureCategory.objects.prefetch_related("features")
+    # No request in the serializer context: image URLs stay relative, so one
+    # body serves every host
+    body = JSONRenderer().render(
+        FaceFeatureCategorySerializer(categories, many=True).data
+    )
+    entry = {
+        "body": body,
+        "etag": f'"{hashlib.sha256(body).hexdigest()}"',
+        "last_modified": timezone.now().replace(microsecond=0),
+    }
+    cache.set(_entry_key(generation), entry, settings.CATALOGUE_CACHE_TIMEOUT)
+    print(f"[Catalogue] Built catalogue ({len(body) / 1024:.0f} KB)")
+    return entry
+
+
+def invalidate():
+    """Drop the cached catalogue; the next request rebuilds it."""
+    generation = _generation()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, generation + 1, None)
+    cache.delete(_entry_key(generation))
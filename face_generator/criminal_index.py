@@ -0,0 +1,640 @@
+"""
+Criminal DB Feature Index
+Persists the face_matcher gallery (histograms, grayscale thumbnails and SSIM
+statistics) next to the criminalDB images so worker processes can memory-map
+it at startup instead of re-decoding every JPEG.
+
+Layout of <criminalDB>/.index-<version>/, published by pointing the
+<criminalDB>/.index symlink at it:
+    manifest.json     - format, version token, row count and a fingerprint of
+                        the indexed files' names, mtimes and sizes
+    files.json        - per-file {mtime, size, sha256}, read only when syncing
+    ids.npy           - criminal id of every row (fixed-width unicode)
+    filenames.npy     - image filename of every row (fixed-width unicode)
+    <array>.npy       - one file per gallery array, rows aligned with ids.npy
+    ivf_*.npy         - IVF index over the descriptors (see ann_index)
+
+Every web worker maps the same files read-only, so the gallery lives once in
+the OS page cache however many workers there are: resident memory does not
+grow with the worker count, and a worker started after the first one finds
+the pages already warm. Builds and syncs are serialised across processes by
+an advisory lock on <criminalDB>/.index.lock, so when N workers start against
+a missing or stale index one of them rebuilds it and the others wait and map
+the result.
+
+A new index is written to its own versioned directory and published by
+atomically replacing the symlink, after which the previous directory is
+removed. Readers resolve the symlink once and read everything from the
+directory it names, so they never mix arrays of two versions; one that loses
+its directory to a concurrent publish simply resolves the symlink again.
+Arrays a process already mapped stay valid after their files are removed.
+
+The index is considered stale when the folder listing, or any file's mtime or
+size, no longer matches the manifest's fingerprint. sync_index() then brings it up to date
+incrementally: only added or modified images are decoded, rows for deleted
+files are dropped and every other row is copied over from the previous index.
+
+Feature extraction fans out over a process pool in chunks of files, with each
+image decoded exactly once.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: index builds are not coordinated
+    fcntl = None
+
+import cv2
+import numpy as np
+
+from .ann_index import assign_ivf, default_nlist, train_ivf
+from .face_matcher import (
+    SSIM_SIZE,
+    _build_gallery,
+    _compute_features,
+    _list_criminal_images,
+)
+
+INDEX_DIRNAME = ".index"
+LOCK_FILENAME = ".index.lock"
+MANIFEST_FILENAME = "manifest.json"
+FILES_FILENAME = "files.json"
+
+# Bump whenever the feature pipeline or array layout changes
+INDEX_FORMAT = 8
+
+# Times load_index() re-resolves the index after losing it to a publish
+LOAD_ATTEMPTS = 3
+
+# Gallery arrays persisted as .npy files
+INDEX_ARRAYS = (
+    "hist_centered",
+    "gray",
+    "mu",
+    "mu_sq",
+    "sigma_sq",
+    "coarse_gray",
+    "coarse_mu",
+    "coarse_mu_sq",
+    "coarse_sigma_sq",
+    "descriptor",
+)
+IVF_ARRAYS = ("ivf_centroids", "ivf_order", "ivf_offsets")
+LABEL_ARRAYS = ("ids", "filenames")
+
+# Rows copied per step when carrying an existing index over during a sync
+COPY_CHUNK_SIZE = 1024
+
+# Files handed to a pool worker per task, and the smallest batch worth a pool
+INDEX_CHUNK_SIZE = 64
+MIN_PARALLEL_FILES = 256
+
+# Seconds between progress lines while indexing
+PROGRESS_INTERVAL = 5.0
+
+
+def index_dir(criminal_db_path: str) -> str:
+    """Symlink to the directory of the current index for a criminal DB folder."""
+    return os.path.join(criminal_db_path, INDEX_DIRNAME)
+
+
+def _current_dir(criminal_db_path: str) -> str | None:
+    """Resolve index_dir() to the directory of the current index, if any."""
+    path = os.path.realpath(index_dir(criminal_db_path))
+    return path if os.path.isdir(path) else None
+
+
+def published_version(criminal_db_path: str) -> str | None:
+    """
+    Version of the index the symlink points at, read from its target name
+    without opening anything; None if there is no published index.
+    """
+    try:
+        target = os.readlink(index_dir(criminal_db_path))
+    except OSError:
+        return None
+    prefix = f"{INDEX_DIRNAME}-"
+    return target[len(prefix) :] if target.startswith(prefix) else None
+
+
+def index_is_stale(criminal_db_path: str) -> bool:
+    """True if the published index is missing or no longer matches the folder."""
+    path = _current_dir(criminal_db_path)
+    manifest = _read_manifest(path) if path else None
+    return manifest is None or _is_stale(manifest, scan_criminal_db(criminal_db_path))
+
+
+@contextmanager
+def index_lock(criminal_db_path: str):
+    """
+    Hold the cross-process lock that serialises index builds and syncs.
+
+    Blocks until any other process building the same index has finished.
+    Not re-entrant: the lock is per open file, so nesting it in one process
+    deadlocks.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(os.path.join(criminal_db_path, LOCK_FILENAME), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def scan_criminal_db(criminal_db_path: str) -> dict:
+    """
+    Stat every image in the criminal DB folder.
+
+    Returns dict of {filename: {"mtime": int (ns), "size": int}}
+    """
+    files = {}
+    for filename in _list_criminal_images(criminal_db_path):
+        stat = os.stat(os.path.join(criminal_db_path, filename))
+        files[filename] = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+    return files
+
+
+def _init_index_worker():
+    """Pool initializer: one OpenCV thread per process avoids oversubscription."""
+    cv2.setNumThreads(1)
+
+
+def _index_chunk(criminal_db_path: str, filenames: list[str]) -> list[tuple]:
+    """Compute features for a chunk of files (runs in a pool worker)."""
+    results = []
+    for filename in filenames:
+        hist, gray_image = _compute_features(os.path.join(criminal_db_path, filename))
+        if hist is not None:
+            results.append((filename, hist, gray_image))
+    return results
+
+
+def load_criminal_images(
+    criminal_db_path: str,
+    filenames: list[str],
+    workers: int | None = None,
+) -> dict:
+    """
+    Decode criminal DB images and compute their features.
+
+    Large batches are split into chunks of INDEX_CHUNK_SIZE files and spread
+    across a process pool; progress and throughput are printed as chunks
+    complete.
+
+    Args:
+        criminal_db_path: Path to the criminalDB folder
+        filenames: Files to load
+        workers: Pool size (default: all cores; 1 runs in-process)
+
+    Returns dict of {criminal_id: {path, filename, histogram, gray_image}},
+    ordered like filenames
+    """
+    workers = workers or os.cpu_count() or 1
+    total = len(filenames)
+    chunks = [
+        filenames[start : start + INDEX_CHUNK_SIZE]
+        for start in range(0, total, INDEX_CHUNK_SIZE)
+    ]
+    processes = min(workers, len(chunks)) if total >= MIN_PARALLEL_FILES else 1
+    print(
+        f"[CriminalIndex] Computing features for {total} images "
+        f"({processes} processes)..."
+    )
+
+    start_time = time.time()
+    last_report = start_time
+    done = 0
+    results = {}
+
+    def record(chunk_results, chunk_size):
+        nonlocal done, last_report
+        for filename, hist, gray_image in chunk_results:
+            results[filename] = (hist, gray_image)
+        done += chunk_size
+        now = time.time()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            print(
+                f"[CriminalIndex] {done}/{total} images ({done / total:.0%}), "
+                f"{done / (now - start_time):.0f} img/s"
+            )
+
+    if processes == 1:
+        for chunk in chunks:
+            record(_index_chunk(criminal_db_path, chunk), len(chunk))
+    else:
+        # spawn: never fork a (possibly threaded) web or management process
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_index_worker,
+        ) as pool:
+            futures = {
+                pool.submit(_index_chunk, criminal_db_path, chunk): len(chunk)
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                record(future.result(), futures[future])
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(
+        f"[CriminalIndex] Computed {len(results)}/{total} images in {elapsed:.1f}s "
+        f"({total / elapsed:.0f} img/s)"
+    )
+
+    criminals = {}
+    for filename in filenames:
+        if filename in results:
+            hist, gray_image = results[filename]
+            criminals[os.path.splitext(filename)[0]] = {
+                "path": os.path.join(criminal_db_path, filename),
+                "filename": filename,
+                "histogram": hist,
+                "gray_image": gray_image,
+            }
+    return criminals
+
+
+def _hash_file(filepath: str) -> str:
+    """SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_manifest(path: str) -> dict | None:
+    """Read an index manifest, or None if missing or from another format."""
+    try:
+        with open(os.path.join(path, MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("format") != INDEX_FORMAT or manifest.get("ssim_size") != SSIM_SIZE:
+        return None
+    return manifest
+
+
+def _read_files(path: str) -> dict:
+    """Per-file stats of an index directory (see scan_criminal_db)."""
+    with open(os.path.join(path, FILES_FILENAME)) as f:
+        return json.load(f)
+
+
+def _fingerprint(files: dict) -> str:
+    """Digest of the filenames, mtimes and sizes in a files dict."""
+    listing = sorted((name, stat["mtime"], stat["size"]) for name, stat in files.items())
+    return hashlib.sha256(json.dumps(listing).encode()).hexdigest()
+
+
+def _write_json(path: str, data: dict):
+    """Replace a JSON file atomically."""
+    staging = f"{path}.tmp-{os.getpid()}"
+    with open(staging, "w") as f:
+        json.dump(data, f)
+    os.replace(staging, path)
+
+
+def _is_stale(manifest: dict, files: dict) -> bool:
+    """True if the manifest no longer describes the files on disk."""
+    return manifest["fingerprint"] != _fingerprint(files)
+
+
+def write_index(
+    criminal_db_path: str,
+    files: dict,
+    fresh: dict,
+    base: dict | None = None,
+    keep_rows: list[int] | None = None,
+) -> dict:
+    """
+    Persist an index made of rows kept from a previous index plus fresh rows.
+
+    Arrays are written through np.lib.format.open_memmap, so carrying over a
+    large existing index never needs it fully in memory. The new index is
+    written to its own versioned directory and published with _publish().
+
+    Args:
+        criminal_db_path: Path to the criminalDB folder
+        files: Manifest file entries {filename: {mtime, size, sha256}}
+        fresh: Gallery of newly computed rows (see face_matcher._build_gallery)
+        base: Previously mapped gallery to carry rows over from
+        keep_rows: Row indices of base to keep, in order
+
+    Returns the manifest that was written.
+    """
+    keep_rows = list(keep_rows or [])
+    labels = {}
+    for name in LABEL_ARRAYS:
+        kept = list(base[name][keep_rows]) if base and keep_rows else []
+        labels[name] = np.array(kept + list(fresh[name]), dtype=str)
+    count = len(labels["ids"])
+
+    manifest = {
+        "format": INDEX_FORMAT,
+        "version": uuid.uuid4().hex,
+        "created_at": time.time(),
+        "ssim_size": SSIM_SIZE,
+        "count": count,
+        "fingerprint": _fingerprint(files),
+    }
+    staging = f"{index_dir(criminal_db_path)}-{manifest['version']}"
+    os.makedirs(staging)
+
+    try:
+        for name, values in labels.items():
+            np.save(os.path.join(staging, f"{name}.npy"), values)
+        if count:
+            for name in INDEX_ARRAYS:
+                source = fresh if len(fresh["ids"]) else base
+                out = np.lib.format.open_memmap(
+                    os.path.join(staging, f"{name}.npy"),
+                    mode="w+",
+                    dtype=source[name].dtype,
+                    shape=(count,) + source[name].shape[1:],
+                )
+                for start in range(0, len(keep_rows), COPY_CHUNK_SIZE):
+                    rows = keep_rows[start : start + COPY_CHUNK_SIZE]
+                    out[start : start + len(rows)] = base[name][rows]
+                if len(fresh["ids"]):
+                    out[len(keep_rows) :] = fresh[name]
+                out.flush()
+                del out
+            _write_ivf(staging, base)
+        with open(os.path.join(staging, FILES_FILENAME), "w") as f:
+            json.dump(files, f)
+        with open(os.path.join(staging, MANIFEST_FILENAME), "w") as f:
+            json.dump(manifest, f)
+        _publish(criminal_db_path, staging)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    return manifest
+
+
+def _publish(criminal_db_path: str, version_dir: str):
+    """
+    Point index_dir() at version_dir and remove every other index directory.
+
+    The symlink is replaced with one rename, so a reader resolves either the
+    old index or the new one. Must be called with the index lock held.
+    """
+    target = index_dir(criminal_db_path)
+    link = f"{target}.link-{os.getpid()}"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version_dir), link)
+
+    if os.path.isdir(target) and not os.path.islink(target):
+        # A directory left by an index format that predates the symlink
+        shutil.rmtree(target, ignore_errors=True)
+    os.replace(link, target)
+
+    current = os.path.basename(version_dir)
+    for name in os.listdir(criminal_db_path):
+        if name.startswith(f"{INDEX_DIRNAME}-") and name != current:
+            shutil.rmtree(os.path.join(criminal_db_path, name), ignore_errors=True)
+
+
+def _write_ivf(staging: str, base: dict | None):
+    """
+    Build the IVF index over the descriptors written to `staging`.
+
+    A sync reuses the previous centroids and only reassigns rows, unless the
+    gallery has grown or shrunk enough that the cluster count is off by more
+    than 2x, in which case the centroids are retrained.
+    """
+    descriptors = np.load(os.path.join(staging, "descriptor.npy"), mmap_mode="r")
+    nlist = default_nlist(len(descriptors))
+
+    centroids = base.get("ivf_centroids") if base else None
+    if centroids is None or not nlist / 2 <= len(centroids) <= nlist * 2:
+        start_time = time.time()
+        centroids = train_ivf(descriptors, nlist)
+        print(
+            f"[CriminalIndex] Trained {len(centroids)} IVF clusters "
+            f"in {time.time() - start_time:.1f}s"
+        )
+
+    order, offsets = assign_ivf(descriptors, np.asarray(centroids))
+    np.save(os.path.join(staging, "ivf_centroids.npy"), centroids)
+    np.save(os.path.join(staging, "ivf_order.npy"), order)
+    np.save(os.path.join(staging, "ivf_offsets.npy"), offsets)
+
+
+def _rewrite_manifest_files(criminal_db_path: str, files: dict):
+    """Replace the file stats of the current index, keeping its version."""
+    path = _current_dir(criminal_db_path)
+    manifest = _read_manifest(path)
+    manifest["fingerprint"] = _fingerprint(files)
+
+    # Stats first: only syncs (which hold the index lock) read them
+    _write_json(os.path.join(path, FILES_FILENAME), files)
+    _write_json(os.path.join(path, MANIFEST_FILENAME), manifest)
+
+
+def load_index(
+    criminal_db_path: str, check_stale: bool = True, with_files: bool = False
+) -> dict | None:
+    """
+    Memory-map a persisted index.
+
+    Every array, including the ids and filenames, is mapped read-only, so
+    all processes mapping the same index share its pages. All files come from
+    the one index directory the symlink named when the load started.
+
+    Args:
+        criminal_db_path: Path to the criminalDB folder
+        check_stale: Return None if the folder changed since the index was built
+        with_files: Also return the manifest's per-file stats (needed to sync)
+
+    Returns:
+        Gallery dict (see face_matcher._build_gallery) with read-only memmap
+        arrays plus "version" (and "files"), or None if there is no usable index
+    """
+    for _ in range(LOAD_ATTEMPTS):
+        path = _current_dir(criminal_db_path)
+        if path is None:
+            return None
+        try:
+            return _load_index_dir(criminal_db_path, path, check_stale, with_files)
+        except FileNotFoundError:
+            # Removed by a concurrent publish: resolve the symlink again
+            if _current_dir(criminal_db_path) == path:
+                return None
+    return None
+
+
+def _load_index_dir(
+    criminal_db_path: str, path: str, check_stale: bool, with_files: bool
+) -> dict | None:
+    """load_index() from one resolved index directory."""
+    manifest = _read_manifest(path)
+    if manifest is None:
+        if _current_dir(criminal_db_path) != path:
+            raise FileNotFoundError(path)
+        return None
+
+    if check_stale and _is_stale(manifest, scan_criminal_db(criminal_db_path)):
+        return None
+
+    gallery = {"version": manifest["version"]}
+    if with_files:
+        gallery["files"] = _read_files(path)
+
+    names = LABEL_ARRAYS + (INDEX_ARRAYS + IVF_ARRAYS if manifest["count"] else ())
+    try:
+        for name in names:
+            gallery[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+    except FileNotFoundError:
+        raise
+    except (OSError, ValueError):
+        return None
+    return gallery
+
+
+def build_index(criminal_db_path: str, workers: int | None = None) -> dict:
+    """Decode every image in the criminal DB, persist the index and map it."""
+    with index_lock(criminal_db_path):
+        return _build_index(criminal_db_path, workers)
+
+
+def _build_index(criminal_db_path: str, workers: int | None) -> dict:
+    start_time = time.time()
+
+    files = scan_criminal_db(criminal_db_path)
+    for filename, stat in files.items():
+        stat["sha256"] = _hash_file(os.path.join(criminal_db_path, filename))
+
+    gallery = _build_gallery(
+        load_criminal_images(criminal_db_path, list(files), workers)
+    )
+
+    # Unreadable images stay in the manifest so they are only retried once
+    # they change, instead of making the index look stale forever
+    manifest = write_index(criminal_db_path, files, gallery)
+
+    print(
+        f"[CriminalIndex] Indexed {len(gallery['ids'])} images "
+        f"in {time.time() - start_time:.1f}s (version {manifest['version'][:8]})"
+    )
+    return load_index(criminal_db_path, check_stale=False)
+
+
+def sync_index(criminal_db_path: str, workers: int | None = None) -> tuple[dict, dict]:
+    """
+    Bring the persisted index up to date with the criminal DB folder.
+
+    Files are compared by mtime and size first; files whose stat changed are
+    hashed so a touched-but-identical image is not re-decoded. Only added or
+    modified images have their features computed, and rows of deleted files
+    are dropped.
+
+    Returns:
+        (gallery, summary) where summary is
+        {added, modified, removed, unchanged} lists of filenames
+    """
+    with index_lock(criminal_db_path):
+        return _sync_index(criminal_db_path, workers)
+
+
+def _sync_index(criminal_db_path: str, workers: int | None) -> tuple[dict, dict]:
+    base = load_index(criminal_db_path, check_stale=False, with_files=True)
+    if base is None:
+        gallery = _build_index(criminal_db_path, workers)
+        summary = {
+            "added": sorted(scan_criminal_db(criminal_db_path)),
+            "modified": [],
+            "removed": [],
+            "unchanged": [],
+        }
+        return gallery, summary
+
+    start_time = time.time()
+    indexed = base["files"]
+    files = scan_criminal_db(criminal_db_path)
+    summary = {"added": [], "modified": [], "removed": [], "unchanged": []}
+
+    for filename, stat in files.items():
+        previous = indexed.get(filename)
+        if previous and (previous["mtime"], previous["size"]) == (
+            stat["mtime"],
+            stat["size"],
+        ):
+            stat["sha256"] = previous["sha256"]
+            summary["unchanged"].append(filename)
+            continue
+
+        stat["sha256"] = _hash_file(os.path.join(criminal_db_path, filename))
+        if previous is None:
+            summary["added"].append(filename)
+        elif previous["sha256"] == stat["sha256"]:
+            summary["unchanged"].append(filename)
+        else:
+            summary["modified"].append(filename)
+
+    summary["removed"] = [name for name in indexed if name not in files]
+
+    changed = summary["added"] + summary["modified"]
+    if not changed and not summary["removed"]:
+        if files != indexed:
+            # Only stats moved (e.g. touched files): features are still valid
+            _rewrite_manifest_files(criminal_db_path, files)
+        return load_index(criminal_db_path, check_stale=False), summary
+
+    # Keep rows whose file is still present and unchanged, in index order
+    dropped = set(summary["modified"]) | set(summary["removed"])
+    keep_rows = [
+        row for row, filename in enumerate(base["filenames"]) if filename not in dropped
+    ]
+
+    fresh = _build_gallery(load_criminal_images(criminal_db_path, changed, workers))
+    manifest = write_index(criminal_db_path, files, fresh, base, keep_rows)
+
+    print(
+        f"[CriminalIndex] Synced in {time.time() - start_time:.1f}s: "
+        f"{len(summary['added'])} added, {len(summary['modified'])} modified, "
+        f"{len(summary['removed'])} removed, {len(summary['unchanged'])} unchanged "
+        f"(version {manifest['version'][:8]})"
+    )
+    return load_index(criminal_db_path, check_stale=False), summary
+
+
+def load_or_build_index(criminal_db_path: str) -> dict:
+    """
+    Map the persisted index, syncing it first if missing or stale.
+
+    When several workers find the index stale at once, the first to take the
+    index lock syncs it; the rest re-check once they get the lock and simply
+    map the fresh index.
+    """
+    gallery = load_index(criminal_db_path)
+    if gallery is None:
+        with index_lock(criminal_db_path):
+            gallery = load_index(criminal_db_path)
+            if gallery is None:
+                print("[CriminalIndex] Index missing or stale, syncing...")
+                gallery, _ = _sync_index(criminal_db_path, None)
+                return gallery
+
+    print(
+        f"[CriminalIndex] Mapped {len(gallery['ids'])} images "
+        f"(version {gallery['version'][:8]})"
+    )
+    return gallery
@@ -4,24 +4,143 @@ Compares a generated face against criminal database images using OpenCV.
 
 Uses histogram comparison + SSIM structural similarity for matching.
 No heavy ML dependencies — works with cv2 + numpy already installed.
+
+The criminal DB is held as a "gallery": per-image features stacked into
+contiguous NumPy arrays, so a query is scored against every candidate with
+a handful of batched operations instead of a Python loop. Galleries are
+persisted by criminal_index and memory-mapped read-only by each worker
+process, so all workers share one copy of the gallery in the page cache.
+
+Matching runs as a cascade, each stage pruning candidates for the next:
+    1. ann:   large galleries are narrowed to a shortlist with an approximate
+              nearest-neighbour (IVF) index over compact descriptors
+    2. coarse: candidates are ranked by histogram correlation alone, or by the
+              combined score with SSIM on COARSE_SSIM_SIZE thumbnails
+    3. ssim:  survivors are re-ranked with the full SSIM + histogram score
+match_face_with_stats() reports how many candidates each stage pruned.
+
+Query features are cached by the SHA-256 of the image bytes, and ranked
+results by that digest plus the gallery index version and match options, so
+re-matching an unchanged image is a dictionary lookup (see cache_info()).
 """
 
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+from typing import Optional
+
 import cv2
 import numpy as np
-from typing import Optional
 
+from .ann_index import search_ivf
+
+
+# Stacked feature arrays for the criminal DB (see _build_gallery), and when
+# the criminalDB folder was last compared with them (time.monotonic())
+_gallery: dict = {}
+_gallery_checked_at = 0.0
+
+# Image extensions treated as criminal DB entries
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Structural image size and SSIM window parameters
+SSIM_SIZE = 128
+SSIM_KERNEL_SIZE = 11
+SSIM_SIGMA = 1.5
+
+# SSIM constants for L=255
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+# Combined score weights: structural features matter more for faces
+HIST_WEIGHT = 0.4
+STRUCT_WEIGHT = 0.6
+
+# Thumbnail size for the coarse SSIM cascade stage
+COARSE_SSIM_SIZE = 32
+
+# Candidates scored per batched SSIM pass — bounds peak memory to
+# roughly MATCH_CHUNK_SIZE * SSIM_SIZE^2 * 4 bytes per temporary array
+MATCH_CHUNK_SIZE = 256
+
+# Compact descriptor: HSV histogram pooled to these bins + structural thumbnail
+DESCRIPTOR_HIST_BINS = (10, 12)
+DESCRIPTOR_THUMB_SIZE = 16
+
+# Galleries smaller than this are scanned exhaustively; larger ones are
+# shortlisted through the IVF index first
+ANN_MIN_GALLERY = 5000
+ANN_SHORTLIST = 300
+ANN_NPROBE = 16
+
+# Coarse cascade stage: "histogram", "ssim32" or "none", and how many
+# candidates survive it into the full-resolution SSIM stage
+CASCADE_MODES = ("none", "histogram", "ssim32")
+CASCADE_MODE = "histogram"
+CASCADE_KEEP = 100
+
+# How often a process checks the criminalDB folder for changes not yet
+# indexed (seconds); a newly published index is picked up on the next match
+GALLERY_CHECK_INTERVAL = 60
+
+# Entries kept by the per-process query caches: features are ~28 KB each,
+# ranked results well under 1 KB
+QUERY_FEATURE_CACHE_SIZE = 256
+MATCH_RESULT_CACHE_SIZE = 1024
+
+
+class _LRUCache:
+    """Thread-safe bounded LRU mapping with hit/miss counters."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value (marking it recently used), or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
 
-# Cache for pre-computed criminal DB data
-_criminal_cache: dict = {}
 
+# digest -> (hist, gray); (digest, index version, options) -> matches
+_feature_cache = _LRUCache(QUERY_FEATURE_CACHE_SIZE)
+_result_cache = _LRUCache(MATCH_RESULT_CACHE_SIZE)
 
-def _compute_face_histogram(image_path: str) -> Optional[np.ndarray]:
-    """Compute a normalized color histogram for a face image."""
-    img = cv2.imread(image_path)
-    if img is None:
-        return None
 
+def _compute_face_histogram(img: np.ndarray) -> np.ndarray:
+    """Compute a normalized color histogram for a decoded BGR face image."""
     # Resize to standard size for fair comparison
     img = cv2.resize(img, (256, 256))
 
@@ -34,87 +153,618 @@ def _compute_face_histogram(image_path: str) -> Optional[np.ndarray]:
     return hist
 
 
-def _load_grayscale_structural_image(image_path: str) -> Optional[np.ndarray]:
-    """Load grayscale image resized for structural similarity (SSIM)."""
-    img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        return None
+def _load_grayscale_structural_image(img: np.ndarray) -> np.ndarray:
+    """Grayscale copy of a decoded BGR image resized for structural similarity."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     # Resize to standard dimensions for fair SSIM comparison
-    img = cv2.resize(img, (128, 128))
-    return img
+    return cv2.resize(gray, (SSIM_SIZE, SSIM_SIZE))
+
+
+def _compute_features(
+    image_path: str,
+) -> tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    """
+    Decode an image once and compute its matching features.
+
+    Returns:
+        (histogram, gray_image), or (None, None) if the image can't be read
+    """
+    img = cv2.imread(image_path)
+    if img is None:
+        return None, None
+    return _compute_face_histogram(img), _load_grayscale_structural_image(img)
+
+
+def _query_features(
+    image_path: str,
+) -> tuple[Optional[str], Optional[np.ndarray], Optional[np.ndarray]]:
+    """
+    Features of a query image, served from the feature cache when its bytes
+    were seen before.
+
+    The file is read once: the bytes are hashed, then decoded in memory on a
+    cache miss. Cached arrays are read-only.
+
+    Returns:
+        (sha256 hex digest, histogram, gray_image), or (None, None, None)
+        if the image can't be read
+    """
+    try:
+        with open(image_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None, None, None
+
+    digest = hashlib.sha256(data).hexdigest()
+    cached = _feature_cache.get(digest)
+    if cached is not None:
+        return (digest,) + cached
+
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None, None, None
+
+    hist, gray = _compute_face_histogram(img), _load_grayscale_structural_image(img)
+    hist.setflags(write=False)
+    gray.setflags(write=False)
+    _feature_cache.put(digest, (hist, gray))
+    return digest, hist, gray
+
+
+@lru_cache(maxsize=None)
+def _gaussian_blur_matrix(size: int) -> np.ndarray:
+    """
+    Return the (size, size) matrix A such that A.T @ X @ A equals
+    cv2.GaussianBlur(X) with the SSIM window, including OpenCV's default
+    reflect-101 border handling.
+
+    Expressing the separable blur as two matrix products lets numpy blur a
+    whole stack of images with one batched matmul.
+    """
+    kernel = cv2.getGaussianKernel(SSIM_KERNEL_SIZE, SSIM_SIGMA, cv2.CV_32F)
+    identity = np.eye(size, dtype=np.float32)
+    # Filtering the rows of the identity yields the horizontal blur operator
+    blur = cv2.sepFilter2D(identity, -1, kernel, np.ones((1, 1), np.float32))
+    blur.setflags(write=False)
+    return blur
+
+
+def _batch_blur(stack: np.ndarray) -> np.ndarray:
+    """Gaussian-blur every image in a (..., H, W) float32 stack."""
+    blur = _gaussian_blur_matrix(stack.shape[-1])
+    return np.matmul(blur.T, np.matmul(stack, blur))
+
+
+def _ssim_statistics(gray_stack: np.ndarray) -> dict:
+    """
+    Precompute the query-independent SSIM terms for a stack of images.
+
+    Returns dict of float32 arrays shaped like gray_stack:
+    {mu, mu_sq, sigma_sq}
+    """
+    gray = gray_stack.astype(np.float32)
+    mu = _batch_blur(gray)
+    mu_sq = mu * mu
+    sigma_sq = _batch_blur(gray * gray) - mu_sq
+    return {"mu": mu, "mu_sq": mu_sq, "sigma_sq": sigma_sq}
+
+
+def _centered_histograms(hists: np.ndarray) -> np.ndarray:
+    """
+    Mean-center and L2-normalize flattened histograms so that a dot product
+    equals cv2.compareHist(..., cv2.HISTCMP_CORREL).
+    """
+    flat = hists.reshape(len(hists), -1).astype(np.float32)
+    flat = flat - flat.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(flat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(flat / norms)
+
+
+def _downsample(gray: np.ndarray, size: int) -> np.ndarray:
+    """Block-average a (N, SSIM_SIZE, SSIM_SIZE) stack to (N, size, size) float32."""
+    block = SSIM_SIZE // size
+    return (
+        np.asarray(gray, dtype=np.float32)
+        .reshape(len(gray), size, block, size, block)
+        .mean(axis=(2, 4))
+    )
+
+
+def _compute_descriptors(hist_centered: np.ndarray, gray: np.ndarray) -> np.ndarray:
+    """
+    Fixed-length unit descriptors for the ANN index.
 
+    Concatenates a pooled, re-centred HSV histogram and a mean-centred
+    DESCRIPTOR_THUMB_SIZE^2 structural thumbnail, each scaled by the square
+    root of its match weight, so a dot product between two descriptors is a
+    cheap proxy for the combined match score.
 
-def _compute_ssim(gray_a: np.ndarray, gray_b: np.ndarray) -> float:
-    """Compute SSIM score between two grayscale images using OpenCV + numpy."""
-    img1 = gray_a.astype(np.float32)
-    img2 = gray_b.astype(np.float32)
+    Returns (N, hist_bins + thumb_size^2) float32
+    """
+    count = len(hist_centered)
+    full_bins = (50, 60)
+    pool = (
+        full_bins[0] // DESCRIPTOR_HIST_BINS[0],
+        full_bins[1] // DESCRIPTOR_HIST_BINS[1],
+    )
+    hist = np.asarray(hist_centered, dtype=np.float32).reshape(
+        count, DESCRIPTOR_HIST_BINS[0], pool[0], DESCRIPTOR_HIST_BINS[1], pool[1]
+    )
+    hist = _centered_histograms(hist.sum(axis=(2, 4)))
+
+    thumbs = _centered_histograms(_downsample(gray, DESCRIPTOR_THUMB_SIZE))
+
+    total_weight = HIST_WEIGHT + STRUCT_WEIGHT
+    return np.ascontiguousarray(
+        np.concatenate(
+            [
+                np.sqrt(HIST_WEIGHT / total_weight) * hist,
+                np.sqrt(STRUCT_WEIGHT / total_weight) * thumbs,
+            ],
+            axis=1,
+        ),
+        dtype=np.float32,
+    )
 
-    # SSIM constants for L=255
-    c1 = (0.01 * 255) ** 2
-    c2 = (0.03 * 255) ** 2
 
-    kernel_size = (11, 11)
-    sigma = 1.5
+def _build_gallery(criminals: dict) -> dict:
+    """
+    Stack cached per-image features into contiguous arrays.
+
+    Returns dict:
+        ids, filenames: lists aligned with the array rows
+        hist_centered: (N, bins) float32, see _centered_histograms
+        gray: (N, SSIM_SIZE, SSIM_SIZE) uint8 thumbnails
+        mu, mu_sq, sigma_sq: (N, SSIM_SIZE, SSIM_SIZE) float32
+        coarse_gray, coarse_mu, coarse_mu_sq, coarse_sigma_sq:
+            the same at (N, COARSE_SSIM_SIZE, COARSE_SSIM_SIZE) float32
+        descriptor: (N, dim) float32, see _compute_descriptors
+
+    The IVF arrays over the descriptors are added by criminal_index.
+    """
+    ids = list(criminals.keys())
+    gallery = {
+        "ids": ids,
+        "filenames": [criminals[cid]["filename"] for cid in ids],
+    }
+    if not ids:
+        return gallery
+
+    gallery["hist_centered"] = _centered_histograms(
+        np.stack([criminals[cid]["histogram"] for cid in ids])
+    )
+    gallery["gray"] = np.stack([criminals[cid]["gray_image"] for cid in ids])
+    gallery.update(_ssim_statistics(gallery["gray"]))
+    gallery["coarse_gray"] = _downsample(gallery["gray"], COARSE_SSIM_SIZE)
+    gallery.update(
+        {
+            f"coarse_{name}": stat
+            for name, stat in _ssim_statistics(gallery["coarse_gray"]).items()
+        }
+    )
+    gallery["descriptor"] = _compute_descriptors(
+        gallery["hist_centered"], gallery["gray"]
+    )
+    return gallery
 
-    mu1 = cv2.GaussianBlur(img1, kernel_size, sigma)
-    mu2 = cv2.GaussianBlur(img2, kernel_size, sigma)
 
-    mu1_sq = mu1 * mu1
-    mu2_sq = mu2 * mu2
-    mu1_mu2 = mu1 * mu2
+def _load_gallery(criminal_db_path: str) -> dict:
+    """
+    Return the stacked feature gallery for the criminal DB (cached).
 
-    sigma1_sq = cv2.GaussianBlur(img1 * img1, kernel_size, sigma) - mu1_sq
-    sigma2_sq = cv2.GaussianBlur(img2 * img2, kernel_size, sigma) - mu2_sq
-    sigma12 = cv2.GaussianBlur(img1 * img2, kernel_size, sigma) - mu1_mu2
+    Memory-maps the persisted index when it is up to date, otherwise
+    syncs it first; workers that find it stale at the same time wait for a
+    single sync instead of each rebuilding it.
 
-    ssim_map = ((2 * mu1_mu2 + c1) * (2 * sigma12 + c2)) / (
-        (mu1_sq + mu2_sq + c1) * (sigma1_sq + sigma2_sq + c2)
+    The cached gallery is remapped as soon as another process publishes a
+    new index (one readlink per call), and every GALLERY_CHECK_INTERVAL once
+    the folder has changed since it was indexed.
+    """
+    global _gallery, _gallery_checked_at
+
+    from .criminal_index import (
+        index_is_stale,
+        load_or_build_index,
+        published_version,
     )
 
-    score = float(np.mean(ssim_map))
-    return max(0.0, min(1.0, score))
+    now = time.monotonic()
+    if _gallery and published_version(criminal_db_path) == _gallery["version"]:
+        if now - _gallery_checked_at < GALLERY_CHECK_INTERVAL:
+            return _gallery
+        if not index_is_stale(criminal_db_path):
+            _gallery_checked_at = now
+            return _gallery
+
+    _gallery = load_or_build_index(criminal_db_path)
+    _gallery_checked_at = now
+    return _gallery
+
 
+def _batch_hist_scores(
+    query_hist: np.ndarray, gallery: dict, rows: np.ndarray | None = None
+) -> np.ndarray:
+    """Histogram correlation of the query against gallery rows (default: all)."""
+    query = _centered_histograms(query_hist[np.newaxis])[0]
+    hists = gallery["hist_centered"] if rows is None else gallery["hist_centered"][rows]
+    return hists @ query
 
-def _load_criminal_db(criminal_db_path: str) -> dict:
+
+def _ssim_index(
+    query: dict, gray: np.ndarray, mu: np.ndarray, mu_sq: np.ndarray, sigma_sq: np.ndarray
+) -> np.ndarray:
     """
-    Load and cache criminal DB image data.
-    Returns dict of {criminal_id: {path, histogram, gray_image}}
+    Mean SSIM between query and gallery images given their precomputed terms.
+
+    query holds the query's {gray, mu, mu_sq, sigma_sq}; every array
+    broadcasts against the (..., H, W) gallery stacks. Only sigma12 depends
+    on both images, so it is the one term blurred here.
     """
-    global _criminal_cache
+    mu1_mu2 = query["mu"] * mu
+    sigma12 = _batch_blur(query["gray"] * gray) - mu1_mu2
 
-    if _criminal_cache:
-        return _criminal_cache
+    ssim_map = ((2 * mu1_mu2 + SSIM_C1) * (2 * sigma12 + SSIM_C2)) / (
+        (query["mu_sq"] + mu_sq + SSIM_C1) * (query["sigma_sq"] + sigma_sq + SSIM_C2)
+    )
+    return ssim_map.mean(axis=(-2, -1))
 
-    print(f"[FaceMatcher] Loading criminal DB from {criminal_db_path}...")
 
-    for filename in os.listdir(criminal_db_path):
-        if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
-            continue
+def _query_ssim_statistics(query_grays: np.ndarray) -> dict:
+    """SSIM terms for a (Q, H, W) stack of query images, plus their float pixels."""
+    queries = _ssim_statistics(query_grays)
+    queries["gray"] = query_grays.astype(np.float32)
+    return queries
 
-        criminal_id = os.path.splitext(filename)[0]
-        filepath = os.path.join(criminal_db_path, filename)
 
-        hist = _compute_face_histogram(filepath)
-        gray_image = _load_grayscale_structural_image(filepath)
+def _batch_ssim_scores(
+    query_gray: np.ndarray,
+    gallery: dict,
+    rows: np.ndarray | None = None,
+    prefix: str = "",
+) -> np.ndarray:
+    """
+    SSIM of the query against gallery rows (default: all).
 
-        if hist is not None and gray_image is not None:
-            _criminal_cache[criminal_id] = {
-                "path": filepath,
-                "filename": filename,
-                "histogram": hist,
-                "gray_image": gray_image,
-            }
+    prefix selects the gallery arrays: "" for full resolution, "coarse_"
+    for COARSE_SSIM_SIZE thumbnails (query_gray must match that size).
+    """
+    query = {
+        name: value[0]
+        for name, value in _query_ssim_statistics(query_gray[np.newaxis]).items()
+    }
+
+    total = len(gallery["ids"]) if rows is None else len(rows)
+    scores = np.empty(total, dtype=np.float32)
+
+    for start in range(0, total, MATCH_CHUNK_SIZE):
+        chunk = slice(start, start + MATCH_CHUNK_SIZE)
+        select = chunk if rows is None else rows[chunk]
+        scores[chunk] = _ssim_index(
+            query,
+            gallery[f"{prefix}gray"][select],
+            gallery[f"{prefix}mu"][select],
+            gallery[f"{prefix}mu_sq"][select],
+            gallery[f"{prefix}sigma_sq"][select],
+        )
 
-    print(f"[FaceMatcher] Loaded {len(_criminal_cache)} criminal images")
-    return _criminal_cache
+    return np.clip(scores, 0.0, 1.0)
 
 
-def match_face(
+def _shared_ssim_scores(
+    query_grays: np.ndarray, gallery: dict, prefix: str = ""
+) -> np.ndarray:
+    """
+    SSIM of a (Q, H, W) stack of queries against every gallery row.
+
+    Each gallery chunk is read once and scored against all queries with one
+    broadcast (Q, chunk, H, W) blur; chunks shrink with Q so peak memory
+    matches _batch_ssim_scores. prefix is as for _batch_ssim_scores.
+
+    Returns (Q, N) float32
+    """
+    queries = {
+        name: value[:, np.newaxis]
+        for name, value in _query_ssim_statistics(query_grays).items()
+    }
+
+    total = len(gallery["ids"])
+    scores = np.empty((len(query_grays), total), dtype=np.float32)
+    step = max(1, MATCH_CHUNK_SIZE // len(query_grays))
+
+    for start in range(0, total, step):
+        chunk = slice(start, start + step)
+        scores[:, chunk] = _ssim_index(
+            queries,
+            gallery[f"{prefix}gray"][chunk],
+            gallery[f"{prefix}mu"][chunk],
+            gallery[f"{prefix}mu_sq"][chunk],
+            gallery[f"{prefix}sigma_sq"][chunk],
+        )
+
+    return np.clip(scores, 0.0, 1.0)
+
+
+def _ann_shortlist(
+    query_hist: np.ndarray,
+    query_gray: np.ndarray,
+    gallery: dict,
+    shortlist: int,
+    nprobe: int,
+) -> np.ndarray | None:
+    """
+    Candidate rows from the IVF index, sorted by row for locality.
+
+    Returns None when the gallery should be scanned exhaustively instead:
+    it is small, the shortlist would cover it anyway, or it has no IVF index.
+    """
+    total = len(gallery["ids"])
+    if total < ANN_MIN_GALLERY or shortlist >= total or "ivf_centroids" not in gallery:
+        return None
+
+    query = _compute_descriptors(
+        _centered_histograms(query_hist[np.newaxis]), query_gray[np.newaxis]
+    )[0]
+    rows = search_ivf(
+        query,
+        gallery["descriptor"],
+        gallery["ivf_centroids"],
+        gallery["ivf_order"],
+        gallery["ivf_offsets"],
+        k=shortlist,
+        nprobe=nprobe,
+    )
+    return np.sort(rows)
+
+
+def _list_criminal_images(criminal_db_path: str) -> list[str]:
+    """Sorted image filenames in the criminal DB folder."""
+    return sorted(
+        filename
+        for filename in os.listdir(criminal_db_path)
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def _combine_scores(hist_scores: np.ndarray, struct_scores: np.ndarray) -> np.ndarray:
+    """Combined score: weight structural features more for face matching."""
+    return HIST_WEIGHT * np.maximum(hist_scores, 0) + STRUCT_WEIGHT * np.maximum(
+        struct_scores, 0
+    )
+
+
+def _top_rows(scores: np.ndarray, keep: int) -> np.ndarray:
+    """Positions of the `keep` highest scores, in ascending position order."""
+    if keep >= len(scores):
+        return np.arange(len(scores))
+    return np.sort(np.argpartition(-scores, keep - 1)[:keep])
+
+
+def _record_stage(
+    stages: list[dict], stage: str, candidates: int, kept: int, started: float
+):
+    """Append a cascade stage's candidate counts and elapsed time to stages."""
+    stages.append(
+        {
+            "stage": stage,
+            "candidates": candidates,
+            "kept": kept,
+            "pruned": candidates - kept,
+            "ms": round((time.time() - started) * 1000, 1),
+        }
+    )
+
+
+def _match_features(
+    query_hist: np.ndarray,
+    query_gray: np.ndarray,
+    gallery: dict,
+    top_k: int,
+    shortlist: int,
+    nprobe: int,
+    cascade: str,
+    cascade_keep: int,
+) -> tuple[list[dict], list[dict]]:
+    """
+    Run the matching cascade for precomputed query features.
+
+    Returns:
+        (matches, stages), see match_face_with_stats()
+    """
+    stages = []
+    record = partial(_record_stage, stages)
+
+    # Stage 1: shortlist candidates from the ANN index (None = every row)
+    started = time.time()
+    rows = _ann_shortlist(query_hist, query_gray, gallery, shortlist, nprobe)
+    if rows is not None:
+        record("ann", len(gallery["ids"]), len(rows), started)
+
+    # Histogram comparison (color similarity) — correlation method
+    hist_scores = _batch_hist_scores(query_hist, gallery, rows)
+
+    # Stage 2: prune with a cheap coarse score
+    keep = max(cascade_keep, top_k)
+    if cascade != "none" and len(hist_scores) > keep:
+        started = time.time()
+        coarse_scores = hist_scores
+        if cascade == "ssim32":
+            coarse_query = _downsample(query_gray[np.newaxis], COARSE_SSIM_SIZE)[0]
+            coarse_scores = _combine_scores(
+                hist_scores,
+                _batch_ssim_scores(coarse_query, gallery, rows, prefix="coarse_"),
+            )
+        survivors = _top_rows(coarse_scores, keep)
+        rows = survivors if rows is None else rows[survivors]
+        hist_scores = hist_scores[survivors]
+        record(cascade, len(coarse_scores), len(rows), started)
+
+    # Stage 3: structural similarity via full-resolution SSIM
+    started = time.time()
+    struct_scores = _batch_ssim_scores(query_gray, gallery, rows)
+    combined = _combine_scores(hist_scores, struct_scores)
+
+    matches = _ranked_matches(gallery, rows, combined, top_k)
+    record("ssim", len(combined), len(matches), started)
+    return matches, stages
+
+
+def _match_features_batch(
+    query_hists: np.ndarray,
+    query_grays: np.ndarray,
+    gallery: dict,
+    top_k: int,
+    shortlist: int,
+    nprobe: int,
+    cascade: str,
+    cascade_keep: int,
+) -> tuple[list[list[dict]], list[dict]]:
+    """
+    Run the matching cascade for a stack of queries at once.
+
+    Gives the same rankings as calling _match_features() per query. While
+    every query still has the whole gallery as candidates, each stage reads
+    the gallery once for the batch: histogram scores are a single
+    (N, D) @ (D, Q) product and SSIM goes through _shared_ssim_scores().
+    Once the ANN or coarse stage has given each query its own candidates,
+    those are scored per query.
+
+    Returns:
+        (results, stages): one match list per query, and stage counts
+        summed over the batch
+    """
+    stages = []
+    record = partial(_record_stage, stages)
+    count, total = len(query_hists), len(gallery["ids"])
+
+    # Stage 1: per-query ANN shortlists (None = every row)
+    started = time.time()
+    candidates = [
+        _ann_shortlist(query_hists[q], query_grays[q], gallery, shortlist, nprobe)
+        for q in range(count)
+    ]
+    shared = candidates[0] is None
+    centered = _centered_histograms(query_hists)
+    if shared:
+        hist_scores = list((gallery["hist_centered"] @ centered.T).T)
+    else:
+        record("ann", total * count, sum(len(rows) for rows in candidates), started)
+        hist_scores = [
+            gallery["hist_centered"][rows] @ centered[q]
+            for q, rows in enumerate(candidates)
+        ]
+
+    def ssim_scores(grays, prefix=""):
+        if shared:
+            return list(_shared_ssim_scores(grays, gallery, prefix))
+        return [
+            _batch_ssim_scores(grays[q], gallery, candidates[q], prefix)
+            for q in range(count)
+        ]
+
+    # Stage 2: prune with a cheap coarse score
+    keep = max(cascade_keep, top_k)
+    if cascade != "none" and any(len(scores) > keep for scores in hist_scores):
+        started = time.time()
+        before = sum(len(scores) for scores in hist_scores)
+        coarse_scores = hist_scores
+        if cascade == "ssim32":
+            coarse_scores = [
+                _combine_scores(hist, struct)
+                for hist, struct in zip(
+                    hist_scores,
+                    ssim_scores(
+                        _downsample(query_grays, COARSE_SSIM_SIZE), prefix="coarse_"
+                    ),
+                )
+            ]
+        for q in range(count):
+            survivors = _top_rows(coarse_scores[q], keep)
+            candidates[q] = survivors if shared else candidates[q][survivors]
+            hist_scores[q] = hist_scores[q][survivors]
+        shared = False
+        record(cascade, before, sum(len(rows) for rows in candidates), started)
+
+    # Stage 3: structural similarity via full-resolution SSIM
+    started = time.time()
+    struct_scores = ssim_scores(query_grays)
+    results = [
+        _ranked_matches(
+            gallery,
+            candidates[q],
+            _combine_scores(hist_scores[q], struct_scores[q]),
+            top_k,
+        )
+        for q in range(count)
+    ]
+    record(
+        "ssim",
+        sum(len(scores) for scores in hist_scores),
+        sum(len(matches) for matches in results),
+        started,
+    )
+    return results, stages
+
+
+def _ranked_matches(
+    gallery: dict, rows: np.ndarray | None, scores: np.ndarray, top_k: int
+) -> list[dict]:
+    """
+    Top-k matches for scores over gallery rows (None = every row).
+
+    Stable sort by similarity descending, so ties keep DB order.
+    """
+    ranked = np.argsort(-scores, kind="stable")[:top_k]
+    gallery_rows = ranked if rows is None else rows[ranked]
+    return [
+        {
+            "criminal_id": str(gallery["ids"][row]),
+            "filename": str(gallery["filenames"][row]),
+            "similarity": float(scores[i]),
+        }
+        for i, row in zip(ranked, gallery_rows)
+    ]
+
+
+def _slice_gallery(gallery: dict, start: int, stop: int) -> dict:
+    """
+    Zero-copy view of gallery rows [start, stop).
+
+    Memmap slices keep reading the shared index pages. The IVF arrays index
+    the whole gallery, so they are left out and the slice is scanned
+    exhaustively.
+    """
+    shard = {
+        "ids": gallery["ids"][start:stop],
+        "filenames": gallery["filenames"][start:stop],
+    }
+    for name, value in gallery.items():
+        if isinstance(value, np.ndarray) and not name.startswith("ivf_"):
+            shard[name] = value[start:stop]
+    return shard
+
+
+def _result_key(digest: str, gallery: dict, options: dict) -> tuple:
+    """Result cache key: query content, gallery index version and options."""
+    return (digest, gallery.get("version")) + tuple(sorted(options.items()))
+
+
+def _copy_matches(matches: list[dict]) -> list[dict]:
+    """Copy match dicts so callers can annotate them without touching the cache."""
+    return [dict(match) for match in matches]
+
+
+def match_face_with_stats(
     query_image_path: str,
     criminal_db_path: str,
     top_k: int = 10,
-) -> list[dict]:
+    shortlist: int = ANN_SHORTLIST,
+    nprobe: int = ANN_NPROBE,
+    cascade: str = CASCADE_MODE,
+    cascade_keep: int = CASCADE_KEEP,
+    shards: int = 0,
+) -> tuple[list[dict], dict]:
     """
     Match a query face image against the criminal database.
 
@@ -122,53 +772,241 @@ def match_face(
         query_image_path: Path to the generated/colorized face image
         criminal_db_path: Path to the criminalDB folder
         top_k: Number of top matches to return
+        shortlist: Candidates taken from the ANN index for exact re-ranking
+            (galleries under ANN_MIN_GALLERY are always scanned exhaustively)
+        nprobe: Minimum number of IVF clusters probed per query
+        cascade: Coarse stage — "histogram", "ssim32" or "none"
+        cascade_keep: Candidates surviving the coarse stage (at least top_k)
+        shards: Split the gallery across this many long-lived worker
+            processes (see match_shards); 0 or 1 matches in-process
 
     Returns:
-        List of dicts: [{criminal_id, filename, similarity}, ...]
-        sorted by similarity (highest first)
+        (matches, stats) where matches is a list of dicts
+        [{criminal_id, filename, similarity}, ...] sorted by similarity
+        (highest first) and stats is
+        {gallery_size, cached, stages: [{stage, candidates, kept, pruned, ms}, ...]}
+        (stages is empty when the result came from the result cache)
     """
-    # Compute query features
-    query_hist = _compute_face_histogram(query_image_path)
-    query_gray = _load_grayscale_structural_image(query_image_path)
+    if cascade not in CASCADE_MODES:
+        raise ValueError(f"Unknown cascade mode {cascade!r}, expected {CASCADE_MODES}")
+
+    stats = {"gallery_size": 0, "stages": [], "cached": False}
+
+    # Compute query features (cached by image content)
+    digest, query_hist, query_gray = _query_features(query_image_path)
 
     if query_hist is None or query_gray is None:
         print(f"[FaceMatcher] Could not process query image: {query_image_path}")
-        return []
+        return [], stats
+
+    # Load criminal DB as stacked feature arrays
+    gallery = _load_gallery(criminal_db_path)
+    stats["gallery_size"] = len(gallery["ids"])
+
+    if not len(gallery["ids"]):
+        print(f"[FaceMatcher] No criminal images found in {criminal_db_path}")
+        return [], stats
+
+    options = {
+        "top_k": top_k,
+        "shortlist": shortlist,
+        "nprobe": nprobe,
+        "cascade": cascade,
+        "cascade_keep": cascade_keep,
+    }
+    key = _result_key(digest, gallery, options)
+    cached = _result_cache.get(key)
+    if cached is not None:
+        stats["cached"] = True
+        return _copy_matches(cached), stats
+
+    matches = None
+    if shards > 1:
+        from .match_shards import get_shard_pool
+
+        try:
+            matches, stats["stages"] = get_shard_pool(criminal_db_path, shards).match(
+                query_hist, query_gray, gallery["version"], **options
+            )
+            stats["shards"] = shards
+        except RuntimeError as e:
+            print(f"[FaceMatcher] Shard matching failed ({e}), matching in-process")
+
+    if matches is None:
+        matches, stats["stages"] = _match_features(
+            query_hist, query_gray, gallery, **options
+        )
+    _result_cache.put(key, _copy_matches(matches))
+    return matches, stats
+
+
+def match_face(
+    query_image_path: str,
+    criminal_db_path: str,
+    top_k: int = 10,
+    **options,
+) -> list[dict]:
+    """
+    Match a query face image against the criminal database.
+
+    Takes the same options as match_face_with_stats().
+
+    Returns:
+        List of dicts: [{criminal_id, filename, similarity}, ...]
+        sorted by similarity (highest first)
+    """
+    matches, _ = match_face_with_stats(
+        query_image_path, criminal_db_path, top_k, **options
+    )
+    return matches
+
 
-    # Load criminal DB
-    criminals = _load_criminal_db(criminal_db_path)
+def match_faces_batch_with_stats(
+    query_image_paths: list[str],
+    criminal_db_path: str,
+    top_k: int = 10,
+    shortlist: int = ANN_SHORTLIST,
+    nprobe: int = ANN_NPROBE,
+    cascade: str = CASCADE_MODE,
+    cascade_keep: int = CASCADE_KEEP,
+) -> tuple[list[list[dict]], dict]:
+    """
+    Match several query face images against the criminal database at once.
 
-    if not criminals:
+    Each query gets the same top-k it would get from match_face_with_stats(),
+    but the gallery is scored for the whole batch together (see
+    _match_features_batch). Batches run in-process, not on the shard pool.
+
+    Args:
+        query_image_paths: Paths to the query images
+        criminal_db_path: Path to the criminalDB folder
+        top_k, shortlist, nprobe, cascade, cascade_keep:
+            As for match_face_with_stats()
+
+    Returns:
+        (results, stats) where results has one match list per query path, in
+        order (empty for unreadable images), and stats is
+        {gallery_size, queries, unreadable, cached, stages} where cached
+        counts queries answered from the result cache
+    """
+    if cascade not in CASCADE_MODES:
+        raise ValueError(f"Unknown cascade mode {cascade!r}, expected {CASCADE_MODES}")
+
+    results = [[] for _ in query_image_paths]
+    stats = {
+        "gallery_size": 0,
+        "queries": len(query_image_paths),
+        "cached": 0,
+        "stages": [],
+    }
+
+    features = {}
+    for i, path in enumerate(query_image_paths):
+        digest, query_hist, query_gray = _query_features(path)
+        if query_hist is None or query_gray is None:
+            print(f"[FaceMatcher] Could not process query image: {path}")
+            continue
+        features[i] = (digest, query_hist, query_gray)
+    stats["unreadable"] = len(query_image_paths) - len(features)
+
+    if not features:
+        return results, stats
+
+    gallery = _load_gallery(criminal_db_path)
+    stats["gallery_size"] = len(gallery["ids"])
+
+    if not len(gallery["ids"]):
         print(f"[FaceMatcher] No criminal images found in {criminal_db_path}")
-        return []
+        return results, stats
+
+    options = {
+        "top_k": top_k,
+        "shortlist": shortlist,
+        "nprobe": nprobe,
+        "cascade": cascade,
+        "cascade_keep": cascade_keep,
+    }
+    pending = {}
+    for i, (digest, query_hist, query_gray) in features.items():
+        cached = _result_cache.get(_result_key(digest, gallery, options))
+        if cached is not None:
+            results[i] = _copy_matches(cached)
+        else:
+            pending[i] = (digest, query_hist, query_gray)
+    stats["cached"] = len(features) - len(pending)
+
+    if not pending:
+        return results, stats
+
+    batch, stats["stages"] = _match_features_batch(
+        np.stack([hist for _, hist, _ in pending.values()]),
+        np.stack([gray for _, _, gray in pending.values()]),
+        gallery,
+        **options,
+    )
+    for (i, (digest, _, _)), matches in zip(pending.items(), batch):
+        _result_cache.put(_result_key(digest, gallery, options), _copy_matches(matches))
+        results[i] = matches
+    return results, stats
 
-    scores = []
 
-    for criminal_id, data in criminals.items():
-        # Histogram comparison (color similarity) — correlation method
-        hist_score = cv2.compareHist(query_hist, data["histogram"], cv2.HISTCMP_CORREL)
+def match_faces_batch(
+    query_image_paths: list[str],
+    criminal_db_path: str,
+    top_k: int = 10,
+    **options,
+) -> list[list[dict]]:
+    """
+    Match several query face images against the criminal database at once.
 
-        # Structural similarity via SSIM on grayscale images
-        struct_score = _compute_ssim(query_gray, data["gray_image"])
+    Takes the same options as match_faces_batch_with_stats().
+
+    Returns:
+        One list of [{criminal_id, filename, similarity}, ...] per query path
+    """
+    results, _ = match_faces_batch_with_stats(
+        query_image_paths, criminal_db_path, top_k, **options
+    )
+    return results
 
-        # Combined score: weight structural features more for face matching
-        combined = 0.4 * max(hist_score, 0) + 0.6 * max(struct_score, 0)
 
-        scores.append(
-            {
-                "criminal_id": criminal_id,
-                "filename": data["filename"],
-                "similarity": float(combined),
-            }
-        )
+def refresh_cache(criminal_db_path: str) -> dict:
+    """
+    Incrementally re-index the criminal DB and remap it in this process.
 
-    # Sort by similarity descending
-    scores.sort(key=lambda x: x["similarity"], reverse=True)
+    Only images added or modified since the last index are decoded; entries
+    for deleted files are dropped.
 
-    return scores[:top_k]
+    Returns:
+        Dict of {added, modified, removed, unchanged} filename lists
+    """
+    global _gallery, _gallery_checked_at
+
+    from .criminal_index import sync_index
+
+    _gallery, summary = sync_index(criminal_db_path)
+    _gallery_checked_at = time.monotonic()
+    return summary
+
+
+def cache_info() -> dict:
+    """
+    Hit/miss counters and sizes of this process's query caches.
+
+    Returns:
+        {"features": {hits, misses, size, maxsize}, "results": {...}}
+    """
+    return {"features": _feature_cache.info(), "results": _result_cache.info()}
 
 
 def clear_cache():
-    """Clear the criminal DB cache (useful if DB images change)."""
-    global _criminal_cache
-    _criminal_cache = {}
+    """
+    Drop this process's mapping of the criminal DB index and its query caches.
+
+    The next match re-opens the persisted index, syncing it first if the
+    criminalDB folder changed since it was written.
+    """
+    global _gallery
+    _gallery = {}
+    _feature_cache.clear()
+    _result_cache.clear()
@@ -0,0 +1,193 @@
+"""
+Generation Result Cache
+Content-addressed on-disk cache of BFL results, so re-submitting the same
+feature selection with the same seed (training sessions, demos) reuses the
+earlier image instead of paying for another BFL round trip. Requests
+without a seed are not cached: repeating one asks for a new image.
+
+A result is keyed by everything that determines the request: model, prompt,
+SHA-256 of the input image (Kontext), output dimensions and seed. Images are
+stored as <GENERATION_CACHE_DIR>/<key[:2]>/<key>.png. A file's mtime records
+its last use; once the cache grows past GENERATION_CACHE_MAX_MB the least
+recently used files are evicted.
+
+Stores keep a running estimate of the cache size instead of walking the
+directory each time. The directory is only scanned, and evicted down to the
+limit, once the estimate passes it, or every RESCAN_INTERVAL seconds to
+account for entries other processes stored.
+
+Opt-in: the cache is off unless GENERATION_CACHE_DIR is set. Used by jobs,
+which still records a normal GenerationVersion for a cached result.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+# Longest a process goes without rescanning the cache directory (seconds)
+RESCAN_INTERVAL = 300
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+# Estimated cache size in bytes (None until first scanned), and when it was
+# last scanned (time.monotonic())
+_size = None
+_scanned_at = 0.0
+
+
+def enabled() -> bool:
+    return bool(settings.GENERATION_CACHE_DIR)
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(
+    model: str,
+    prompt: str,
+    input_path: str | None = None,
+    width: int | None = None,
+    height: int | None = None,
+    seed: int | None = None,
+) -> str:
+    """
+    Key of a generation request.
+
+    Args:
+        model: BFL model name
+        prompt: Full prompt sent to BFL
+        input_path: Source image of an image-to-image request (hashed by content)
+        width, height: Requested output size, if any
+        seed: Requested seed, if any
+
+    Returns:
+        Hex SHA-256 of the request description
+    """
+    request = {
+        "model": model,
+        "prompt": prompt,
+        "input": _file_digest(input_path) if input_path else None,
+        "width": width,
+        "height": height,
+        "seed": seed,
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(settings.GENERATION_CACHE_DIR, key[:2], f"{key}.png")
+
+
+def fetch(key: str, output_path: str) -> bool:
+    """Copy the cached image for `key` to output_path; False on a miss."""
+    entry = _entry_path(key)
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        shutil.copyfile(entry, output_path)
+        os.utime(entry)
+    except FileNotFoundError:
+        with _lock:
+            _stats["misses"] += 1
+        return False
+
+    with _lock:
+        _stats["hits"] += 1
+    print(f"[GenCache] Hit {key[:12]} -> {output_path}")
+    return True
+
+
+def store(key: str, image_path: str):
+    """Add a generated image to the cache, evicting down to the size limit if due."""
+    global _size
+
+    entry = _entry_path(key)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+    # Copy under a temporary name so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry), suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(image_path, tmp_path)
+        os.replace(tmp_path, entry)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    size = os.path.getsize(entry)
+    limit = settings.GENERATION_CACHE_MAX_MB * 1024 * 1024
+    with _lock:
+        _stats["stores"] += 1
+        if _size is not None:
+            _size += size
+        due = (
+            _size is None
+            or _size > limit
+            or time.monotonic() - _scanned_at >= RESCAN_INTERVAL
+        )
+    print(f"[GenCache] Stored {key[:12]} ({size / 1024:.0f} KB)")
+    if due:
+        _evict()
+
+
+def _evict():
+    """
+    Scan the cache directory and remove least recently used entries while it
+    exceeds its limit.
+    """
+    global _size, _scanned_at
+
+    limit = settings.GENERATION_CACHE_MAX_MB * 1024 * 1024
+    entries = []
+    total = 0
+    for root, _, files in os.walk(settings.GENERATION_CACHE_DIR):
+        for name in files:
+            if not name.endswith(".png"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    if total <= limit:
+        with _lock:
+            _size, _scanned_at = total, time.monotonic()
+        return
+
+    entries.sort()
+    evicted = 0
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+
+    with _lock:
+        _stats["evictions"] += evicted
+        _size, _scanned_at = total, time.monotonic()
+    print(f"[GenCache] Evicted {evicted} entries ({total / 1024 / 1024:.1f} MB left)")
+
+
+def cache_info() -> dict:
+    """Hit/miss/store/eviction counts for this process."""
+    with _lock:
+        return dict(_stats)
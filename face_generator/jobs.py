@@ -0,0 +1,788 @@
+"""
+Background Generation Jobs
+Runs BFL generations (sketch, revision, colorization) off the request thread.
+
+The generate/revise/colorize views capture their inputs in a GenerationJob
+row and return 202 with the job id straight away; a per-process pool of
+GENERATION_WORKERS threads makes the slow BFL calls, so a burst of
+generations can no longer tie up every web worker. Clients follow a job
+through GET /api/jobs/<id>/, which reports status and the latest BFL poll
+status as progress.
+
+Under ASGI (criminal_face_app.asgi) jobs instead run as tasks on the
+server's event loop through bfl_async, so waiting on BFL holds no thread at
+all and one process can drive hundreds of generations at once.
+
+A worker claims a job with a conditional UPDATE (queued -> running), so a
+job runs once even if it is submitted twice — e.g. when a process starting
+its pool picks up jobs that were still queued when another process exited.
+Jobs left running by a process that died are failed once they have run for
+STALE_JOB_TIMEOUT seconds, when a process starts its runner or when a
+client polls them.
+
+With BFL_WEBHOOK_BASE_URL set, a worker only submits the generation, with a
+callback URL carrying a per-job token, and moves on. BFL POSTs the outcome
+to GenerationJobViewSet.bfl_webhook, which hands it to complete_job() to
+download the image and record the version. A sweeper thread polls jobs whose
+notification hasn't arrived after BFL_WEBHOOK_SWEEP_INTERVAL seconds, so a
+lost webhook only delays a job. Whichever of the two gets there first clears
+the token, which makes completion run once. The webhook may land on another
+process than the one that submitted the job and holds its scheduler slot, so
+that process's sweeper thread also gives back slots of jobs it sees
+completed, every SLOT_CHECK_INTERVAL seconds.
+"""
+
+import asyncio
+import hmac
+import os
+import secrets
+import threading
+import time
+import traceback
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.urls import reverse
+from django.utils import timezone
+
+from . import bfl_async, bfl_flux, bfl_scheduler, generation_cache
+from .models import FaceComposition, GenerationJob, GenerationVersion
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Set when served through criminal_face_app.asgi (see attach_event_loop)
+_event_loop = None
+
+# Webhook jobs still waiting after this long are failed by the sweeper (seconds)
+WEBHOOK_JOB_TIMEOUT = 600
+
+_sweeper = None
+
+# How often the sweeper thread looks for completed webhook jobs still holding
+# one of this process's scheduler slots (seconds)
+SLOT_CHECK_INTERVAL = 2
+
+# Jobs running this long without waiting on a webhook are taken to have lost
+# their process (seconds)
+STALE_JOB_TIMEOUT = 1800
+
+# Delays before retrying a claim that hit a database error (seconds); the
+# job is failed once these run out
+CLAIM_RETRY_DELAYS = (1, 5, 30)
+
+# Scheduler lane per job kind (see bfl_scheduler): operators sit waiting on
+# sketches and revisions, colorizations can queue behind them
+JOB_LANES = {"sketch": "interactive", "revision": "interactive", "colorize": "batch"}
+
+
+def _next_version(composition) -> int:
+    """
+    Allocate the composition's next version number.
+
+    Increments FaceComposition.last_version_number in the database; the
+    UPDATE locks the row until the caller's transaction ends, so concurrent
+    allocations queue up rather than reading the same maximum. Must run
+    inside the transaction that saves the version, which keeps numbers
+    gapless if that save fails.
+    """
+    compositions = FaceComposition.objects.filter(pk=composition.pk)
+    compositions.update(last_version_number=F("last_version_number") + 1)
+    return compositions.values_list("last_version_number", flat=True).get()
+
+
+def save_version(composition, image_path, image_type, prompt_used, parent=None):
+    """Create a GenerationVersion record for an image under MEDIA_ROOT"""
+    ver = GenerationVersion(
+        composition=composition,
+        image_type=image_type,
+        prompt_used=prompt_used,
+        parent_version=parent,
+    )
+    rel_path = os.path.relpath(image_path, settings.MEDIA_ROOT)
+    ver.image.name = rel_path
+    with transaction.atomic():
+        ver.version_number = _next_version(composition)
+        ver.save()
+    return ver
+
+
+def _parent_version(composition, params):
+    """The version a job builds on, if it still exists"""
+    parent_id = params.get("parent_version_id")
+    if not parent_id:
+        return None
+    return GenerationVersion.objects.filter(
+        id=parent_id, composition=composition
+    ).first()
+
+
+def _finish_sketch(composition, params):
+    composition.sketch_image = os.path.relpath(params["output_path"], settings.MEDIA_ROOT)
+    composition.save(update_fields=["sketch_image"])
+
+    prompt_used = params["features_description"]
+    if params.get("seed") is not None:
+        prompt_used = f"[seed {params['seed']}] {prompt_used}"
+    return save_version(composition, params["output_path"], "sketch", prompt_used)
+
+
+def _finish_revision(composition, params):
+    composition.sketch_image = os.path.relpath(params["output_path"], settings.MEDIA_ROOT)
+    composition.save(update_fields=["sketch_image"])
+
+    return save_version(
+        composition,
+        params["output_path"],
+        "revision",
+        params["prompt"],
+        parent=_parent_version(composition, params),
+    )
+
+
+def _finish_colorize(composition, params):
+    composition.final_image = os.path.relpath(params["output_path"], settings.MEDIA_ROOT)
+    composition.save(update_fields=["final_image"])
+
+    return save_version(
+        composition,
+        params["output_path"],
+        "colorized",
+        f"[colorize] {params['features_description']}",
+        parent=_parent_version(composition, params),
+    )
+
+
+def _generation_call(job) -> tuple[str, dict]:
+    """Name of the bfl_flux / bfl_async function a job calls, and its arguments"""
+    params = job.params
+    if job.kind == "sketch":
+        return "generate_sketch", {
+            "features_description": params["features_description"],
+            "output_path": params["output_path"],
+            "user_prompt": params["user_prompt"],
+            "reference_image_path": params["reference_image_path"],
+            "seed": params.get("seed"),
+        }
+    if job.kind == "revision":
+        return "revise_sketch", {
+            "edit_instruction": params["prompt"],
+            "init_image_path": params["init_image_path"],
+            "output_path": params["output_path"],
+            "conversation_history": params["conversation_history"],
+        }
+    return "colorize_sketch", {
+        "features_description": params["features_description"],
+        "sketch_path": params["sketch_path"],
+        "output_path": params["output_path"],
+    }
+
+
+_FINISHERS = {
+    "sketch": _finish_sketch,
+    "revision": _finish_revision,
+    "colorize": _finish_colorize,
+}
+
+
+class _ClaimFailed(Exception):
+    """A database error while claiming a job (see CLAIM_RETRY_DELAYS)"""
+
+
+def _queued_job(job_id: int):
+    """The job if it is still queued, else None"""
+    return (
+        GenerationJob.objects.select_related("composition")
+        .filter(id=job_id, status="queued")
+        .first()
+    )
+
+
+def _claim_job(job_id: int) -> bool:
+    """Mark a queued job as running; False if another worker already claimed it"""
+    claimed = GenerationJob.objects.filter(id=job_id, status="queued").update(
+        status="running", started_at=timezone.now(), progress="Starting"
+    )
+    if claimed:
+        print(f"[Jobs] Running job {job_id}")
+    return bool(claimed)
+
+
+def _claim(job) -> bool:
+    """
+    _claim_job() for a job about to run, giving back its BFL slot if it
+    isn't claimed.
+
+    Raises _ClaimFailed on a database error.
+    """
+    try:
+        claimed = _claim_job(job.id)
+    except Exception as e:
+        bfl_scheduler.release(job.id)
+        raise _ClaimFailed(str(e)) from e
+    if not claimed:
+        bfl_scheduler.release(job.id)
+    return claimed
+
+
+def _slot_granted(job, claimed: bool) -> bool:
+    """
+    Claim a job once the scheduler grants it its first slot, or restart its
+    stale clock (started_at) after a later one.
+
+    Jobs stay queued while they wait for a slot, which may take longer than
+    STALE_JOB_TIMEOUT when BFL is busy. Returns False if another worker
+    claimed the job first.
+    """
+    if not claimed:
+        return _claim(job)
+    GenerationJob.objects.filter(id=job.id).update(started_at=timezone.now())
+    return True
+
+
+def _set_progress(job_id: int, message: str):
+    GenerationJob.objects.filter(id=job_id).update(progress=message[:200])
+
+
+def _finish_job(job):
+    """
+    Record the generated image on the composition and mark the job done.
+
+    Records nothing if the job is no longer running, e.g. because
+    fail_stale_jobs or the webhook sweeper gave up on it meanwhile.
+    """
+    bfl_scheduler.release(job.id)
+    with transaction.atomic():
+        finished = GenerationJob.objects.filter(id=job.id, status="running").update(
+            status="succeeded", progress="", finished_at=timezone.now()
+        )
+        if not finished:
+            print(f"[Jobs] Job {job.id} already ended, discarding its result")
+            return
+        version = _FINISHERS[job.kind](job.composition, job.params)
+        GenerationJob.objects.filter(id=job.id).update(version=version)
+    print(f"[Jobs] Job {job.id} finished: v{version.version_number}")
+
+
+def _describe(job) -> dict:
+    """The BFL request a job makes (see bfl_flux.describe_generation)"""
+    name, kwargs = _generation_call(job)
+    return bfl_flux.describe_generation(name, kwargs)
+
+
+def _cache_key(job) -> str:
+    """
+    Result cache key of a job's BFL request (see generation_cache).
+
+    Worked out once per job, since it hashes the source image, and kept in
+    the job's params for storing the result later.
+    """
+    key = job.params.get("cache_key")
+    if key is None:
+        key = generation_cache.cache_key(**_describe(job))
+        job.params["cache_key"] = key
+        GenerationJob.objects.filter(id=job.id).update(params=job.params)
+    return key
+
+
+def _cacheable(job) -> bool:
+    """
+    Whether a job's result may come from, or go to, the result cache.
+
+    Only requests with an explicit seed are repeatable; asking again without
+    one ("regenerate") means wanting a different image.
+    """
+    return generation_cache.enabled() and _describe(job)["seed"] is not None
+
+
+def _finish_from_cache(job) -> bool:
+    """
+    Claim and finish a queued job with a cached result, if the cache is on
+    and has one; True if the job needs no generation.
+    """
+    if not _cacheable(job):
+        return False
+    if not generation_cache.fetch(_cache_key(job), job.params["output_path"]):
+        return False
+
+    if _claim(job):
+        print(f"[Jobs] Job {job.id} served from the result cache")
+        _finish_job(job)
+    return True
+
+
+def _cache_result(job):
+    """Offer a finished job's image to the result cache"""
+    if not _cacheable(job):
+        return
+    try:
+        generation_cache.store(_cache_key(job), job.params["output_path"])
+    except Exception as e:
+        print(f"[Jobs] Could not cache result of job {job.id}: {e}")
+
+
+def _fail_job(job_id: int, error: Exception):
+    """Mark a queued or running job failed; one that already ended is left be"""
+    bfl_scheduler.release(job_id)
+    failed = GenerationJob.objects.filter(
+        id=job_id, status__in=("queued", "running")
+    ).update(
+        status="failed",
+        error=str(error),
+        progress="",
+        finished_at=timezone.now(),
+    )
+    if failed:
+        print(f"[Jobs] Job {job_id} failed: {error}")
+    else:
+        print(f"[Jobs] Job {job_id} already ended, not failing it: {error}")
+
+
+def _stale_jobs():
+    cutoff = timezone.now() - timedelta(seconds=STALE_JOB_TIMEOUT)
+    return GenerationJob.objects.filter(
+        status="running", webhook_token="", started_at__lte=cutoff
+    )
+
+
+def is_stale(job) -> bool:
+    """True if a running job has outlived STALE_JOB_TIMEOUT (see fail_stale_jobs)"""
+    return (
+        job.status == "running"
+        and not job.webhook_token
+        and job.started_at is not None
+        and job.started_at <= timezone.now() - timedelta(seconds=STALE_JOB_TIMEOUT)
+    )
+
+
+def fail_stale_jobs(job_ids: list[int] | None = None) -> int:
+    """
+    Fail running jobs whose process died before finishing them.
+
+    Webhook jobs are left to the sweeper, which has its own deadline.
+
+    Args:
+        job_ids: Only consider these jobs (default: all)
+
+    Returns:
+        Number of jobs failed
+    """
+    stale = _stale_jobs()
+    if job_ids is not None:
+        stale = stale.filter(id__in=job_ids)
+    failed = stale.update(
+        status="failed",
+        error=f"Job stopped: no result after {STALE_JOB_TIMEOUT} seconds",
+        progress="",
+        finished_at=timezone.now(),
+    )
+    if failed:
+        print(f"[Jobs] Failed {failed} job(s) left running by a stopped worker")
+    return failed
+
+
+def _generate(job) -> bool:
+    """
+    Claim a queued job once the scheduler grants it a slot and run its BFL
+    generation; with webhooks on, only submit it. A 429 puts the job back in
+    the scheduler's queue.
+
+    Returns False if another worker claimed the job first. The slot is given
+    back when the job finishes or fails.
+    """
+    name, kwargs = _generation_call(job)
+    model = _describe(job)["model"]
+    claimed = False
+    while True:
+        _set_progress(job.id, "Waiting for a BFL slot")
+        bfl_scheduler.acquire(job.id, model, JOB_LANES[job.kind], job.requested_by)
+        if not _slot_granted(job, claimed):
+            return False
+        claimed = True
+        try:
+            if settings.BFL_WEBHOOK_BASE_URL:
+                _submit_for_webhook(job)
+            else:
+                getattr(bfl_flux, name)(
+                    **kwargs, progress=partial(_set_progress, job.id)
+                )
+            return True
+        except bfl_flux.RateLimited as e:
+            bfl_scheduler.release(job.id)
+            bfl_scheduler.throttled(model, e.retry_after)
+
+
+async def _generate_async(job) -> bool:
+    """_generate() on the event loop, through bfl_async"""
+    name, kwargs = _generation_call(job)
+    model = (await asyncio.to_thread(_describe, job))["model"]
+    claimed = False
+    while True:
+        await _db(_set_progress, job.id, "Waiting for a BFL slot")
+        await bfl_scheduler.acquire_async(
+            job.id, model, JOB_LANES[job.kind], job.requested_by
+        )
+        if not await _db(_slot_granted, job, claimed):
+            return False
+        claimed = True
+        try:
+            if settings.BFL_WEBHOOK_BASE_URL:
+                await _db(_submit_for_webhook, job)
+            else:
+                await getattr(bfl_async, name)(
+                    **kwargs,
+                    progress=lambda message: _db(_set_progress, job.id, message),
+                )
+            return True
+        except bfl_flux.RateLimited as e:
+            bfl_scheduler.release(job.id)
+            bfl_scheduler.throttled(model, e.retry_after)
+
+
+def _retry_claim(job_id: int, attempt: int) -> bool:
+    """
+    Submit a job whose claim failed again after a delay.
+
+    Returns False once CLAIM_RETRY_DELAYS are used up.
+    """
+    if attempt >= len(CLAIM_RETRY_DELAYS):
+        return False
+
+    delay = CLAIM_RETRY_DELAYS[attempt]
+    print(f"[Jobs] Could not claim job {job_id}, retrying in {delay}s")
+    timer = threading.Timer(delay, _submit, (job_id, attempt + 1))
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+def _give_up_claim(job_id: int, error: Exception):
+    try:
+        _fail_job(job_id, error)
+    except Exception:
+        # Left as it is; the next process to start its pool picks it up
+        traceback.print_exc()
+
+
+def run_job(job_id: int, attempt: int = 0):
+    """
+    Claim and run a queued job on this thread, recording its outcome.
+
+    Does nothing if the job is no longer queued (another worker claimed it).
+    A claim that fails outright is retried later (see CLAIM_RETRY_DELAYS).
+    """
+    try:
+        try:
+            job = _queued_job(job_id)
+        except Exception as e:
+            # Executor futures are never inspected, so report it here
+            traceback.print_exc()
+            if not _retry_claim(job_id, attempt):
+                _give_up_claim(job_id, e)
+            return
+        if job is None:
+            return
+
+        try:
+            if _finish_from_cache(job) or not _generate(job):
+                return
+            if not settings.BFL_WEBHOOK_BASE_URL:
+                _finish_job(job)
+                _cache_result(job)
+        except _ClaimFailed as e:
+            traceback.print_exc()
+            if not _retry_claim(job_id, attempt):
+                _give_up_claim(job_id, e)
+        except Exception as e:
+            traceback.print_exc()
+            _fail_job(job_id, e)
+    finally:
+        # Worker threads keep their own DB connections; don't leak them
+        close_old_connections()
+
+
+async def _db(func, *args):
+    """Run an ORM call in a worker thread, closing its connection afterwards"""
+
+    def call():
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    return await sync_to_async(call, thread_sensitive=False)()
+
+
+async def run_job_async(job_id: int, attempt: int = 0):
+    """
+    Claim and run a queued job as a task on the running event loop.
+
+    The BFL round trip goes through bfl_async, so waiting on BFL costs no
+    thread; only the short ORM calls run in worker threads. Failed claims
+    are retried as in run_job.
+    """
+    try:
+        job = await _db(_queued_job, job_id)
+    except Exception as e:
+        traceback.print_exc()
+        if not _retry_claim(job_id, attempt):
+            await _db(_give_up_claim, job_id, e)
+        return
+    if job is None:
+        return
+
+    try:
+        if await _db(_finish_from_cache, job) or not await _generate_async(job):
+            return
+        if not settings.BFL_WEBHOOK_BASE_URL:
+            await _db(_finish_job, job)
+            await asyncio.to_thread(_cache_result, job)
+    except _ClaimFailed as e:
+        traceback.print_exc()
+        if not _retry_claim(job_id, attempt):
+            await _db(_give_up_claim, job_id, e)
+    except Exception as e:
+        traceback.print_exc()
+        await _db(_fail_job, job_id, e)
+
+
+def _webhook_url(job_id: int, token: str) -> str:
+    path = reverse("generationjob-bfl-webhook", args=[job_id])
+    return f"{settings.BFL_WEBHOOK_BASE_URL}{path}?token={token}"
+
+
+def _submit_for_webhook(job):
+    """Submit a claimed job's generation; BFL reports back to bfl_webhook"""
+    # Store the token first: the notification may beat the response to submit
+    token = secrets.token_urlsafe(32)
+    GenerationJob.objects.filter(id=job.id).update(webhook_token=token)
+
+    name, kwargs = _generation_call(job)
+    request_id, polling_url = bfl_flux.submit_generation(
+        name, kwargs, webhook_url=_webhook_url(job.id, token), webhook_secret=token
+    )
+    GenerationJob.objects.filter(id=job.id).update(
+        bfl_task_id=request_id,
+        bfl_polling_url=polling_url or "",
+        submitted_at=timezone.now(),
+        progress="Waiting for BFL",
+    )
+    print(f"[Jobs] Job {job.id} submitted as {request_id}, waiting for webhook")
+    _start_sweeper()
+
+
+def _claim_completion(job_id: int, token: str) -> bool:
+    """Take over a waiting job's completion; False if already taken"""
+    return bool(
+        GenerationJob.objects.filter(id=job_id, status="running", webhook_token=token)
+        .exclude(webhook_token="")
+        .update(webhook_token="", progress="Downloading result")
+    )
+
+
+def complete_job(job_id: int, token: str, result: dict):
+    """
+    Download a webhook job's image and record its version.
+
+    Does nothing if the webhook or the sweeper already completed the job.
+    """
+    try:
+        if not _claim_completion(job_id, token):
+            return
+
+        job = GenerationJob.objects.select_related("composition").get(id=job_id)
+        try:
+            bfl_flux.download_result(result, job.params["output_path"])
+            _finish_job(job)
+            _cache_result(job)
+        except Exception as e:
+            traceback.print_exc()
+            _fail_job(job_id, e)
+    finally:
+        close_old_connections()
+
+
+def _apply_result(job, token: str, result: dict):
+    """Act on a BFL status report (webhook or poll) for a waiting job"""
+    bfl_status = result.get("status")
+    if bfl_status in bfl_flux.READY_STATUSES:
+        _in_background(complete_job, job.id, token, result)
+    elif bfl_status in bfl_flux.FAILED_STATUSES:
+        if _claim_completion(job.id, token):
+            _fail_job(job.id, Exception(f"Generation failed ({bfl_status}): {result}"))
+    elif bfl_status:
+        _set_progress(job.id, str(bfl_status))
+
+
+def handle_webhook(job, token: str, result: dict) -> bool:
+    """
+    Accept a BFL notification for `job` if `token` is the job's webhook token.
+
+    Returns False for an unknown token or a job that is no longer waiting.
+    """
+    if (
+        job.status != "running"
+        or not job.webhook_token
+        or not hmac.compare_digest(job.webhook_token, token)
+    ):
+        return False
+
+    print(f"[Jobs] Webhook for job {job.id}: {result.get('status')}")
+    _apply_result(job, token, result)
+    return True
+
+
+def sweep_webhook_jobs():
+    """Poll BFL once for every webhook job that has waited too long"""
+    now = timezone.now()
+    waiting = GenerationJob.objects.filter(
+        status="running",
+        submitted_at__lte=now - timedelta(seconds=settings.BFL_WEBHOOK_SWEEP_INTERVAL),
+    ).exclude(webhook_token="")
+
+    for job in waiting:
+        try:
+            result = bfl_flux.fetch_result(job.bfl_task_id, job.bfl_polling_url or None)
+        except Exception as e:
+            print(f"[Jobs] Sweep poll for job {job.id} failed: {e}")
+            result = {}
+
+        if result.get("status") in bfl_flux.READY_STATUSES + bfl_flux.FAILED_STATUSES:
+            print(f"[Jobs] Webhook for job {job.id} missing, swept: {result['status']}")
+            _apply_result(job, job.webhook_token, result)
+        elif job.submitted_at <= now - timedelta(seconds=WEBHOOK_JOB_TIMEOUT):
+            if _claim_completion(job.id, job.webhook_token):
+                _fail_job(
+                    job.id,
+                    Exception(f"Generation timed out after {WEBHOOK_JOB_TIMEOUT} seconds"),
+                )
+        elif result.get("status"):
+            _set_progress(job.id, result["status"])
+
+
+def release_finished_slots():
+    """
+    Give back this process's scheduler slots of jobs BFL is done with.
+
+    A webhook job is finished by whichever process receives its webhook,
+    whose bfl_scheduler.release() can't free a slot taken here.
+    """
+    held = bfl_scheduler.held_slots()
+    if not held:
+        return
+
+    # Queued jobs may hold a slot for the moment between grant and claim
+    done = GenerationJob.objects.filter(id__in=held).filter(
+        Q(status__in=("succeeded", "failed"))
+        | Q(status="running", webhook_token="", submitted_at__isnull=False)
+    )
+    for job_id in done.values_list("id", flat=True):
+        bfl_scheduler.release(job_id)
+
+
+def _sweep_forever():
+    last_sweep = time.monotonic()
+    while True:
+        time.sleep(SLOT_CHECK_INTERVAL)
+        try:
+            release_finished_slots()
+            if time.monotonic() - last_sweep >= settings.BFL_WEBHOOK_SWEEP_INTERVAL:
+                last_sweep = time.monotonic()
+                sweep_webhook_jobs()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            close_old_connections()
+
+
+def _start_sweeper():
+    """Start this process's fallback sweeper thread, once"""
+    global _sweeper
+
+    with _executor_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(
+                target=_sweep_forever, name="generation-job-sweeper", daemon=True
+            )
+            _sweeper.start()
+
+
+def _in_background(func, *args):
+    """Run a blocking call off the request thread"""
+    if _event_loop is not None and not _event_loop.is_closed():
+        _event_loop.call_soon_threadsafe(_event_loop.run_in_executor, None, func, *args)
+    else:
+        _get_executor().submit(func, *args)
+
+
+def attach_event_loop(loop: asyncio.AbstractEventLoop):
+    """
+    Run jobs as tasks on `loop` instead of the thread pool.
+
+    Called by the ASGI entry point with the server's event loop, so one
+    process can drive as many concurrent generations as BFL allows. Jobs
+    still queued from a previous process are picked up on the first call.
+    """
+    global _event_loop
+
+    with _executor_lock:
+        if _event_loop is loop:
+            return
+        _event_loop = loop
+    print("[Jobs] Running generation jobs on the ASGI event loop")
+
+    def resume_queued():
+        fail_stale_jobs()
+        for job_id in GenerationJob.objects.filter(status="queued").values_list(
+            "id", flat=True
+        ):
+            asyncio.run_coroutine_threadsafe(run_job_async(job_id), loop)
+        close_old_connections()
+
+    threading.Thread(target=resume_queued, daemon=True).start()
+    if settings.BFL_WEBHOOK_BASE_URL:
+        _start_sweeper()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """This process's job pool, started on first use."""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.GENERATION_WORKERS,
+                thread_name_prefix="generation-job",
+            )
+            print(f"[Jobs] Started {settings.GENERATION_WORKERS} generation workers")
+
+            # Pick up jobs left queued by a process that exited before running
+            # them (a job another process is still waiting on is only claimed
+            # by one of them), and give up on those it left running
+            fail_stale_jobs()
+            for job_id in GenerationJob.objects.filter(status="queued").values_list(
+                "id", flat=True
+            ):
+                _executor.submit(run_job, job_id)
+
+    # ...and webhook jobs whose notification went to a process that exited
+    if settings.BFL_WEBHOOK_BASE_URL:
+        _start_sweeper()
+    return _executor
+
+
+def _submit(job_id: int, attempt: int = 0):
+    if _event_loop is not None and not _event_loop.is_closed():
+        asyncio.run_coroutine_threadsafe(run_job_async(job_id, attempt), _event_loop)
+    else:
+        _get_executor().submit(run_job, job_id, attempt)
+
+
+def enqueue(job: GenerationJob):
+    """Hand a saved job to the runner once the current transaction commits."""
+    transaction.on_commit(lambda: _submit(job.id))
@@ -11,9 +11,18 @@ Supports three modes:
 1. Sketch Generation - B&W pencil sketch style
 2. Revision/Edit - Modify existing images (img2img)
 3. Colorization - Add color to sketches
+
+When the warm inference server (local_flux_server, started with
+`python manage.py local_flux_server`) listens on LOCAL_FLUX_SOCKET, jobs are
+sent to it and skip loading the model; otherwise each call runs the
+mflux-generate-flux2 CLI. Both need mflux 0.22.0
+(local_flux_server.MFLUX_VERSION).
 """
 
+import json
 import os
+import socket
+import tempfile
 import time
 import subprocess
 from typing import Optional
@@ -22,6 +31,53 @@ from typing import Optional
 DEFAULT_MODEL = "flux2-klein-4b"
 DEFAULT_QUANTIZE = 4  # 4-bit quantization for M4 MacBook Air
 
+# Unix socket of the warm inference server
+SERVER_SOCKET = os.getenv(
+    "LOCAL_FLUX_SOCKET", os.path.join(tempfile.gettempdir(), "local_flux.sock")
+)
+GENERATION_TIMEOUT = 600  # 10 minutes
+
+
+def flux2_guidance(model: str, guidance: float) -> float:
+    """
+    Guidance mflux will accept for a FLUX.2 Klein model.
+
+    Distilled checkpoints only run at 1.0 (mflux-generate-flux2 exits with an
+    error otherwise); the "-base-" ones take real CFG.
+    """
+    return guidance if "-base-" in model else 1.0
+
+
+def _request_server(job: dict) -> Optional[dict]:
+    """
+    Run a job on the inference server.
+
+    Args:
+        job: Arguments of _run_mflux_generate()
+
+    Returns:
+        The server's reply, or None if no server is listening
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(SERVER_SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        client.settimeout(GENERATION_TIMEOUT)
+        client.sendall(json.dumps(job).encode() + b"\n")
+        with client.makefile("rb") as reply:
+            line = reply.readline()
+    except socket.timeout:
+        raise Exception("Generation timed out after 10 minutes")
+    finally:
+        client.close()
+
+    if not line:
+        raise Exception("Local Flux server closed the connection")
+    return json.loads(line)
+
 
 def _run_mflux_generate(
     prompt: str,
@@ -36,7 +92,7 @@ def _run_mflux_generate(
     strength: float = 0.75,
 ) -> str:
     """
-    Run mflux-generate CLI command with Flux 2.1 Klein 4B
+    Run mflux-generate-flux2 CLI command with Flux 2.1 Klein 4B
 
     Args:
         prompt: Text prompt for generation
@@ -62,9 +118,38 @@ def _run_mflux_generate(
     print(f"[MFLUX] Prompt: {prompt[:100]}...")
     start_time = time.time()
 
-    # Build mflux-generate command
+    reply = _request_server(
+        {
+            "prompt": prompt,
+            "output_path": output_path,
+            "num_steps": num_steps,
+            "guidance": guidance,
+            "width": width,
+            "height": height,
+            "model": model,
+            "quantize": quantize,
+            # Like the CLI below, a missing init image means text-to-image
+            "init_image_path": (
+                init_image_path
+                if init_image_path and os.path.exists(init_image_path)
+                else None
+            ),
+            "strength": strength,
+        }
+    )
+    if reply is not None:
+        if not reply["ok"]:
+            print(f"[MFLUX] Server error: {reply['error']}")
+            raise Exception(f"Local Flux server failed: {reply['error']}")
+        print(
+            f"[MFLUX] Generated by server in {reply['seconds']:.2f}s "
+            f"({time.time() - start_time:.2f}s total)"
+        )
+        return output_path
+
+    # Build mflux-generate-flux2 command
     cmd = [
-        "mflux-generate",
+        "mflux-generate-flux2",
         "--model",
         model,
         "--quantize",
@@ -80,7 +165,7 @@ def _run_mflux_generate(
         "--output",
         output_path,
         "--guidance",
-        str(guidance),
+        str(flux2_guidance(model, guidance)),
     ]
 
     # Add img2img parameters if init image provided
@@ -99,13 +184,13 @@ def _run_mflux_generate(
         print(f"[MFLUX] Running command: {' '.join(cmd[:8])}...")
 
         result = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=600  # 10 minute timeout
+            cmd, capture_output=True, text=True, timeout=GENERATION_TIMEOUT
         )
 
         if result.returncode != 0:
             error_msg = result.stderr or result.stdout or "Unknown error"
             print(f"[MFLUX] Error output: {error_msg}")
-            raise Exception(f"mflux-generate failed: {error_msg}")
+            raise Exception(f"mflux-generate-flux2 failed: {error_msg}")
 
         # Check if file was created
         if not os.path.exists(output_path):
@@ -121,7 +206,9 @@ def _run_mflux_generate(
     except subprocess.TimeoutExpired:
         raise Exception("Generation timed out after 10 minutes")
     except FileNotFoundError:
-        raise Exception("mflux-generate not found. Install with: pip install mflux")
+        raise Exception(
+            "mflux-generate-flux2 not found. Install with: pip install mflux==0.22.0"
+        )
     except Exception as e:
         print(f"[MFLUX] Error: {str(e)}")
         raise
@@ -0,0 +1,174 @@
+"""
+Local Flux Inference Server
+Long-lived worker for local_flux that loads the model once and then serves
+generation jobs over a Unix socket, so each sketch, revision or colorization
+costs only the diffusion steps instead of a fresh mflux-generate-flux2 process
+reloading the quantized weights from disk.
+
+Protocol: one JSON object per line each way. A request carries the arguments
+of local_flux._run_mflux_generate(); the reply is
+{"ok": true, "output_path": ..., "seconds": ...} or {"ok": false, "error": ...}.
+A connection may send any number of requests. Jobs run one at a time (there
+is one model and one GPU); other connections wait their turn.
+
+Backends:
+- "mflux": FLUX.2 Klein through mflux's Python API (what mflux-generate-flux2
+  wraps), loaded on first use and kept per (model, quantize); needs
+  mflux==MFLUX_VERSION
+- "stub": writes a placeholder image after an optional delay, for tests and
+  for working on the app without the model
+
+Start it with `python manage.py local_flux_server`; local_flux uses it
+whenever LOCAL_FLUX_SOCKET answers.
+"""
+
+import importlib.metadata
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+
+from PIL import Image
+
+from .local_flux import flux2_guidance
+
+
+class StubBackend:
+    """Stand-in for the model: a gray image (or the init image) per job."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.loads = 1
+        self.jobs = 0
+
+    def generate(self, job: dict):
+        time.sleep(self.delay)
+        size = (job.get("width", 1024), job.get("height", 1024))
+        init_image_path = job.get("init_image_path")
+        if init_image_path:
+            with Image.open(init_image_path) as init:
+                image = init.convert("RGB").resize(size)
+        else:
+            image = Image.new("RGB", size, "lightgray")
+        image.save(job["output_path"])
+        self.jobs += 1
+
+
+# mflux release the backend was written against; its Python API changes
+# between minor versions, so any other version is refused at startup
+MFLUX_VERSION = "0.22.0"
+
+# Model names (as passed to mflux-generate-flux2 --model) -> ModelConfig factory
+FLUX2_MODELS = {
+    "flux2-klein-4b": "flux2_klein_4b",
+    "flux2-klein-9b": "flux2_klein_9b",
+    "flux2-klein-base-4b": "flux2_klein_base_4b",
+    "flux2-klein-base-9b": "flux2_klein_base_9b",
+}
+
+
+class MfluxBackend:
+    """FLUX.2 Klein through mflux's Python API; models stay loaded between jobs."""
+
+    def __init__(self):
+        try:
+            installed = importlib.metadata.version("mflux")
+        except importlib.metadata.PackageNotFoundError:
+            raise Exception(
+                f"mflux not installed. Install with: pip install mflux=={MFLUX_VERSION}"
+            )
+        if installed != MFLUX_VERSION:
+            raise Exception(
+                f"mflux {installed} is installed but the server needs "
+                f"{MFLUX_VERSION}. Install with: pip install mflux=={MFLUX_VERSION}"
+            )
+        from mflux.models.common.config.model_config import ModelConfig
+        from mflux.models.flux2.variants import Flux2Klein
+
+        self._model_config = ModelConfig
+        self._flux = Flux2Klein
+        self._models = {}
+        self.loads = 0
+        self.jobs = 0
+
+    def load(self, name: str, quantize: int):
+        if name not in FLUX2_MODELS:
+            raise Exception(
+                f"Unsupported model for the mflux backend: {name} "
+                f"(supported: {', '.join(FLUX2_MODELS)})"
+            )
+        key = (name, quantize)
+        if key not in self._models:
+            print(f"[MFLUX Server] Loading {name} ({quantize}-bit)...")
+            start_time = time.time()
+            model_config = getattr(self._model_config, FLUX2_MODELS[name])()
+            self._models[key] = self._flux(quantize=quantize, model_config=model_config)
+            self.loads += 1
+            print(f"[MFLUX Server] Model loaded in {time.time() - start_time:.1f}s")
+        return self._models[key]
+
+    def generate(self, job: dict):
+        flux = self.load(job["model"], job["quantize"])
+        image = flux.generate_image(
+            seed=random.randrange(2**32),
+            prompt=job["prompt"],
+            num_inference_steps=job["num_steps"],
+            height=job["height"],
+            width=job["width"],
+            guidance=flux2_guidance(job["model"], job["guidance"]),
+            image_path=job.get("init_image_path"),
+            image_strength=(job["strength"] if job.get("init_image_path") else None),
+        )
+        image.save(path=job["output_path"], overwrite=True)
+        self.jobs += 1
+
+
+BACKENDS = {"mflux": MfluxBackend, "stub": StubBackend}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.run(json.loads(line))
+            except Exception as e:
+                print(f"[MFLUX Server] Error: {e}")
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class LocalFluxServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server running every job on one shared backend."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, backend):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.socket_path = socket_path
+        self.backend = backend
+        self._lock = threading.Lock()
+
+    def run(self, job: dict) -> dict:
+        if job.get("init_image_path") and not os.path.exists(job["init_image_path"]):
+            raise Exception(f"Source image not found: {job['init_image_path']}")
+        os.makedirs(os.path.dirname(job["output_path"]), exist_ok=True)
+
+        with self._lock:
+            start_time = time.time()
+            self.backend.generate(job)
+            elapsed = time.time() - start_time
+
+        print(f"[MFLUX Server] {job['output_path']} in {elapsed:.2f}s")
+        return {"ok": True, "output_path": job["output_path"], "seconds": elapsed}
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
@@ -0,0 +1,202 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from face_generator.models import FaceComposition, GenerationVersion
+
+# Marks the compositions this command seeds, so --cleanup can find them
+BENCH_NOTE = "[benchmark_history]"
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a large generation history (1M versions by default) and time the "
+        "history queries against it"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--versions",
+            type=int,
+            default=1_000_000,
+            help="Versions to have in the benchmark history (default: 1,000,000)",
+        )
+        parser.add_argument(
+            "--per-composition",
+            type=int,
+            default=10,
+            help="Versions per seeded composition (default: 10)",
+        )
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=5000,
+            help="Compositions inserted per transaction while seeding",
+        )
+        parser.add_argument(
+            "--runs",
+            type=int,
+            default=20,
+            help="Timed runs per query (default: 20)",
+        )
+        parser.add_argument(
+            "--cleanup",
+            action="store_true",
+            help="Delete the seeded history and exit",
+        )
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            seeded = FaceComposition.objects.filter(additional_notes=BENCH_NOTE)
+            GenerationVersion.objects.filter(composition__in=seeded).delete()
+            deleted, _ = seeded.delete()
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} seeded rows"))
+            return
+
+        self.stdout.write(
+            f"Database: {connection.vendor} ({connection.settings_dict['NAME']})"
+        )
+        self.seed(options["versions"], options["per_composition"], options["batch"])
+
+        seeded = FaceComposition.objects.filter(additional_notes=BENCH_NOTE)
+        sample_ids = list(seeded.values_list("id", flat=True)[:1000])
+        runs = options["runs"]
+
+        # The paginator builds absolute next links, which validates the host
+        with override_settings(ALLOWED_HOSTS=["testserver"]):
+            client = Client()
+            deep_url = "/api/compositions/all_history/"
+            for _ in range(50):
+                deep_url = client.get(deep_url).json()["next"]
+
+            self.time_query(
+                "all_history, first page",
+                runs,
+                lambda: client.get("/api/compositions/all_history/"),
+            )
+            self.time_query(
+                "all_history, 50 pages deep",
+                runs,
+                lambda: client.get(deep_url),
+            )
+            self.time_query(
+                "composition history",
+                runs,
+                lambda: client.get(
+                    f"/api/compositions/{random.choice(sample_ids)}/history/"
+                ),
+            )
+        self.time_query(
+            "latest version of a composition",
+            runs,
+            lambda: GenerationVersion.objects.filter(
+                composition_id=random.choice(sample_ids)
+            )
+            .order_by("-version_number")
+            .first(),
+        )
+
+        self.stdout.write("\nQuery plans:")
+        plans = {
+            "versions of a composition": GenerationVersion.objects.filter(
+                composition_id=sample_ids[0]
+            ).order_by("version_number"),
+            "newest compositions": FaceComposition.objects.order_by(
+                "-created_at", "-id"
+            )[:20],
+        }
+        for label, queryset in plans.items():
+            self.stdout.write(f"  {label}:")
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f"    {line}")
+
+    def seed(self, versions: int, per_composition: int, batch: int):
+        """Top the seeded history up to `versions` versions."""
+        existing = GenerationVersion.objects.filter(
+            composition__additional_notes=BENCH_NOTE
+        ).count()
+        missing = max(0, versions - existing)
+        if not missing:
+            self.stdout.write(f"Using {existing:,} seeded versions")
+            return
+
+        compositions_needed = -(-missing // per_composition)
+        self.stdout.write(
+            f"Seeding {compositions_needed:,} compositions with "
+            f"{per_composition} versions each..."
+        )
+        start_time = time.time()
+        start_at = timezone.now() - timedelta(minutes=existing // per_composition)
+        created = 0
+        while created < compositions_needed:
+            count = min(batch, compositions_needed - created)
+            with transaction.atomic():
+                compositions = FaceComposition.objects.bulk_create(
+                    FaceComposition(
+                        additional_notes=BENCH_NOTE,
+                        last_version_number=per_composition,
+                    )
+                    for _ in range(count)
+                )
+                # created_at is set on insert; spread it a minute apart, like
+                # a real archive, rather than one shared timestamp
+                for offset, composition in enumerate(reversed(compositions)):
+                    composition.created_at = start_at - timedelta(
+                        minutes=created + offset
+                    )
+                FaceComposition.objects.bulk_update(
+                    compositions, ["created_at"], batch_size=500
+                )
+                GenerationVersion.objects.bulk_create(
+                    (
+                        GenerationVersion(
+                            composition=composition,
+                            version_number=number,
+                            image_type="sketch" if number == 1 else "revision",
+                            image=f"versions/bench_{number}.png",
+                            prompt_used="benchmark",
+                        )
+                        for composition in compositions
+                        for number in range(1, per_composition + 1)
+                    ),
+                    batch_size=5000,
+                )
+            created += count
+            self.stdout.write(
+                f"  {created * per_composition:,} versions "
+                f"({time.time() - start_time:.0f}s)"
+            )
+
+        total = GenerationVersion.objects.aggregate(Max("id"))["id__max"]
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Seeded in {time.time() - start_time:.0f}s "
+                f"(version ids up to {total:,})"
+            )
+        )
+
+    def time_query(self, label: str, runs: int, query):
+        with CaptureQueriesContext(connection) as queries:
+            query()
+        query_count = len(queries)
+
+        timings = []
+        for _ in range(runs):
+            start_time = time.perf_counter()
+            query()
+            timings.append((time.perf_counter() - start_time) * 1000)
+
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        self.stdout.write(
+            f"{label:<34} median {statistics.median(timings):7.2f} ms   "
+            f"p95 {p95:7.2f} ms   {query_count} queries"
+        )
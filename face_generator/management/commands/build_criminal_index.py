@@ -0,0 +1,59 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from face_generator.criminal_index import build_index, sync_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Bring the persisted criminal DB feature index up to date, re-indexing "
+        "only added, changed or removed images"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            default=os.path.join(settings.BASE_DIR, "criminalDB"),
+            help="Criminal DB folder (default: BASE_DIR/criminalDB)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Indexing processes (default: one per CPU core)",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rebuild the whole index from scratch instead of syncing",
+        )
+
+    def handle(self, *args, **options):
+        criminal_db_path = options["path"]
+        if not os.path.isdir(criminal_db_path):
+            raise CommandError(
+                f"Criminal database folder not found: {criminal_db_path}"
+            )
+
+        if options["force"]:
+            gallery = build_index(criminal_db_path, options["workers"])
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Rebuilt index: {len(gallery['ids'])} images "
+                    f"(version {gallery['version'][:8]})"
+                )
+            )
+            return
+
+        gallery, summary = sync_index(criminal_db_path, options["workers"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Index synced: {len(summary['added'])} added, "
+                f"{len(summary['modified'])} modified, "
+                f"{len(summary['removed'])} removed, "
+                f"{len(summary['unchanged'])} unchanged — "
+                f"{len(gallery['ids'])} images (version {gallery['version'][:8]})"
+            )
+        )
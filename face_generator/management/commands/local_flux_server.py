@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+
+from face_generator import local_flux
+from face_generator.local_flux_server import BACKENDS, LocalFluxServer, StubBackend
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the warm local Flux inference server: load the model once and "
+        "serve local_flux generations over a Unix socket"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--socket",
+            default=local_flux.SERVER_SOCKET,
+            help="Socket path (default: LOCAL_FLUX_SOCKET or <tmp>/local_flux.sock)",
+        )
+        parser.add_argument(
+            "--backend",
+            choices=sorted(BACKENDS),
+            default="mflux",
+            help="mflux (the real model) or stub (placeholder images, no model)",
+        )
+        parser.add_argument(
+            "--stub-delay",
+            type=float,
+            default=0.0,
+            help="Seconds the stub backend takes per image",
+        )
+        parser.add_argument(
+            "--preload",
+            action="store_true",
+            help="Load the default model before accepting jobs",
+        )
+
+    def handle(self, *args, **options):
+        if options["backend"] == "stub":
+            backend = StubBackend(delay=options["stub_delay"])
+        else:
+            backend = BACKENDS[options["backend"]]()
+            if options["preload"]:
+                backend.load(local_flux.DEFAULT_MODEL, local_flux.DEFAULT_QUANTIZE)
+
+        server = LocalFluxServer(options["socket"], backend)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Local Flux server ({options['backend']}) listening on "
+                f"{options['socket']}"
+            )
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,240 @@
+"""
+Sharded Criminal Matching
+Splits the criminal DB gallery across long-lived worker processes so a single
+match request can use every core on the box.
+
+Each worker memory-maps the persisted index (see criminal_index) and owns one
+contiguous slice of its rows; the mapped pages are shared through the OS page
+cache, so shards add no per-process copy of the gallery. A query is sent to
+every shard, each shard runs the matching cascade over its slice and returns
+its local top-k, and the results are merged into the global top-k.
+
+The pool is created lazily, per web process, by get_shard_pool().
+
+A worker pins its BLAS/OpenMP thread counts in its own environment before
+numpy loads, so this module imports numpy and the matching code only inside
+_shard_worker; the web process's environment is never touched.
+"""
+
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Thread-count variables pinned to 1 in shard workers so S shards use S cores
+_SINGLE_THREAD_ENV = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _shard_worker(conn, criminal_db_path: str, shard: int, shards: int):
+    """
+    Worker loop: map the index, then answer queries until told to stop.
+
+    Messages are (query_hist, query_gray, index_version, options) tuples, or
+    None to exit. The index is re-mapped whenever the parent asks for a
+    different version than the one last requested; a query finding another
+    version published (mid-publish, or the parent is behind) is answered
+    with an error, so the parent matches in-process instead.
+    """
+    # Numerical libraries size their thread pools when first imported
+    os.environ.update({name: "1" for name in _SINGLE_THREAD_ENV})
+
+    import cv2
+
+    from .criminal_index import load_index
+    from .face_matcher import _match_features, _slice_gallery
+
+    cv2.setNumThreads(1)
+
+    requested = None
+    view = None
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        query_hist, query_gray, version, options = message
+        try:
+            if version != requested:
+                requested = version
+                gallery = load_index(criminal_db_path, check_stale=False)
+                if gallery is None:
+                    raise RuntimeError(f"No criminal index in {criminal_db_path}")
+                if gallery["version"] != version:
+                    raise RuntimeError(
+                        f"Index version {gallery['version'][:8]} is published, "
+                        f"not {version[:8]}"
+                    )
+                total = len(gallery["ids"])
+                view = _slice_gallery(
+                    gallery, shard * total // shards, (shard + 1) * total // shards
+                )
+
+            if len(view["ids"]):
+                result = _match_features(query_hist, query_gray, view, **options)
+            else:
+                result = ([], [])
+            conn.send(("ok", result))
+        except Exception as e:
+            requested = None
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+    conn.close()
+
+
+def _merge_stages(shard_stages: list[list[dict]]) -> list[dict]:
+    """Sum per-shard stage counts; shards run in parallel, so ms is the max."""
+    merged = {}
+    for stages in shard_stages:
+        for stage in stages:
+            total = merged.setdefault(
+                stage["stage"],
+                {"stage": stage["stage"], "candidates": 0, "kept": 0, "pruned": 0},
+            )
+            for key in ("candidates", "kept", "pruned"):
+                total[key] += stage[key]
+            total["ms"] = max(total.get("ms", 0.0), stage["ms"])
+    return list(merged.values())
+
+
+class ShardPool:
+    """Long-lived worker processes, one per gallery shard."""
+
+    def __init__(self, criminal_db_path: str, shards: int):
+        self.criminal_db_path = criminal_db_path
+        self.shards = shards
+        self._lock = threading.Lock()
+        self._workers = []
+
+        context = multiprocessing.get_context("spawn")
+        for shard in range(shards):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_shard_worker,
+                args=(child_conn, criminal_db_path, shard, shards),
+                name=f"face-matcher-shard-{shard}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._workers.append((process, parent_conn))
+
+        print(f"[MatchShards] Started {shards} shard workers")
+
+    def is_alive(self) -> bool:
+        return bool(self._workers) and all(
+            process.is_alive() for process, _ in self._workers
+        )
+
+    def match(
+        self,
+        query_hist: "np.ndarray",
+        query_gray: "np.ndarray",
+        index_version: str,
+        top_k: int,
+        **options,
+    ) -> tuple[list[dict], list[dict]]:
+        """
+        Fan a query out to every shard and merge the shard top-k lists.
+
+        Returns:
+            (matches, stages), like face_matcher._match_features()
+        """
+        message = (query_hist, query_gray, index_version, {"top_k": top_k, **options})
+
+        # One query at a time: each query already uses every shard
+        with self._lock:
+            if not self._workers:
+                raise RuntimeError("Shard pool is closed")
+            try:
+                for _, conn in self._workers:
+                    conn.send(message)
+                replies = [conn.recv() for _, conn in self._workers]
+            except (EOFError, OSError) as e:
+                # A worker died mid-query; unread replies would poison the
+                # pipes, so retire the whole pool (get_shard_pool restarts it)
+                self.close()
+                raise RuntimeError(f"Shard worker lost: {e}") from e
+
+        errors = [payload for status, payload in replies if status != "ok"]
+        if errors:
+            raise RuntimeError(f"Shard matching failed: {errors[0]}")
+
+        started = time.time()
+        candidates = [match for _, (matches, _) in replies for match in matches]
+        candidates.sort(key=lambda x: x["similarity"], reverse=True)
+        matches = candidates[:top_k]
+
+        stages = _merge_stages([stages for _, (_, stages) in replies])
+        stages.append(
+            {
+                "stage": "merge",
+                "candidates": len(candidates),
+                "kept": len(matches),
+                "pruned": len(candidates) - len(matches),
+                "ms": round((time.time() - started) * 1000, 1),
+            }
+        )
+        return matches, stages
+
+    def close(self):
+        """Ask every worker to exit and wait briefly for it."""
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+                conn.close()
+            except OSError:
+                pass
+        for process, _ in self._workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._workers = []
+
+
+def get_shard_pool(criminal_db_path: str, shards: int) -> ShardPool:
+    """
+    Return this process's shard pool, (re)starting it if the gallery path or
+    shard count changed or a worker died.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None and (
+            _pool.criminal_db_path != criminal_db_path
+            or _pool.shards != shards
+            or not _pool.is_alive()
+        ):
+            _pool.close()
+            _pool = None
+        if _pool is None:
+            _pool = ShardPool(criminal_db_path, shards)
+        return _pool
+
+
+def close_shard_pool():
+    """Stop this process's shard workers, if any."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+atexit.register(close_shard_pool)
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("face_generator", "0004_generationjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="generationjob",
+            name="bfl_polling_url",
+            field=models.CharField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name="generationjob",
+            name="bfl_task_id",
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name="generationjob",
+            name="submitted_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="generationjob",
+            name="webhook_token",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
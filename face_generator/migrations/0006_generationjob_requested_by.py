@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("face_generator", "0005_generationjob_webhook"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="generationjob",
+            name="requested_by",
+            field=models.CharField(
+                blank=True,
+                help_text="User or client address, for fair queuing",
+                max_length=150,
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:18
+
+from django.db import migrations, models
+
+
+def clear_existing_prompts(apps, schema_editor):
+    # Existing compositions rebuild their prompt on first use
+    FaceComposition = apps.get_model("face_generator", "FaceComposition")
+    FaceComposition.objects.update(cached_prompt=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("face_generator", "0006_generationjob_requested_by"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="facecomposition",
+            name="cached_prompt",
+            field=models.TextField(blank=True, default="", editable=False, null=True),
+        ),
+        migrations.RunPython(clear_existing_prompts, migrations.RunPython.noop),
+    ]
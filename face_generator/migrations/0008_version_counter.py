@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:30
+
+from django.db import migrations, models
+from django.db.models import Count, F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def number_existing_versions(apps, schema_editor):
+    FaceComposition = apps.get_model("face_generator", "FaceComposition")
+    GenerationVersion = apps.get_model("face_generator", "GenerationVersion")
+
+    # Concurrent generations could give two versions the same number;
+    # renumber those compositions in creation order so the constraint holds
+    duplicated = (
+        GenerationVersion.objects.values("composition")
+        .annotate(rows=Count("id"), numbers=Count("version_number", distinct=True))
+        .filter(rows__gt=F("numbers"))
+        .values_list("composition", flat=True)
+    )
+    for composition_id in list(duplicated):
+        versions = GenerationVersion.objects.filter(
+            composition_id=composition_id
+        ).order_by("version_number", "created_at", "id")
+        for number, version in enumerate(versions, start=1):
+            if version.version_number != number:
+                version.version_number = number
+                version.save(update_fields=["version_number"])
+
+    last_numbers = (
+        GenerationVersion.objects.filter(composition=OuterRef("pk"))
+        .values("composition")
+        .annotate(last=Max("version_number"))
+        .values("last")
+    )
+    FaceComposition.objects.update(
+        last_version_number=Coalesce(Subquery(last_numbers), 0)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("face_generator", "0007_facecomposition_cached_prompt"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="facecomposition",
+            name="last_version_number",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(number_existing_versions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="generationversion",
+            constraint=models.UniqueConstraint(
+                fields=("composition", "version_number"),
+                name="unique_version_number_per_composition",
+            ),
+        ),
+    ]
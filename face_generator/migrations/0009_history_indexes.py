@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("face_generator", "0008_version_counter"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="facecomposition",
+            index=models.Index(
+                fields=["-created_at", "-id"], name="composition_newest_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="generationjob",
+            index=models.Index(
+                fields=["composition", "-created_at"], name="job_composition_newest_idx"
+            ),
+        ),
+    ]
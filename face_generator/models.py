@@ -54,18 +54,60 @@ class FaceComposition(models.Model):
         blank=True,
         help_text="Optional reference image (CCTV capture, blurry photo, etc.)",
     )
+    # get_prompt() result, kept in step with selected_features (see signals);
+    # NULL when a feature's prompt_text changed and it must be rebuilt
+    cached_prompt = models.TextField(
+        null=True, blank=True, default="", editable=False
+    )
+    # Highest version_number handed out (see jobs.save_version)
+    last_version_number = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # Newest-first listing and history pages (HistoryCursorPagination)
+            models.Index(fields=["-created_at", "-id"], name="composition_newest_idx"),
+        ]
+
+    # Written only by UPDATEs of their own (see refresh_prompt, signals and
+    # jobs._next_version), so a full save() of an instance loaded earlier
+    # mustn't put back its stale copy
+    SEPARATELY_UPDATED_FIELDS = ("cached_prompt", "last_version_number")
 
     def __str__(self):
         return f"Composition {self.id} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
 
-    def get_prompt(self):
-        """Generate AI prompt from selected features"""
+    def save(self, **kwargs):
+        if kwargs.get("update_fields") is None and not (
+            self._state.adding or kwargs.get("force_insert")
+        ):
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.SEPARATELY_UPDATED_FIELDS
+            ]
+        super().save(**kwargs)
+
+    def build_prompt(self):
+        """Join the selected features' prompt texts (queries the features)"""
         features_text = ", ".join([f.prompt_text for f in self.selected_features.all()])
         return features_text
 
+    def refresh_prompt(self):
+        """Rebuild and store cached_prompt"""
+        self.cached_prompt = self.build_prompt()
+        FaceComposition.objects.filter(pk=self.pk).update(
+            cached_prompt=self.cached_prompt
+        )
+        return self.cached_prompt
+
+    def get_prompt(self):
+        """Generate AI prompt from selected features"""
+        if self.cached_prompt is None:
+            return self.refresh_prompt()
+        return self.cached_prompt
+
 
 class GenerationVersion(models.Model):
     """Tracks each version of a generated image (sketch, revision, colorized)"""
@@ -94,6 +136,74 @@ class GenerationVersion(models.Model):
 
     class Meta:
         ordering = ["version_number"]
+        # The unique constraint's (composition, version_number) index also
+        # serves a composition's versions in order and its latest version
+        constraints = [
+            models.UniqueConstraint(
+                fields=["composition", "version_number"],
+                name="unique_version_number_per_composition",
+            )
+        ]
 
     def __str__(self):
         return f"v{self.version_number} ({self.image_type}) — Composition {self.composition_id}"
+
+
+class GenerationJob(models.Model):
+    """A BFL generation (sketch, revision or colorization) run in the background"""
+
+    KINDS = [
+        ("sketch", "Sketch"),
+        ("revision", "Revision"),
+        ("colorize", "Colorize"),
+    ]
+
+    STATUSES = [
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("succeeded", "Succeeded"),
+        ("failed", "Failed"),
+    ]
+
+    composition = models.ForeignKey(
+        FaceComposition, on_delete=models.CASCADE, related_name="jobs"
+    )
+    kind = models.CharField(max_length=20, choices=KINDS)
+    status = models.CharField(
+        max_length=20, choices=STATUSES, default="queued", db_index=True
+    )
+    params = models.JSONField(
+        default=dict, blank=True, help_text="Inputs captured when the job was queued"
+    )
+    progress = models.CharField(max_length=200, blank=True)
+    error = models.TextField(blank=True)
+    requested_by = models.CharField(
+        max_length=150, blank=True, help_text="User or client address, for fair queuing"
+    )
+    version = models.ForeignKey(
+        GenerationVersion,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    # Set while a job submitted with a webhook URL waits for BFL to call back
+    bfl_task_id = models.CharField(max_length=100, blank=True)
+    bfl_polling_url = models.CharField(max_length=500, blank=True)
+    webhook_token = models.CharField(max_length=64, blank=True)
+    submitted_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+        indexes = [
+            # A composition's jobs, newest first (/api/jobs/?composition=)
+            models.Index(
+                fields=["composition", "-created_at"], name="job_composition_newest_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.kind}, {self.status}) — Composition {self.composition_id}"
@@ -0,0 +1,15 @@
+from rest_framework.pagination import CursorPagination
+
+
+class HistoryCursorPagination(CursorPagination):
+    """
+    Newest-first cursor pages for the history sidebar.
+
+    A cursor keeps its place however many compositions are added meanwhile,
+    and a page costs the same at any depth of the archive (no OFFSET scan).
+    """
+
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = ("-created_at", "-id")
@@ -1,5 +1,11 @@
 from rest_framework import serializers
-from .models import FaceFeatureCategory, FaceFeature, FaceComposition, GenerationVersion
+from .models import (
+    FaceFeatureCategory,
+    FaceFeature,
+    FaceComposition,
+    GenerationJob,
+    GenerationVersion,
+)
 
 
 class FaceFeatureSerializer(serializers.ModelSerializer):
@@ -30,6 +36,29 @@ class GenerationVersionSerializer(serializers.ModelSerializer):
         ]
 
 
+class GenerationVersionSummarySerializer(serializers.ModelSerializer):
+    """What the history sidebar shows and needs to restore a version"""
+
+    class Meta:
+        model = GenerationVersion
+        fields = [
+            "id",
+            "version_number",
+            "image_type",
+            "image",
+            "prompt_used",
+            "created_at",
+        ]
+
+
+class CompositionHistorySerializer(serializers.ModelSerializer):
+    versions = GenerationVersionSummarySerializer(many=True, read_only=True)
+
+    class Meta:
+        model = FaceComposition
+        fields = ["id", "created_at", "versions"]
+
+
 class FaceCompositionSerializer(serializers.ModelSerializer):
     selected_features = serializers.PrimaryKeyRelatedField(
         many=True, queryset=FaceFeature.objects.all(), required=False
@@ -55,3 +84,32 @@ class FaceCompositionSerializer(serializers.ModelSerializer):
 
     def get_prompt(self, obj):
         return obj.get_prompt()
+
+
+class GenerationJobSerializer(serializers.ModelSerializer):
+    version = GenerationVersionSerializer(read_only=True)
+    image_url = serializers.SerializerMethodField()
+    method = serializers.SerializerMethodField()
+
+    class Meta:
+        model = GenerationJob
+        fields = [
+            "id",
+            "composition",
+            "kind",
+            "status",
+            "progress",
+            "error",
+            "method",
+            "image_url",
+            "version",
+            "created_at",
+            "started_at",
+            "finished_at",
+        ]
+
+    def get_image_url(self, obj):
+        return obj.version.image.url if obj.version else None
+
+    def get_method(self, obj):
+        return obj.params.get("method")
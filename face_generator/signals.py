@@ -0,0 +1,63 @@
+"""
+Keeps denormalized data in step with what it is built from.
+
+FaceComposition.cached_prompt:
+- selected_features changes (either side of the relation) rebuild the
+  affected compositions' prompts straight away.
+- Editing or deleting a feature clears the prompt of every composition using
+  it with one UPDATE; get_prompt() rebuilds each on its next use.
+
+The cached feature catalogue (see catalogue) is dropped on any save or
+delete of a category or feature.
+"""
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import catalogue
+from .models import FaceComposition, FaceFeature, FaceFeatureCategory
+
+
+@receiver(m2m_changed, sender=FaceComposition.selected_features.through)
+def selected_features_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            instance.refresh_prompt()
+        return
+
+    # feature.facecomposition_set changed: pk_set holds composition ids,
+    # except for clear, where they have to be read before the rows go
+    if action == "pre_clear":
+        instance._cleared_compositions = list(
+            instance.facecomposition_set.values_list("pk", flat=True)
+        )
+    elif action in ("post_add", "post_remove", "post_clear"):
+        if action == "post_clear":
+            pk_set = instance.__dict__.pop("_cleared_compositions", [])
+        for composition in FaceComposition.objects.filter(pk__in=pk_set):
+            composition.refresh_prompt()
+
+
+def _invalidate_prompts(feature):
+    FaceComposition.objects.filter(selected_features=feature).update(
+        cached_prompt=None
+    )
+
+
+@receiver(post_save, sender=FaceFeature)
+def feature_saved(sender, instance, created, **kwargs):
+    if not created:
+        _invalidate_prompts(instance)
+    catalogue.invalidate()
+
+
+@receiver(pre_delete, sender=FaceFeature)
+def feature_deleted(sender, instance, **kwargs):
+    _invalidate_prompts(instance)
+
+
+@receiver(post_delete, sender=FaceFeature)
+@receiver(post_save, sender=FaceFeatureCategory)
+@receiver(post_delete, sender=FaceFeatureCategory)
+def catalogue_changed(sender, **kwargs):
+    catalogue.invalidate()
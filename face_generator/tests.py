@@ -1,3 +1,2257 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+import cv2
+from criminal_face_app import asgi
+import httpx
+import numpy as np
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError, close_old_connections
+from django.test import (
+    AsyncClient,
+    Client,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.utils import timezone
+import requests
+from PIL import Image
+
+from . import (
+    ann_index,
+    bfl_async,
+    bfl_flux,
+    bfl_scheduler,
+    bfl_session,
+    criminal_index,
+    face_matcher,
+    generation_cache,
+    jobs,
+    local_flux,
+    match_shards,
+)
+from .local_flux_server import (
+    MFLUX_VERSION,
+    LocalFluxServer,
+    MfluxBackend,
+    StubBackend,
+)
+from .models import (
+    FaceComposition,
+    FaceFeature,
+    FaceFeatureCategory,
+    GenerationJob,
+    GenerationVersion,
+)
+
+
+class StubBFL:
+    """Local stand-in for the BFL API: submit, get_result and image download"""
+
+    def __init__(self):
+        self.submissions = []
+        self.polls = 0
+        self.status = "Pending"
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (8, 8), "gray").save(buffer, format="PNG")
+        self.image = buffer.getvalue()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, body, content_type="application/json"):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                stub.submissions.append(json.loads(self.rfile.read(length)))
+                task_id = f"task-{len(stub.submissions)}"
+                self.reply(
+                    json.dumps(
+                        {"id": task_id, "polling_url": f"{stub.url}/get_result?id={task_id}"}
+                    ).encode()
+                )
+
+            def do_GET(self):
+                if self.path.endswith("/image"):
+                    return self.reply(stub.image, "image/png")
+                stub.polls += 1
+                self.reply(json.dumps(stub.result(stub.status)).encode())
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def result(self, status):
+        return {"status": status, "result": {"sample": f"{self.url}/image"}}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class BFLWebhookTests(TransactionTestCase):
+    def setUp(self):
+        self.stub = StubBFL()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(self.stub.close)
+        self.addCleanup(shutil.rmtree, self.media, True)
+
+        overrides = override_settings(
+            BFL_API_KEY="test",
+            BFL_WEBHOOK_BASE_URL="http://testserver",
+            MEDIA_ROOT=self.media,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        for patcher in (
+            mock.patch.object(bfl_flux, "BFL_API_BASE", self.stub.url),
+            # Sweeps are driven by the tests, not the background thread
+            mock.patch.object(jobs, "_start_sweeper"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.client = Client(HTTP_HOST="testserver")
+        self.composition = FaceComposition.objects.create()
+        self.job = GenerationJob.objects.create(
+            composition=self.composition,
+            kind="sketch",
+            params={
+                "features_description": "round face",
+                "output_path": os.path.join(self.media, "sketches", "sketch.png"),
+                "user_prompt": "",
+                "reference_image_path": None,
+                "method": "flux_dev",
+            },
+        )
+
+    def submit(self):
+        jobs.run_job(self.job.id)
+        self.job.refresh_from_db()
+        return self.stub.submissions[-1]["webhook_url"]
+
+    def wait_for_job(self, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.job.refresh_from_db()
+            if self.job.status in ("succeeded", "failed"):
+                return
+            time.sleep(0.05)
+        self.fail(f"Job still {self.job.status} after {timeout}s")
+
+    def test_slot_is_freed_when_another_process_completes_the_job(self):
+        self.submit()
+        jobs.release_finished_slots()
+        self.assertIn(self.job.id, bfl_scheduler.held_slots())
+
+        # The webhook landed on another worker process, which finished the job
+        GenerationJob.objects.filter(id=self.job.id).update(
+            status="succeeded", webhook_token=""
+        )
+        jobs.release_finished_slots()
+        self.assertNotIn(self.job.id, bfl_scheduler.held_slots())
+
+    def test_submit_registers_webhook_and_frees_worker(self):
+        webhook_url = self.submit()
+
+        self.assertEqual(self.job.status, "running")
+        self.assertEqual(self.job.bfl_task_id, "task-1")
+        self.assertTrue(
+            webhook_url.startswith(
+                f"http://testserver/api/jobs/{self.job.id}/bfl_webhook/?token="
+            )
+        )
+        self.assertEqual(
+            self.stub.submissions[0]["webhook_secret"], self.job.webhook_token
+        )
+        self.assertEqual(self.stub.polls, 0)
+
+    def test_webhook_finishes_job(self):
+        webhook_url = self.submit()
+
+        response = self.client.post(
+            webhook_url, self.stub.result("SUCCESS"), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 202)
+        self.wait_for_job()
+
+        self.assertEqual(self.job.status, "succeeded")
+        self.assertEqual(self.job.version.version_number, 1)
+        self.assertTrue(os.path.exists(self.job.params["output_path"]))
+        self.assertEqual(self.stub.polls, 0)
+
+        # A repeated notification is refused rather than recording a second version
+        response = self.client.post(
+            webhook_url, self.stub.result("SUCCESS"), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.composition.versions.count(), 1)
+
+    def test_webhook_rejects_wrong_token(self):
+        self.submit()
+
+        response = self.client.post(
+            f"/api/jobs/{self.job.id}/bfl_webhook/?token=forged",
+            self.stub.result("SUCCESS"),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 404)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, "running")
+
+    def test_webhook_reports_failure(self):
+        webhook_url = self.submit()
+
+        response = self.client.post(
+            webhook_url,
+            self.stub.result("Request Moderated"),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 202)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, "failed")
+        self.assertIn("Request Moderated", self.job.error)
+
+    def test_sweeper_polls_jobs_missing_their_webhook(self):
+        webhook_url = self.submit()
+        token = parse_qs(urlparse(webhook_url).query)["token"][0]
+
+        # Not overdue yet: left alone
+        jobs.sweep_webhook_jobs()
+        self.assertEqual(self.stub.polls, 0)
+
+        GenerationJob.objects.filter(id=self.job.id).update(
+            submitted_at=timezone.now() - timedelta(minutes=5)
+        )
+        self.stub.status = "Ready"
+        jobs.sweep_webhook_jobs()
+        self.wait_for_job()
+
+        self.assertEqual(self.job.status, "succeeded")
+        self.assertEqual(self.stub.polls, 1)
+
+        # The late webhook finds the job already complete
+        response = self.client.post(
+            f"/api/jobs/{self.job.id}/bfl_webhook/?token={token}",
+            self.stub.result("SUCCESS"),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class SketchVariantTests(TransactionTestCase):
+    def setUp(self):
+        self.stub = StubBFL()
+        self.stub.status = "Ready"
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(self.stub.close)
+        self.addCleanup(shutil.rmtree, self.media, True)
+
+        overrides = override_settings(
+            BFL_API_KEY="test", BFL_WEBHOOK_BASE_URL="", MEDIA_ROOT=self.media
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        patcher = mock.patch.object(bfl_flux, "BFL_API_BASE", self.stub.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.composition = FaceComposition.objects.create()
+
+    def post_variants(self, client):
+        return client.post(
+            f"/api/compositions/{self.composition.id}/generate_variants/",
+            {"seeds": [11, 22, 33]},
+            content_type="application/json",
+        )
+
+    def assert_sibling_versions(self):
+        self.assertEqual(sorted(s["seed"] for s in self.stub.submissions), [11, 22, 33])
+        versions = self.composition.versions.all()
+        self.assertEqual(len(versions), 3)
+        self.assertEqual({v.parent_version_id for v in versions}, {None})
+        self.assertEqual(
+            sorted(v.prompt_used for v in versions),
+            ["[seed 11] ", "[seed 22] ", "[seed 33] "],
+        )
+
+    def test_variants_are_queued_as_sibling_versions(self):
+        response = self.post_variants(Client())
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "queued")
+        job_ids = [job["id"] for job in response.json()["jobs"]]
+        self.assertEqual(len(job_ids), 3)
+
+        deadline = time.time() + 5
+        jobs_left = GenerationJob.objects.filter(id__in=job_ids).exclude(
+            status__in=("succeeded", "failed")
+        )
+        while jobs_left.exists() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(
+            set(GenerationJob.objects.values_list("status", flat=True)), {"succeeded"}
+        )
+        self.assert_sibling_versions()
+
+    async def test_variants_stream_back_under_asgi(self):
+        response = await self.post_variants(AsyncClient())
+        self.assertEqual(response.status_code, 202)
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        lines = [json.loads(line) for line in body.splitlines()]
+
+        self.assertEqual(lines[0]["status"], "queued")
+        self.assertEqual(len(lines[0]["jobs"]), 3)
+        finished = [line["job"] for line in lines if line["status"] == "finished"]
+        self.assertEqual([job["status"] for job in finished], ["succeeded"] * 3)
+        self.assertEqual(lines[-1], {"status": "done"})
+        await sync_to_async(self.assert_sibling_versions)()
+
+    def test_rejects_too_many_variants(self):
+        response = Client().post(
+            f"/api/compositions/{self.composition.id}/generate_variants/",
+            {"count": 50},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(GenerationJob.objects.exists())
+
+
+class LocalFluxServerTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+
+        socket_path = os.path.join(self.tmp, "flux.sock")
+        self.backend = StubBackend()
+        self.server = LocalFluxServer(socket_path, self.backend)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        patcher = mock.patch.object(local_flux, "SERVER_SOCKET", socket_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_jobs_share_one_loaded_model(self):
+        sketch = os.path.join(self.tmp, "out", "sketch.png")
+        revised = os.path.join(self.tmp, "out", "revised.png")
+        colored = os.path.join(self.tmp, "out", "colored.png")
+
+        with mock.patch.object(local_flux.subprocess, "run") as cli:
+            local_flux.generate_sketch_fast("oval face", sketch)
+            local_flux.revise_sketch("add stubble", sketch, revised)
+            local_flux.colorize_sketch("brown skin", revised, colored)
+        cli.assert_not_called()
+
+        self.assertEqual((self.backend.loads, self.backend.jobs), (1, 3))
+        with Image.open(colored) as image:
+            self.assertEqual(image.size, (1024, 1024))
+
+    def test_server_errors_are_raised(self):
+        failure = mock.patch.object(
+            self.backend, "generate", side_effect=RuntimeError("OOM")
+        )
+        with failure, self.assertRaisesRegex(Exception, "OOM"):
+            local_flux.generate_sketch_fast(
+                "oval face", os.path.join(self.tmp, "sketch.png")
+            )
+
+    def test_falls_back_to_cli_without_server(self):
+        output_path = os.path.join(self.tmp, "sketch.png")
+        missing = os.path.join(self.tmp, "missing.sock")
+
+        def run(cmd, **kwargs):
+            Image.new("RGB", (8, 8)).save(output_path)
+            return mock.Mock(returncode=0)
+
+        no_server = mock.patch.object(local_flux, "SERVER_SOCKET", missing)
+        cli = mock.patch.object(local_flux.subprocess, "run", side_effect=run)
+        with no_server, cli as run_cli:
+            local_flux.generate_sketch_fast("oval face", output_path)
+        self.assertEqual(run_cli.call_args.args[0][0], "mflux-generate-flux2")
+
+
+
+class _FakeFlux2Klein:
+    """Flux2Klein with mflux 0.22.0's signatures, recording each call"""
+
+    calls = []
+
+    def __init__(self, quantize=None, model_path=None, model_config=None):
+        self.calls.append(("load", quantize, model_config))
+
+    def generate_image(
+        self,
+        seed,
+        prompt,
+        num_inference_steps=4,
+        height=1024,
+        width=1024,
+        guidance=1.0,
+        image_path=None,
+        image_strength=None,
+    ):
+        self.calls.append(("generate", prompt, guidance, image_path, image_strength))
+        return mock.Mock()
+
+
+class MfluxBackendTests(SimpleTestCase):
+    def setUp(self):
+        model_config = types.SimpleNamespace(
+            flux2_klein_4b=lambda: "klein-4b", flux2_klein_base_4b=lambda: "base-4b"
+        )
+        modules = {
+            "mflux.models.common.config.model_config": types.SimpleNamespace(
+                ModelConfig=model_config
+            ),
+            "mflux.models.flux2.variants": types.SimpleNamespace(
+                Flux2Klein=_FakeFlux2Klein
+            ),
+        }
+        patcher = mock.patch.dict(sys.modules, modules)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _FakeFlux2Klein.calls = []
+
+    def job(self, model, **extra):
+        return {
+            "prompt": "oval face",
+            "output_path": "out.png",
+            "num_steps": 8,
+            "guidance": 3.5,
+            "width": 1024,
+            "height": 1024,
+            "model": model,
+            "quantize": 4,
+            **extra,
+        }
+
+    def test_refuses_other_mflux_versions(self):
+        with mock.patch("importlib.metadata.version", return_value="0.21.0"):
+            with self.assertRaisesMessage(Exception, f"needs {MFLUX_VERSION}"):
+                MfluxBackend()
+
+    def test_rejects_models_other_than_flux2_klein(self):
+        with mock.patch("importlib.metadata.version", return_value=MFLUX_VERSION):
+            backend = MfluxBackend()
+        with self.assertRaisesMessage(Exception, "Unsupported model"):
+            backend.generate(self.job("schnell"))
+
+    def test_distilled_models_run_at_guidance_one(self):
+        with mock.patch("importlib.metadata.version", return_value=MFLUX_VERSION):
+            backend = MfluxBackend()
+        backend.generate(self.job("flux2-klein-4b"))
+        backend.generate(
+            self.job("flux2-klein-4b", init_image_path="in.png", strength=0.6)
+        )
+        backend.generate(self.job("flux2-klein-base-4b"))
+
+        self.assertEqual(
+            _FakeFlux2Klein.calls,
+            [
+                ("load", 4, "klein-4b"),
+                ("generate", "oval face", 1.0, None, None),
+                ("generate", "oval face", 1.0, "in.png", 0.6),
+                ("load", 4, "base-4b"),
+                ("generate", "oval face", 3.5, None, None),
+            ],
+        )
+        self.assertEqual(backend.loads, 2)
+
+class AllHistoryTests(TestCase):
+    def add_compositions(self, count, versions=2):
+        for _ in range(count):
+            composition = FaceComposition.objects.create()
+            for number in range(1, versions + 1):
+                GenerationVersion.objects.create(
+                    composition=composition,
+                    version_number=number,
+                    image_type="sketch",
+                    image=f"sketches/{composition.id}_{number}.png",
+                )
+
+    def get_page(self, url="/api/compositions/all_history/?page_size=5"):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_query_count_does_not_grow_with_archive(self):
+        self.add_compositions(3)
+        with self.assertNumQueries(2):
+            self.get_page()
+
+        self.add_compositions(30, versions=5)
+        with self.assertNumQueries(2):
+            page = self.get_page()
+        self.assertEqual(len(page["results"]), 5)
+        self.assertEqual(len(page["results"][0]["versions"]), 5)
+
+    def test_pages_skip_empty_compositions(self):
+        self.add_compositions(4)
+        FaceComposition.objects.create()  # never generated anything
+        self.add_compositions(3)
+
+        seen = []
+        url = "/api/compositions/all_history/?page_size=5"
+        while url:
+            page = self.get_page(url)
+            seen.extend(comp["id"] for comp in page["results"])
+            url = page["next"]
+
+        expected = FaceComposition.objects.filter(versions__isnull=False).distinct()
+        self.assertEqual(seen, sorted((c.id for c in expected), reverse=True))
+        self.assertEqual(
+            set(page["results"][0]["versions"][0]),
+            {"id", "version_number", "image_type", "image", "prompt_used", "created_at"},
+        )
+
+
+class CompositionQueryTests(TestCase):
+    def setUp(self):
+        category = FaceFeatureCategory.objects.create(name="Eyes")
+        self.features = [
+            FaceFeature.objects.create(
+                category=category,
+                name=f"Feature {i}",
+                description="",
+                prompt_text=f"trait {i}",
+                order=i,
+            )
+            for i in range(3)
+        ]
+
+    def add_compositions(self, count):
+        for _ in range(count):
+            composition = FaceComposition.objects.create()
+            composition.selected_features.set(self.features[:2])
+            GenerationVersion.objects.create(
+                composition=composition,
+                version_number=1,
+                image_type="sketch",
+                image="sketches/s.png",
+            )
+
+    def test_list_and_detail_queries_are_constant(self):
+        self.add_compositions(2)
+        with self.assertNumQueries(3):
+            self.client.get("/api/compositions/")
+
+        self.add_compositions(20)
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/compositions/")
+        self.assertEqual(len(response.json()), 22)
+        self.assertEqual(response.json()[0]["prompt"], "trait 0, trait 1")
+
+        composition_id = response.json()[0]["id"]
+        with self.assertNumQueries(3):
+            self.client.get(f"/api/compositions/{composition_id}/")
+
+    def test_prompt_follows_selected_features(self):
+        composition = FaceComposition.objects.create()
+        self.assertEqual(composition.get_prompt(), "")
+
+        composition.selected_features.add(self.features[0], self.features[2])
+        self.assertEqual(composition.cached_prompt, "trait 0, trait 2")
+
+        composition.selected_features.remove(self.features[0])
+        composition.refresh_from_db()
+        self.assertEqual(composition.cached_prompt, "trait 2")
+
+        # Changed from the feature's side of the relation
+        self.features[1].facecomposition_set.add(composition)
+        composition.refresh_from_db()
+        self.assertEqual(composition.cached_prompt, "trait 1, trait 2")
+
+        self.features[2].facecomposition_set.clear()
+        composition.refresh_from_db()
+        self.assertEqual(composition.cached_prompt, "trait 1")
+
+    def test_editing_a_feature_invalidates_prompts(self):
+        composition = FaceComposition.objects.create()
+        composition.selected_features.set(self.features[:2])
+
+        self.features[0].prompt_text = "hooded eyes"
+        self.features[0].save()
+        composition.refresh_from_db()
+        self.assertIsNone(composition.cached_prompt)
+        self.assertEqual(composition.get_prompt(), "hooded eyes, trait 1")
+
+        self.features[1].delete()
+        composition.refresh_from_db()
+        self.assertEqual(composition.get_prompt(), "hooded eyes")
+
+    def test_saving_a_stale_instance_keeps_the_prompt_invalidated(self):
+        composition = FaceComposition.objects.create()
+        composition.selected_features.set(self.features[:2])
+        stale = FaceComposition.objects.get(id=composition.id)
+
+        self.features[0].prompt_text = "hooded eyes"
+        self.features[0].save()
+        stale.user_prompt = "scar on left cheek"
+        stale.save()
+
+        composition.refresh_from_db()
+        self.assertEqual(composition.user_prompt, "scar on left cheek")
+        self.assertIsNone(composition.cached_prompt)
+        self.assertEqual(composition.get_prompt(), "hooded eyes, trait 1")
+
+
+class CatalogueTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = FaceFeatureCategory.objects.create(name="Eyes")
+        self.feature = FaceFeature.objects.create(
+            category=self.category,
+            name="Hooded",
+            description="",
+            prompt_text="hooded eyes",
+        )
+
+    def test_catalogue_is_cached_and_revalidated(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/categories/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["features"][0]["name"], "Hooded")
+        self.assertTrue(response["ETag"].startswith('"'))
+        self.assertIn("Last-Modified", response)
+
+        with self.assertNumQueries(0):
+            cached = self.client.get("/api/categories/")
+        self.assertEqual(cached.content, response.content)
+
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(
+                "/api/categories/", HTTP_IF_NONE_MATCH=response["ETag"]
+            )
+        self.assertEqual(not_modified.status_code, 304)
+
+        not_modified = self.client.get(
+            "/api/categories/", HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+        )
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_edits_invalidate_the_catalogue(self):
+        etag = self.client.get("/api/categories/")["ETag"]
+
+        self.feature.name = "Deep-set"
+        self.feature.save()
+        response = self.client.get("/api/categories/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["features"][0]["name"], "Deep-set")
+
+        etag = response["ETag"]
+        FaceFeatureCategory.objects.create(name="Nose")
+        response = self.client.get("/api/categories/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.json()), 2)
+
+        FaceFeature.objects.all().delete()
+        self.assertEqual(self.client.get("/api/categories/").json()[0]["features"], [])
+
+
+class VersionNumberingTests(TransactionTestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, True)
+        overrides = override_settings(MEDIA_ROOT=self.media)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def save_versions(self, composition, count):
+        try:
+            for _ in range(count):
+                jobs.save_version(
+                    composition, os.path.join(self.media, "v.png"), "revision", ""
+                )
+        finally:
+            close_old_connections()
+
+    def run_workers(self, targets):
+        errors = []
+
+        def work(composition, count):
+            try:
+                self.save_versions(composition, count)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=args) for args in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def numbers(self, composition):
+        return list(
+            composition.versions.order_by("version_number").values_list(
+                "version_number", flat=True
+            )
+        )
+
+    def test_concurrent_workers_get_distinct_gapless_numbers(self):
+        composition = FaceComposition.objects.create()
+        self.run_workers([(composition, 10)] * 8)
+
+        self.assertEqual(self.numbers(composition), list(range(1, 81)))
+        composition.refresh_from_db()
+        self.assertEqual(composition.last_version_number, 80)
+
+    def test_compositions_number_independently(self):
+        first = FaceComposition.objects.create()
+        second = FaceComposition.objects.create()
+        self.run_workers([(first, 5), (second, 5)] * 3)
+
+        self.assertEqual(self.numbers(first), list(range(1, 16)))
+        self.assertEqual(self.numbers(second), list(range(1, 16)))
+
+    def test_full_save_of_a_loaded_composition_keeps_the_counter(self):
+        composition = FaceComposition.objects.create()
+        loaded = FaceComposition.objects.get(id=composition.id)
+        self.save_versions(loaded, 1)
+
+        loaded.additional_notes = "seen near the station"
+        loaded.save()
+        self.save_versions(loaded, 1)
+
+        # ...and through restore_version, which saves the whole composition
+        version = composition.versions.first()
+        response = self.client.post(
+            f"/api/compositions/{composition.id}/restore/{version.id}/"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.save_versions(loaded, 1)
+
+        self.assertEqual(self.numbers(composition), [1, 2, 3])
+
+    def test_failed_save_leaves_no_gap(self):
+        composition = FaceComposition.objects.create()
+        with mock.patch.object(
+            GenerationVersion, "save", side_effect=IntegrityError("disk full")
+        ), self.assertRaises(IntegrityError):
+            self.save_versions(composition, 1)
+
+        self.save_versions(composition, 2)
+        self.assertEqual(self.numbers(composition), [1, 2])
+
+    def test_duplicate_numbers_are_rejected(self):
+        composition = FaceComposition.objects.create()
+        self.save_versions(composition, 1)
+        with self.assertRaises(IntegrityError):
+            GenerationVersion.objects.create(
+                composition=composition, version_number=1, image_type="sketch"
+            )
+
+
+def _reference_ssim(gray_a, gray_b):
+    """SSIM of one pair with five cv2.GaussianBlur passes (the per-pair original)"""
+    img1 = gray_a.astype(np.float32)
+    img2 = gray_b.astype(np.float32)
+    window = (face_matcher.SSIM_KERNEL_SIZE, face_matcher.SSIM_KERNEL_SIZE)
+    sigma = face_matcher.SSIM_SIGMA
+
+    mu1 = cv2.GaussianBlur(img1, window, sigma)
+    mu2 = cv2.GaussianBlur(img2, window, sigma)
+    mu1_sq, mu2_sq, mu1_mu2 = mu1 * mu1, mu2 * mu2, mu1 * mu2
+    sigma1_sq = cv2.GaussianBlur(img1 * img1, window, sigma) - mu1_sq
+    sigma2_sq = cv2.GaussianBlur(img2 * img2, window, sigma) - mu2_sq
+    sigma12 = cv2.GaussianBlur(img1 * img2, window, sigma) - mu1_mu2
+
+    ssim_map = (
+        (2 * mu1_mu2 + face_matcher.SSIM_C1) * (2 * sigma12 + face_matcher.SSIM_C2)
+    ) / (
+        (mu1_sq + mu2_sq + face_matcher.SSIM_C1)
+        * (sigma1_sq + sigma2_sq + face_matcher.SSIM_C2)
+    )
+    return max(0.0, min(1.0, float(np.mean(ssim_map))))
+
+
+def _random_faces(count, seed=0):
+    """Smooth random grayscale images at SSIM_SIZE, with their histograms"""
+    rng = np.random.default_rng(seed)
+    size = face_matcher.SSIM_SIZE
+    criminals = {}
+    for i in range(count):
+        noise = rng.integers(0, 256, (size // 8, size // 8, 3), dtype=np.uint8)
+        img = cv2.resize(noise, (size, size), interpolation=cv2.INTER_CUBIC)
+        criminals[f"c{i}"] = {
+            "filename": f"c{i}.png",
+            "histogram": face_matcher._compute_face_histogram(img),
+            "gray_image": face_matcher._load_grayscale_structural_image(img),
+        }
+    return criminals
+
+
+class VectorizedSSIMTests(SimpleTestCase):
+    def test_batched_scores_match_per_pair_ssim(self):
+        criminals = _random_faces(40)
+        gallery = face_matcher._build_gallery(criminals)
+
+        # A near-duplicate of one entry, so scores span low to high
+        query = criminals["c3"]["gray_image"].astype(np.int16)
+        query += np.random.default_rng(1).integers(-20, 21, query.shape, dtype=np.int16)
+        query = np.clip(query, 0, 255).astype(np.uint8)
+
+        with mock.patch.object(face_matcher, "MATCH_CHUNK_SIZE", 16):
+            scores = face_matcher._batch_ssim_scores(query, gallery)
+
+        expected = [
+            _reference_ssim(query, criminals[cid]["gray_image"]) for cid in gallery["ids"]
+        ]
+        np.testing.assert_allclose(scores, expected, rtol=0, atol=1e-6)
+        self.assertGreater(max(expected), 0.5)
+
+    def test_histogram_scores_match_compare_hist(self):
+        criminals = _random_faces(10)
+        gallery = face_matcher._build_gallery(criminals)
+        query = criminals["c0"]["histogram"]
+
+        scores = face_matcher._batch_hist_scores(query, gallery)
+
+        expected = [
+            cv2.compareHist(query, criminals[cid]["histogram"], cv2.HISTCMP_CORREL)
+            for cid in gallery["ids"]
+        ]
+        np.testing.assert_allclose(scores, expected, rtol=0, atol=1e-5)
+
+
+def _with_ivf(gallery):
+    """Add the IVF arrays criminal_index would persist to an in-memory gallery"""
+    descriptors = gallery["descriptor"]
+    centroids = ann_index.train_ivf(
+        descriptors, ann_index.default_nlist(len(descriptors))
+    )
+    order, offsets = ann_index.assign_ivf(descriptors, centroids)
+    return {
+        **gallery,
+        "ivf_centroids": centroids,
+        "ivf_order": order,
+        "ivf_offsets": offsets,
+    }
+
+
+class AnnIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(20, 32))
+        points = np.repeat(centers, 100, axis=0) + 0.5 * rng.normal(size=(2000, 32))
+        self.descriptors = ann_index._normalize(points)
+        self.queries = ann_index._normalize(
+            self.descriptors[rng.choice(2000, 50, replace=False)]
+            + 0.1 * rng.normal(size=(50, 32))
+        )
+        self.centroids = ann_index.train_ivf(
+            self.descriptors, ann_index.default_nlist(2000)
+        )
+        self.order, self.offsets = ann_index.assign_ivf(
+            self.descriptors, self.centroids
+        )
+
+    def exact(self, query, k):
+        return np.argsort(-(self.descriptors @ query), kind="stable")[:k]
+
+    def search(self, query, k, nprobe):
+        return ann_index.search_ivf(
+            query,
+            self.descriptors,
+            self.centroids,
+            self.order,
+            self.offsets,
+            k=k,
+            nprobe=nprobe,
+        )
+
+    def test_clusters_cover_every_row_once(self):
+        self.assertEqual(sorted(self.order), list(range(2000)))
+        self.assertEqual(self.offsets[-1], 2000)
+        self.assertEqual(len(self.offsets), len(self.centroids) + 1)
+
+    def test_recall_against_exhaustive_search(self):
+        found = 0
+        for query in self.queries:
+            found += len(set(self.search(query, 10, 4)) & set(self.exact(query, 10)))
+        self.assertGreaterEqual(found / (10 * len(self.queries)), 0.9)
+
+    def test_probing_every_cluster_is_exact(self):
+        for query in self.queries:
+            np.testing.assert_array_equal(
+                self.search(query, 10, len(self.centroids)), self.exact(query, 10)
+            )
+
+    def test_matching_reports_the_ann_stage(self):
+        criminals = _random_faces(60)
+        gallery = _with_ivf(face_matcher._build_gallery(criminals))
+        hist = criminals["c7"]["histogram"]
+        gray = criminals["c7"]["gray_image"]
+        options = {"top_k": 3, "nprobe": 2, "cascade": "none", "cascade_keep": 10}
+
+        with mock.patch.object(face_matcher, "ANN_MIN_GALLERY", 10):
+            matches, stages = face_matcher._match_features(
+                hist, gray, gallery, shortlist=20, **options
+            )
+            exhaustive, exhaustive_stages = face_matcher._match_features(
+                hist, gray, gallery, shortlist=60, **options
+            )
+
+        self.assertEqual(stages[0]["stage"], "ann")
+        self.assertEqual(
+            (stages[0]["candidates"], stages[0]["kept"], stages[0]["pruned"]),
+            (60, 20, 40),
+        )
+        # A shortlist covering the gallery skips the index
+        self.assertEqual([stage["stage"] for stage in exhaustive_stages], ["ssim"])
+        self.assertEqual(matches[0]["filename"], "c7.png")
+        self.assertEqual(matches[0], exhaustive[0])
+
+
+def _graded_faces(count, seed=0):
+    """
+    Copies of one face blended with more and more noise, so every score
+    ranks them in order: c0 (the face itself) first
+    """
+    rng = np.random.default_rng(seed)
+    size = face_matcher.SSIM_SIZE
+
+    def smooth_noise():
+        noise = rng.integers(0, 256, (size // 8, size // 8, 3), dtype=np.uint8)
+        return cv2.resize(noise, (size, size), interpolation=cv2.INTER_CUBIC)
+
+    face = smooth_noise().astype(np.float32)
+    criminals = {}
+    for i in range(count):
+        weight = i / count
+        img = ((1 - weight) * face + weight * smooth_noise()).astype(np.uint8)
+        criminals[f"c{i}"] = {
+            "filename": f"c{i}.png",
+            "histogram": face_matcher._compute_face_histogram(img),
+            "gray_image": face_matcher._load_grayscale_structural_image(img),
+        }
+    return criminals
+
+
+class CascadeTests(SimpleTestCase):
+    def setUp(self):
+        self.criminals = _graded_faces(30)
+        self.gallery = face_matcher._build_gallery(self.criminals)
+        self.query = (
+            self.criminals["c0"]["histogram"],
+            self.criminals["c0"]["gray_image"],
+        )
+
+    def match(self, cascade, top_k=5, cascade_keep=8):
+        return face_matcher._match_features(
+            *self.query,
+            self.gallery,
+            top_k=top_k,
+            shortlist=face_matcher.ANN_SHORTLIST,
+            nprobe=face_matcher.ANN_NPROBE,
+            cascade=cascade,
+            cascade_keep=cascade_keep,
+        )
+
+    def test_pruned_ranking_matches_the_full_ranking(self):
+        full, _ = self.match("none")
+        self.assertEqual([m["filename"] for m in full], [f"c{i}.png" for i in range(5)])
+
+        for cascade in ("histogram", "ssim32"):
+            matches, stages = self.match(cascade)
+            self.assertEqual([stage["stage"] for stage in stages], [cascade, "ssim"])
+            self.assertEqual(stages[0]["pruned"], 22)
+            self.assertEqual(
+                [m["filename"] for m in matches], [m["filename"] for m in full]
+            )
+            np.testing.assert_allclose(
+                [m["similarity"] for m in matches],
+                [m["similarity"] for m in full],
+                rtol=0,
+                atol=1e-6,
+            )
+
+    def test_stage_counts_add_up(self):
+        for cascade, cascade_keep in (("histogram", 8), ("ssim32", 8), ("ssim32", 2)):
+            matches, stages = self.match(cascade, cascade_keep=cascade_keep)
+
+            self.assertEqual(stages[0]["candidates"], 30)
+            for stage in stages:
+                self.assertEqual(stage["candidates"] - stage["kept"], stage["pruned"])
+            for before, after in zip(stages, stages[1:]):
+                self.assertEqual(before["kept"], after["candidates"])
+            # At least top_k survive the coarse stage
+            self.assertEqual(stages[0]["kept"], max(cascade_keep, 5))
+            self.assertEqual(stages[-1]["kept"], len(matches))
+            self.assertEqual(len(matches), 5)
+
+    def test_small_galleries_skip_the_coarse_stage(self):
+        _, stages = self.match("ssim32", cascade_keep=30)
+        self.assertEqual([stage["stage"] for stage in stages], ["ssim"])
+
+
+def _write_face(path, seed):
+    """A small random color image standing in for a criminal DB photo"""
+    noise = np.random.default_rng(seed).integers(0, 256, (16, 16, 3), dtype=np.uint8)
+    cv2.imwrite(path, cv2.resize(noise, (64, 64), interpolation=cv2.INTER_CUBIC))
+
+
+class CriminalIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.db = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db, True)
+        for seed in range(3):
+            _write_face(os.path.join(self.db, f"A{seed}.png"), seed)
+
+    def index_dirs(self):
+        return sorted(
+            name for name in os.listdir(self.db) if name.startswith(".index-")
+        )
+
+    def test_publish_swaps_one_symlink_and_keeps_old_mappings_valid(self):
+        old = criminal_index.build_index(self.db, workers=1)
+        old_ids = list(old["ids"])
+
+        _write_face(os.path.join(self.db, "A3.png"), 3)
+        new, _ = criminal_index.sync_index(self.db, workers=1)
+
+        self.assertTrue(os.path.islink(criminal_index.index_dir(self.db)))
+        self.assertEqual(self.index_dirs(), [f".index-{new['version']}"])
+        self.assertNotEqual(new["version"], old["version"])
+        # The previous directory is gone, but its mapped arrays still read
+        self.assertEqual(list(old["ids"]), old_ids)
+        self.assertEqual(old["gray"].shape[0], 3)
+        self.assertEqual(criminal_index.load_index(self.db)["version"], new["version"])
+
+    def test_load_retries_when_a_publish_removes_its_directory(self):
+        criminal_index.build_index(self.db, workers=1)
+        load_dir = criminal_index._load_index_dir
+        calls = []
+
+        def publish_midway(*args):
+            # Another process publishes between resolving and reading
+            if not calls:
+                calls.append(args[1])
+                criminal_index.build_index(self.db, workers=1)
+            return load_dir(*args)
+
+        with mock.patch.object(criminal_index, "_load_index_dir", publish_midway):
+            gallery = criminal_index.load_index(self.db)
+
+        self.assertIsNotNone(gallery)
+        self.assertFalse(os.path.exists(calls[0]))
+        self.assertEqual(self.index_dirs(), [f".index-{gallery['version']}"])
+
+    def test_replaces_a_pre_symlink_index_directory(self):
+        legacy = criminal_index.index_dir(self.db)
+        os.makedirs(legacy)
+        with open(os.path.join(legacy, "manifest.json"), "w") as f:
+            json.dump({"format": 6}, f)
+
+        self.assertIsNone(criminal_index.load_index(self.db))
+        gallery, _ = criminal_index.sync_index(self.db, workers=1)
+
+        self.assertTrue(os.path.islink(legacy))
+        self.assertEqual(len(gallery["ids"]), 3)
+
+    def test_plain_loads_skip_the_per_file_stats(self):
+        criminal_index.build_index(self.db, workers=1)
+        path = os.path.realpath(criminal_index.index_dir(self.db))
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.assertNotIn("files", json.load(f))
+
+        with mock.patch.object(criminal_index, "_read_files") as read_files:
+            self.assertIsNotNone(criminal_index.load_index(self.db))
+            read_files.assert_not_called()
+
+        os.utime(os.path.join(self.db, "A0.png"), ns=(1, 1))
+        self.assertIsNone(criminal_index.load_index(self.db))
+        files = criminal_index.load_index(self.db, check_stale=False, with_files=True)[
+            "files"
+        ]
+        self.assertEqual(sorted(files), ["A0.png", "A1.png", "A2.png"])
+
+    def test_sync_decodes_only_added_and_modified_images(self):
+        base = criminal_index.build_index(self.db, workers=1)
+        rows = dict(zip(base["filenames"], np.array(base["gray"])))
+
+        _write_face(os.path.join(self.db, "A3.png"), 3)
+        _write_face(os.path.join(self.db, "A1.png"), 11)
+        os.remove(os.path.join(self.db, "A2.png"))
+        # Touched but identical: rehashed, not re-decoded
+        os.utime(os.path.join(self.db, "A0.png"), ns=(1, 1))
+
+        with mock.patch.object(
+            criminal_index, "_compute_features", wraps=criminal_index._compute_features
+        ) as compute:
+            gallery, summary = criminal_index.sync_index(self.db, workers=1)
+
+        self.assertEqual(
+            sorted(os.path.basename(call.args[0]) for call in compute.call_args_list),
+            ["A1.png", "A3.png"],
+        )
+        self.assertEqual(
+            summary,
+            {
+                "added": ["A3.png"],
+                "modified": ["A1.png"],
+                "removed": ["A2.png"],
+                "unchanged": ["A0.png"],
+            },
+        )
+        self.assertEqual(sorted(gallery["filenames"]), ["A0.png", "A1.png", "A3.png"])
+
+        synced = dict(zip(gallery["filenames"], gallery["gray"]))
+        np.testing.assert_array_equal(synced["A0.png"], rows["A0.png"])
+        self.assertFalse(np.array_equal(synced["A1.png"], rows["A1.png"]))
+        self.assertIsNotNone(criminal_index.load_index(self.db))
+
+    def test_unchanged_folder_syncs_without_a_new_version(self):
+        base = criminal_index.build_index(self.db, workers=1)
+        gallery, summary = criminal_index.sync_index(self.db, workers=1)
+
+        self.assertEqual(gallery["version"], base["version"])
+        self.assertEqual(len(summary["unchanged"]), 3)
+
+
+class _ThreadPool(ThreadPoolExecutor):
+    """ProcessPoolExecutor stand-in whose workers share the test's patches"""
+
+    def __init__(self, max_workers, mp_context=None, initializer=None):
+        super().__init__(max_workers=max_workers)
+
+
+class ParallelDecodeTests(SimpleTestCase):
+    def setUp(self):
+        self.db = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db, True)
+        for seed in range(10):
+            _write_face(os.path.join(self.db, f"A{seed}.png"), seed)
+        with open(os.path.join(self.db, "broken.png"), "wb") as f:
+            f.write(b"not an image")
+        self.filenames = sorted(os.listdir(self.db))
+
+        for name, value in (("MIN_PARALLEL_FILES", 4), ("INDEX_CHUNK_SIZE", 3)):
+            patcher = mock.patch.object(criminal_index, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_pool_decodes_each_image_once(self):
+        with mock.patch.object(
+            criminal_index, "ProcessPoolExecutor", _ThreadPool
+        ), mock.patch.object(cv2, "imread", wraps=cv2.imread) as imread:
+            criminals = criminal_index.load_criminal_images(
+                self.db, self.filenames, workers=3
+            )
+
+        decoded = sorted(os.path.basename(c.args[0]) for c in imread.call_args_list)
+        self.assertEqual(decoded, self.filenames)
+        # Ordered like the filenames, unreadable images left out
+        self.assertEqual(
+            [c["filename"] for c in criminals.values()], self.filenames[:10]
+        )
+
+    def test_process_pool_matches_in_process_decoding(self):
+        pooled = criminal_index.load_criminal_images(self.db, self.filenames, workers=2)
+        in_process = criminal_index.load_criminal_images(
+            self.db, self.filenames, workers=1
+        )
+
+        self.assertEqual(list(pooled), list(in_process))
+        for cid, criminal in in_process.items():
+            for name in ("histogram", "gray_image"):
+                np.testing.assert_array_equal(pooled[cid][name], criminal[name])
+
+
+class ShardPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.db = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db, True)
+        for seed in range(6):
+            _write_face(os.path.join(self.db, f"A{seed}.png"), seed)
+        self.gallery = criminal_index.build_index(self.db, workers=1)
+
+    def test_shards_match_like_one_process_without_touching_our_env(self):
+        seen = []
+        start = multiprocessing.context.SpawnProcess.start
+
+        def record_env(process):
+            seen.append(os.environ.get("OMP_NUM_THREADS"))
+            start(process)
+
+        parent_value = os.environ.get("OMP_NUM_THREADS")
+        with mock.patch.object(multiprocessing.context.SpawnProcess, "start", record_env):
+            pool = match_shards.ShardPool(self.db, 2)
+        self.addCleanup(pool.close)
+        self.assertEqual(seen, [parent_value, parent_value])
+
+        hist, gray = face_matcher._compute_features(os.path.join(self.db, "A4.png"))
+        options = {
+            "shortlist": face_matcher.ANN_SHORTLIST,
+            "nprobe": face_matcher.ANN_NPROBE,
+            "cascade": "none",
+            "cascade_keep": face_matcher.CASCADE_KEEP,
+        }
+        matches, stages = pool.match(
+            hist, gray, self.gallery["version"], top_k=3, **options
+        )
+        expected, _ = face_matcher._match_features(
+            hist, gray, self.gallery, top_k=3, **options
+        )
+
+        self.assertEqual(
+            [m["filename"] for m in matches], [m["filename"] for m in expected]
+        )
+        self.assertEqual(matches[0]["filename"], "A4.png")
+        self.assertEqual(stages[-1]["stage"], "merge")
+
+    def test_worker_refuses_to_answer_from_another_index_version(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        threads = cv2.getNumThreads()
+        self.addCleanup(cv2.setNumThreads, threads)
+        with mock.patch.dict(os.environ):
+            worker = threading.Thread(
+                target=match_shards._shard_worker, args=(child_conn, self.db, 0, 1)
+            )
+            worker.start()
+            hist, gray = face_matcher._compute_features(os.path.join(self.db, "A4.png"))
+            options = {
+                "top_k": 3,
+                "shortlist": face_matcher.ANN_SHORTLIST,
+                "nprobe": face_matcher.ANN_NPROBE,
+                "cascade": "none",
+                "cascade_keep": face_matcher.CASCADE_KEEP,
+            }
+
+            parent_conn.send((hist, gray, "0" * 32, options))
+            status, error = parent_conn.recv()
+            self.assertEqual(status, "error")
+            self.assertIn("not 00000000", error)
+
+            parent_conn.send((hist, gray, self.gallery["version"], options))
+            status, (matches, _) = parent_conn.recv()
+            self.assertEqual(status, "ok")
+            self.assertEqual(matches[0]["filename"], "A4.png")
+
+            parent_conn.send(None)
+            worker.join(timeout=5)
+
+
+class RequestValidationTests(TestCase):
+    def test_match_batch_rejects_non_integer_ids(self):
+        for body in (
+            {"composition_ids": ["abc"]},
+            {"composition_ids": [1, None]},
+            {"version_ids": [True]},
+            {"version_ids": "1,2"},
+        ):
+            response = Client().post(
+                "/api/compositions/match_batch/", body, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 400, body)
+
+    def test_variants_reject_bad_seeds(self):
+        composition = FaceComposition.objects.create()
+        for seeds in ([True, 2], [3, 3], [-1], [2**32], [1.5], [[1]]):
+            response = Client().post(
+                f"/api/compositions/{composition.id}/generate_variants/",
+                {"seeds": seeds},
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 400, seeds)
+        self.assertFalse(GenerationJob.objects.exists())
+
+    def test_jobs_filter_rejects_non_integer_composition(self):
+        composition = FaceComposition.objects.create()
+        GenerationJob.objects.create(composition=composition, kind="sketch")
+
+        self.assertEqual(Client().get("/api/jobs/?composition=abc").status_code, 400)
+        response = Client().get(f"/api/jobs/?composition={composition.id}")
+        self.assertEqual(response.status_code, 200)
+
+
+class MatchCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.db = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db, True)
+        for seed in range(4):
+            _write_face(os.path.join(self.db, f"A{seed}.png"), seed)
+        self.query = os.path.join(tempfile.mkdtemp(), "query.png")
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.query), True)
+        shutil.copy(os.path.join(self.db, "A2.png"), self.query)
+
+        face_matcher.clear_cache()
+        self.addCleanup(face_matcher.clear_cache)
+
+    def test_repeat_queries_hit_the_caches(self):
+        matches, stats = face_matcher.match_face_with_stats(self.query, self.db, top_k=2)
+        self.assertFalse(stats["cached"])
+        self.assertEqual(matches[0]["filename"], "A2.png")
+
+        # Same bytes under another name: features and result both cached
+        copy = f"{self.query}.copy.png"
+        shutil.copy(self.query, copy)
+        with mock.patch.object(cv2, "imdecode", wraps=cv2.imdecode) as decode:
+            cached, stats = face_matcher.match_face_with_stats(copy, self.db, top_k=2)
+        decode.assert_not_called()
+        self.assertTrue(stats["cached"])
+        self.assertEqual(cached, matches)
+
+        # Callers may annotate what they get back without touching the cache
+        cached[0]["similarity"] = -1
+        again, _ = face_matcher.match_face_with_stats(self.query, self.db, top_k=2)
+        self.assertEqual(again, matches)
+
+        info = face_matcher.cache_info()
+        self.assertEqual(info["features"]["hits"], 2)
+        self.assertEqual(info["results"]["hits"], 2)
+
+        # Different options are a different result
+        _, stats = face_matcher.match_face_with_stats(self.query, self.db, top_k=3)
+        self.assertFalse(stats["cached"])
+
+    def test_reindexing_invalidates_cached_results(self):
+        face_matcher.match_face_with_stats(self.query, self.db, top_k=5)
+
+        _write_face(os.path.join(self.db, "A9.png"), 9)
+        face_matcher.refresh_cache(self.db)
+        matches, stats = face_matcher.match_face_with_stats(self.query, self.db, top_k=5)
+
+        self.assertFalse(stats["cached"])
+        self.assertIn("A9.png", [m["filename"] for m in matches])
+
+    def test_picks_up_an_index_published_by_another_process(self):
+        face_matcher.match_face_with_stats(self.query, self.db, top_k=5)
+
+        # As if build_criminal_index ran elsewhere
+        _write_face(os.path.join(self.db, "A9.png"), 9)
+        criminal_index.build_index(self.db)
+        matches, stats = face_matcher.match_face_with_stats(self.query, self.db, top_k=5)
+
+        self.assertFalse(stats["cached"])
+        self.assertIn("A9.png", [m["filename"] for m in matches])
+
+    def test_rechecks_the_folder_after_the_check_interval(self):
+        face_matcher.match_face_with_stats(self.query, self.db, top_k=5)
+        _write_face(os.path.join(self.db, "A9.png"), 9)
+
+        matches, _ = face_matcher.match_face_with_stats(self.query, self.db, top_k=5)
+        self.assertNotIn("A9.png", [m["filename"] for m in matches])
+
+        with mock.patch.object(face_matcher, "GALLERY_CHECK_INTERVAL", 0):
+            matches, _ = face_matcher.match_face_with_stats(
+                self.query, self.db, top_k=5
+            )
+        self.assertIn("A9.png", [m["filename"] for m in matches])
+
+
+class BatchMatchTests(SimpleTestCase):
+    def setUp(self):
+        self.db = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db, True)
+        for seed in range(12):
+            _write_face(os.path.join(self.db, f"A{seed}.png"), seed)
+
+        queries = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queries, True)
+        self.queries = []
+        for name in ("A1", "A5", "A9"):
+            path = os.path.join(queries, f"{name}.png")
+            shutil.copy(os.path.join(self.db, f"{name}.png"), path)
+            self.queries.append(path)
+        self.queries.append(os.path.join(queries, "other.png"))
+        _write_face(self.queries[-1], 99)
+        self.queries.append(os.path.join(queries, "unreadable.png"))
+        with open(self.queries[-1], "wb") as f:
+            f.write(b"not an image")
+
+        face_matcher.clear_cache()
+        self.addCleanup(face_matcher.clear_cache)
+
+    def assert_batch_matches_single_queries(self, **options):
+        expected = [
+            face_matcher.match_face_with_stats(path, self.db, top_k=3, **options)[0]
+            for path in self.queries
+        ]
+        face_matcher.clear_cache()
+
+        results, stats = face_matcher.match_faces_batch_with_stats(
+            self.queries, self.db, top_k=3, **options
+        )
+
+        self.assertEqual((stats["cached"], stats["unreadable"]), (0, 1))
+        for got, want in zip(results, expected):
+            self.assertEqual(
+                [m["filename"] for m in got], [m["filename"] for m in want], options
+            )
+            np.testing.assert_allclose(
+                [m["similarity"] for m in got],
+                [m["similarity"] for m in want],
+                rtol=0,
+                atol=1e-6,
+            )
+        return stats
+
+    def test_batch_matches_single_queries(self):
+        for cascade in face_matcher.CASCADE_MODES:
+            self.assert_batch_matches_single_queries(cascade=cascade, cascade_keep=4)
+
+    def test_batch_matches_single_queries_through_the_ann_index(self):
+        with mock.patch.object(face_matcher, "ANN_MIN_GALLERY", 4):
+            for cascade in face_matcher.CASCADE_MODES:
+                stats = self.assert_batch_matches_single_queries(
+                    shortlist=6, nprobe=1, cascade=cascade, cascade_keep=4
+                )
+                self.assertEqual(stats["stages"][0]["stage"], "ann")
+
+
+class StaleJobTests(TestCase):
+    def setUp(self):
+        composition = FaceComposition.objects.create()
+        long_ago = timezone.now() - timedelta(seconds=jobs.STALE_JOB_TIMEOUT + 60)
+
+        def job(**fields):
+            return GenerationJob.objects.create(
+                composition=composition, kind="sketch", status="running", **fields
+            )
+
+        self.orphan = job(started_at=long_ago)
+        self.recent = job(started_at=timezone.now())
+        self.webhook = job(started_at=long_ago, webhook_token="token")
+
+    def statuses(self):
+        return {
+            name: GenerationJob.objects.get(id=getattr(self, name).id).status
+            for name in ("orphan", "recent", "webhook")
+        }
+
+    def test_starting_the_runner_fails_orphaned_jobs(self):
+        with mock.patch.object(jobs, "_executor", None), mock.patch.object(
+            jobs, "ThreadPoolExecutor"
+        ):
+            jobs._get_executor()
+
+        self.assertEqual(
+            self.statuses(),
+            {"orphan": "failed", "recent": "running", "webhook": "running"},
+        )
+        self.assertIn("no result", GenerationJob.objects.get(id=self.orphan.id).error)
+
+    def test_polling_an_orphaned_job_fails_it(self):
+        response = Client().get(f"/api/jobs/{self.orphan.id}/")
+        self.assertEqual(response.json()["status"], "failed")
+
+        response = Client().get(f"/api/jobs/{self.recent.id}/")
+        self.assertEqual(response.json()["status"], "running")
+
+
+    def test_late_result_does_not_revive_a_failed_job(self):
+        jobs.fail_stale_jobs()
+        self.orphan.refresh_from_db()
+
+        jobs._finish_job(self.orphan)
+
+        self.orphan.refresh_from_db()
+        self.assertEqual(self.orphan.status, "failed")
+        self.assertIsNone(self.orphan.version)
+        self.assertFalse(GenerationVersion.objects.exists())
+
+    def test_late_failure_does_not_undo_a_finished_job(self):
+        GenerationJob.objects.filter(id=self.recent.id).update(status="succeeded")
+
+        jobs._fail_job(self.recent.id, Exception("timed out"))
+
+        self.recent.refresh_from_db()
+        self.assertEqual(self.recent.status, "succeeded")
+        self.assertEqual(self.recent.error, "")
+
+class ClaimRetryTests(TransactionTestCase):
+    def setUp(self):
+        self.job = GenerationJob.objects.create(
+            composition=FaceComposition.objects.create(),
+            kind="sketch",
+            params={
+                "features_description": "round face",
+                "output_path": "sketch.png",
+                "user_prompt": "",
+                "reference_image_path": None,
+            },
+        )
+        self.timers = []
+
+        class Timer:
+            def __init__(timer, delay, func, args):
+                self.timers.append(delay)
+                timer.daemon = False
+                timer.func, timer.args = func, args
+
+            def start(timer):
+                timer.func(*timer.args)
+
+        for patcher in (
+            mock.patch.object(jobs.threading, "Timer", Timer),
+            mock.patch.object(jobs, "CLAIM_RETRY_DELAYS", (1, 5)),
+            mock.patch.object(jobs, "_submit", side_effect=jobs.run_job),
+            mock.patch.object(bfl_scheduler, "acquire"),
+            mock.patch.object(bfl_flux, "generate_sketch"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def claim_failing(self, times):
+        claim = jobs._claim_job
+        failures = iter(range(times))
+
+        def flaky(job_id):
+            if next(failures, None) is not None:
+                raise OperationalError("database is locked")
+            return claim(job_id)
+
+        return mock.patch.object(jobs, "_claim_job", side_effect=flaky)
+
+    def test_failed_claim_is_retried(self):
+        with self.claim_failing(2) as claim, mock.patch.object(jobs, "_finish_job"):
+            jobs.run_job(self.job.id)
+
+        self.assertEqual(self.timers, [1, 5])
+        self.assertEqual(claim.call_count, 3)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, "running")
+
+    def test_job_fails_once_retries_run_out(self):
+        with self.claim_failing(3):
+            jobs.run_job(self.job.id)
+
+        self.assertEqual(self.timers, [1, 5])
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, "failed")
+        self.assertIn("database is locked", self.job.error)
+
+    def test_job_stays_queued_until_it_has_a_slot(self):
+        waiting = []
+
+        def acquire(*args):
+            job = GenerationJob.objects.get(id=self.job.id)
+            waiting.append((job.status, job.progress, timezone.now()))
+
+        with mock.patch.object(
+            bfl_scheduler, "acquire", side_effect=acquire
+        ), mock.patch.object(jobs, "_finish_job"):
+            jobs.run_job(self.job.id)
+
+        [(status, progress, granted_at)] = waiting
+        self.assertEqual((status, progress), ("queued", "Waiting for a BFL slot"))
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, "running")
+        self.assertGreaterEqual(self.job.started_at, granted_at)
+
+    def test_slot_is_given_back_if_another_worker_claims_the_job(self):
+        def acquire(*args):
+            GenerationJob.objects.filter(id=self.job.id).update(status="running")
+
+        with mock.patch.object(
+            bfl_scheduler, "acquire", side_effect=acquire
+        ), mock.patch.object(bfl_scheduler, "release") as release:
+            jobs.run_job(self.job.id)
+
+        release.assert_called_once_with(self.job.id)
+        bfl_flux.generate_sketch.assert_not_called()
+
+
+class FlakyServer:
+    """HTTP server answering each path with a scripted list of status codes"""
+
+    def __init__(self, script):
+        self.script = {path: list(codes) for path, codes in script.items()}
+        self.hits = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def answer(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                server.hits.append((self.command, self.path))
+                codes = server.script[self.path]
+                code = codes.pop(0) if len(codes) > 1 else codes[0]
+                body = b"{}"
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = answer
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@override_settings(BFL_HTTP_RETRIES=3, BFL_HTTP_POOL_SIZE=2)
+class BFLSessionTests(SimpleTestCase):
+    def setUp(self):
+        for name, value in (("_session", None), ("RETRY_BACKOFF", 0), ("RETRY_JITTER", 0)):
+            patcher = mock.patch.object(bfl_session, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: bfl_session._session and bfl_session._session.close())
+
+    def serve(self, script):
+        server = FlakyServer(script)
+        self.addCleanup(server.close)
+        return server
+
+    def test_polls_are_retried_over_one_kept_alive_connection(self):
+        server = self.serve({"/get_result": [503, 502, 200]})
+        before = bfl_session.session_stats()
+
+        response = bfl_session.request("poll", "GET", f"{server.url}/get_result")
+
+        after = bfl_session.session_stats()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.hits), 3)
+        self.assertEqual(after["retries"] - before["retries"], 2)
+        self.assertEqual(after["requests"] - before["requests"], 3)
+        self.assertEqual(after["connections"] - before["connections"], 1)
+
+    def test_retries_give_up_with_the_last_response(self):
+        server = self.serve({"/get_result": [500]})
+        response = bfl_session.request("poll", "GET", f"{server.url}/get_result")
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(server.hits), 4)
+
+    def test_submits_that_reached_bfl_are_not_retried(self):
+        server = self.serve({"/flux-dev": [503, 200]})
+        response = bfl_session.request("submit", "POST", f"{server.url}/flux-dev", json={})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(server.hits, [("POST", "/flux-dev")])
+
+    def test_submits_that_never_connected_are_retried(self):
+        server = self.serve({"/": [200]})
+        url = server.url
+        server.close()
+        before = bfl_session.session_stats()["retries"]
+
+        with self.assertRaises(requests.ConnectionError):
+            bfl_session.request("submit", "POST", f"{url}/flux-dev", json={})
+        self.assertEqual(bfl_session.session_stats()["retries"] - before, 4)
+
+    def send_async(self, method, url):
+        async def main():
+            async with httpx.AsyncClient(
+                transport=bfl_session.async_transport(2)
+            ) as client:
+                return await client.request(method, url, json={})
+
+        return asyncio.run(main())
+
+    def test_async_polls_are_retried_over_one_kept_alive_connection(self):
+        server = self.serve({"/get_result": [503, 502, 200]})
+        before = bfl_session.session_stats()
+
+        response = self.send_async("GET", f"{server.url}/get_result")
+
+        after = bfl_session.session_stats()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.hits), 3)
+        self.assertEqual(after["retries"] - before["retries"], 2)
+        self.assertEqual(after["requests"] - before["requests"], 3)
+        self.assertEqual(after["connections"] - before["connections"], 1)
+
+    def test_async_submits_are_only_retried_if_they_never_connected(self):
+        server = self.serve({"/flux-dev": [503, 200]})
+        response = self.send_async("POST", f"{server.url}/flux-dev")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(server.hits, [("POST", "/flux-dev")])
+
+        url = server.url
+        server.close()
+        before = bfl_session.session_stats()["retries"]
+        with self.assertRaises(httpx.ConnectError):
+            self.send_async("POST", f"{url}/flux-dev")
+        self.assertEqual(bfl_session.session_stats()["retries"] - before, 3)
+
+
+class BFLStreamingTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.image = os.urandom(300_000)
+        self.declared_size = len(self.image)
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(test.declared_size))
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(test.image)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f"http://127.0.0.1:{server.server_address[1]}/sample.jpg"
+        self.output_path = os.path.join(self.tmp, "sketches", "out.png")
+
+    def test_download_streams_to_the_output(self):
+        bfl_flux._download_image(self.url, self.output_path)
+
+        with open(self.output_path, "rb") as f:
+            self.assertEqual(f.read(), self.image)
+        self.assertFalse(os.path.exists(f"{self.output_path}.part"))
+
+    def test_truncated_download_keeps_the_previous_image(self):
+        os.makedirs(os.path.dirname(self.output_path))
+        with open(self.output_path, "wb") as f:
+            f.write(b"previous")
+        self.declared_size = len(self.image) + 1000
+
+        with self.assertRaises(Exception):
+            bfl_flux._download_image(self.url, self.output_path)
+
+        with open(self.output_path, "rb") as f:
+            self.assertEqual(f.read(), b"previous")
+        self.assertFalse(os.path.exists(f"{self.output_path}.part"))
+
+    def test_writer_checks_size_and_reports_the_checksum(self):
+        writer = bfl_flux._ImageWriter(self.output_path)
+        writer.write(self.image[:1000])
+        with self.assertRaisesMessage(Exception, "truncated: 1000 of 2000 bytes"):
+            writer.commit(expected_size=2000)
+        self.assertEqual(os.listdir(os.path.dirname(self.output_path)), [])
+
+        writer = bfl_flux._ImageWriter(self.output_path)
+        for start in range(0, len(self.image), 4096):
+            writer.write(self.image[start : start + 4096])
+        checksum = writer.commit(expected_size=len(self.image))
+        self.assertEqual(checksum, hashlib.sha256(self.image).hexdigest())
+
+    def test_upload_body_is_the_json_payload_streamed(self):
+        path = os.path.join(self.tmp, "input.jpg")
+        with open(path, "wb") as f:
+            f.write(self.image)
+
+        body = bfl_flux._ImagePayload({"prompt": "sketch"}, "input_image", path)
+        chunks = iter(lambda: body.read(bfl_flux.UPLOAD_CHUNK_SIZE // 3), b"")
+        sent = b"".join(chunks)
+        expected = json.dumps(
+            {"prompt": "sketch", "input_image": base64.b64encode(self.image).decode()}
+        ).encode()
+
+        self.assertEqual(sent, expected)
+        self.assertEqual(len(body), len(expected))
+        # A retried request rewinds and resends the same bytes
+        body.seek(0)
+        self.assertEqual(body.read(), expected)
+        body.close()
+
+
+class UploadPreprocessingTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+
+    def test_large_inputs_are_downscaled_to_jpeg(self):
+        path = os.path.join(self.tmp, "overlay.png")
+        image = Image.new("RGBA", (2000, 3000), (0, 0, 0, 0))
+        image.paste((200, 30, 30, 255), (0, 0, 1000, 3000))
+        image.save(path)
+
+        upload_path = bfl_flux._prepare_upload(path)
+        self.addCleanup(os.remove, upload_path)
+
+        self.assertNotEqual(upload_path, path)
+        with Image.open(upload_path) as upload:
+            self.assertEqual(upload.format, "JPEG")
+            width, height = upload.size
+            # Transparent areas become white paper
+            self.assertGreater(min(upload.getpixel((width - 10, 10))), 245)
+        self.assertLessEqual(
+            width * height, bfl_flux.MUGSHOT_WIDTH * bfl_flux.MUGSHOT_HEIGHT
+        )
+        self.assertAlmostEqual(width / height, 2 / 3, places=2)
+        self.assertLess(os.path.getsize(upload_path), os.path.getsize(path))
+
+    def test_small_compact_inputs_are_uploaded_as_they_are(self):
+        path = os.path.join(self.tmp, "sketch.jpg")
+        Image.effect_noise((300, 400), 60).convert("RGB").save(path, quality=20)
+
+        self.assertEqual(bfl_flux._prepare_upload(path), path)
+        self.assertEqual(os.listdir(self.tmp), ["sketch.jpg"])
+
+
+class GenerationCacheTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.cache_dir = os.path.join(self.tmp, "cache")
+
+        overrides = override_settings(
+            GENERATION_CACHE_DIR=self.cache_dir, GENERATION_CACHE_MAX_MB=1
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        for name, value in (("_size", None), ("_scanned_at", 0.0)):
+            patcher = mock.patch.object(generation_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def image(self, name, size=400 * 1024):
+        path = os.path.join(self.tmp, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_key_covers_every_request_field(self):
+        source = self.image("source.png", 1000)
+        copy = os.path.join(self.tmp, "copy.png")
+        shutil.copy(source, copy)
+        request = {
+            "model": "flux-kontext-dev",
+            "prompt": "sketch",
+            "input_path": source,
+        }
+        key = generation_cache.cache_key(**request)
+
+        same = generation_cache.cache_key(**{**request, "input_path": copy})
+        self.assertEqual(same, key)
+        for change in (
+            {"model": "flux-kontext-pro"},
+            {"prompt": "sketch, older"},
+            {"input_path": self.image("other.png", 1000)},
+            {"width": 768, "height": 1024},
+            {"seed": 7},
+        ):
+            changed = generation_cache.cache_key(**{**request, **change})
+            self.assertNotEqual(changed, key)
+
+    def test_evicts_least_recently_used_entries(self):
+        first, second, third = (self.image(f"{n}.png") for n in ("a", "b", "c"))
+        generation_cache.store("aa" * 32, first)
+        generation_cache.store("bb" * 32, second)
+        now = time.time()
+        os.utime(generation_cache._entry_path("aa" * 32), (now - 100, now - 100))
+        os.utime(generation_cache._entry_path("bb" * 32), (now - 50, now - 50))
+
+        # Reading an entry makes it the most recently used
+        out = os.path.join(self.tmp, "out.png")
+        self.assertTrue(generation_cache.fetch("aa" * 32, out))
+        generation_cache.store("cc" * 32, third)
+
+        self.assertTrue(os.path.exists(generation_cache._entry_path("aa" * 32)))
+        self.assertFalse(os.path.exists(generation_cache._entry_path("bb" * 32)))
+        self.assertTrue(os.path.exists(generation_cache._entry_path("cc" * 32)))
+        self.assertFalse(generation_cache.fetch("bb" * 32, out))
+
+    def test_stores_under_the_limit_skip_the_directory_scan(self):
+        with mock.patch.object(os, "walk", wraps=os.walk) as walk:
+            generation_cache.store("aa" * 32, self.image("a.png", 1000))
+            generation_cache.store("bb" * 32, self.image("b.png", 1000))
+            self.assertEqual(walk.call_count, 1)
+
+            with mock.patch.object(generation_cache, "RESCAN_INTERVAL", 0):
+                generation_cache.store("cc" * 32, self.image("c.png", 1000))
+            self.assertEqual(walk.call_count, 2)
+
+    def sketch_job(self, seed, reference_image_path=None):
+        return GenerationJob.objects.create(
+            composition=FaceComposition.objects.create(),
+            kind="sketch",
+            params={
+                "features_description": "round face",
+                "output_path": os.path.join(self.tmp, "out", f"sketch_{seed}.png"),
+                "user_prompt": "",
+                "reference_image_path": reference_image_path,
+                "seed": seed,
+            },
+        )
+
+    def test_a_job_hashes_its_source_image_once(self):
+        source = self.image("reference.png", 1000)
+        job = self.sketch_job(7, reference_image_path=source)
+        with mock.patch.object(
+            generation_cache, "_file_digest", wraps=generation_cache._file_digest
+        ) as digest:
+            self.assertFalse(jobs._finish_from_cache(job))
+            shutil.copy(source, job.params["output_path"])
+            jobs._cache_result(job)
+
+        digest.assert_called_once_with(source)
+        job.refresh_from_db()
+        self.assertTrue(
+            generation_cache.fetch(
+                job.params["cache_key"], os.path.join(self.tmp, "again.png")
+            )
+        )
+
+    def test_only_seeded_requests_are_cached(self):
+        for seed in (None, 7):
+            job = self.sketch_job(seed)
+            self.assertFalse(jobs._finish_from_cache(job))
+            os.makedirs(os.path.dirname(job.params["output_path"]), exist_ok=True)
+            shutil.copy(self.image("result.png", 1000), job.params["output_path"])
+            jobs._cache_result(job)
+
+        with mock.patch.object(jobs, "_claim", return_value=False):
+            self.assertFalse(jobs._finish_from_cache(self.sketch_job(None)))
+            self.assertTrue(jobs._finish_from_cache(self.sketch_job(7)))
+        entries = [name for _, _, names in os.walk(self.cache_dir) for name in names]
+        self.assertEqual(len(entries), 1)
+
+
+@override_settings(BFL_SUBMIT_RATE=100, BFL_SUBMIT_BURST=100, BFL_MAX_IN_FLIGHT=1)
+class SchedulerTests(SimpleTestCase):
+    model = "flux-dev"
+
+    def setUp(self):
+        for name, value in (("_models", {}), ("_slots", {}), ("_waiters", [])):
+            patcher = mock.patch.object(bfl_scheduler, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.granted = []
+
+    def enqueue(self, job_id, user, lane="interactive"):
+        waiter = bfl_scheduler._Waiter(
+            job_id, self.model, lane, user, lambda: self.granted.append(job_id)
+        )
+        with bfl_scheduler._cond:
+            waiter.tag = bfl_scheduler._limits(self.model).tag(user)
+            bfl_scheduler._waiters.append(waiter)
+
+    def dispatch(self, now=None):
+        with bfl_scheduler._cond:
+            bfl_scheduler._dispatch(time.monotonic() if now is None else now)
+
+    def run_one_at_a_time(self):
+        while bfl_scheduler._waiters:
+            self.dispatch()
+            bfl_scheduler.release(self.granted[-1])
+
+    def test_users_take_turns(self):
+        for job_id in ("a1", "a2", "a3", "a4"):
+            self.enqueue(job_id, "user:a")
+        self.enqueue("b1", "user:b")
+        self.enqueue("b2", "user:b")
+        self.enqueue("c1", "user:c")
+
+        self.run_one_at_a_time()
+
+        self.assertEqual(self.granted, ["a1", "b1", "c1", "a2", "b2", "a3", "a4"])
+
+    def test_interactive_lane_goes_first(self):
+        self.enqueue("colorize", "user:a", lane="batch")
+        self.enqueue("sketch", "user:b")
+
+        self.run_one_at_a_time()
+
+        self.assertEqual(self.granted, ["sketch", "colorize"])
+
+    def test_unreleased_slots_expire_after_their_lease(self):
+        self.enqueue("stuck", "user:a")
+        self.enqueue("next", "user:b")
+        now = time.monotonic()
+
+        self.dispatch(now)
+        self.dispatch(now + 1)
+        self.assertEqual(self.granted, ["stuck"])
+
+        self.dispatch(now + bfl_scheduler.LEASE_SECONDS + 1)
+        self.assertEqual(self.granted, ["stuck", "next"])
+        self.assertEqual(bfl_scheduler.held_slots(), ["next"])
+
+    def test_throttling_pauses_and_slows_the_model(self):
+        self.enqueue("first", "user:a")
+        bfl_scheduler.throttled(self.model, retry_after=10)
+        now = time.monotonic()
+
+        self.dispatch(now)
+        self.assertEqual(self.granted, [])
+        self.assertEqual(bfl_scheduler.scheduler_info()[self.model]["rate"], 50)
+
+        self.dispatch(now + 11)
+        self.assertEqual(self.granted, ["first"])
+
+    def test_cancelled_waiter_leaves_the_queue(self):
+        bfl_scheduler._limits(self.model).max_in_flight = 1
+
+        async def main():
+            await bfl_scheduler.acquire_async("holder", self.model)
+            waiting = asyncio.create_task(
+                bfl_scheduler.acquire_async("next", self.model)
+            )
+            await asyncio.sleep(0.05)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+
+        asyncio.run(main())
+        self.assertEqual(bfl_scheduler._waiters, [])
+        bfl_scheduler.release("holder")
+        self.assertEqual(bfl_scheduler.held_slots(), [])
+
+    def test_slot_granted_to_a_cancelled_task_is_given_back(self):
+        async def main():
+            task = asyncio.create_task(bfl_scheduler.acquire_async("job", self.model))
+            await asyncio.sleep(0)
+            # Block the loop so the task is cancelled before it sees its grant
+            deadline = time.monotonic() + 5
+            while not bfl_scheduler.held_slots() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(bfl_scheduler.held_slots(), ["job"])
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+        self.assertEqual(bfl_scheduler.held_slots(), [])
+        self.assertEqual(bfl_scheduler._limits(self.model).in_flight, 0)
+
+
+@override_settings(BFL_API_KEY="test")
+class BFLAsyncTests(SimpleTestCase):
+    def setUp(self):
+        self.stub = StubBFL()
+        self.stub.status = "Ready"
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(self.stub.close)
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.output_path = os.path.join(self.tmp, "sketches", "out.png")
+
+        for module, name, value in (
+            (bfl_flux, "BFL_API_BASE", self.stub.url),
+            (bfl_async, "POLL_MIN_INTERVAL", 0.01),
+            (bfl_async, "POLL_MAX_INTERVAL", 0.08),
+            (bfl_async, "POLL_BACKOFF", 2),
+        ):
+            patcher = mock.patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_async(self, coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await bfl_async._get_client().aclose()
+
+        return asyncio.run(main())
+
+    def test_sketch_is_submitted_polled_and_downloaded(self):
+        messages = []
+
+        async def progress(message):
+            messages.append(message)
+
+        self.run_async(
+            bfl_async.generate_sketch(
+                "oval face", self.output_path, progress=progress, seed=7
+            )
+        )
+
+        self.assertEqual(self.stub.submissions[0]["seed"], 7)
+        self.assertEqual(self.stub.polls, 1)
+        with open(self.output_path, "rb") as f:
+            self.assertEqual(f.read(), self.stub.image)
+        self.assertEqual(messages[-1], "Downloading result")
+
+    def test_revision_streams_the_source_image(self):
+        source = os.path.join(self.tmp, "source.png")
+        Image.new("RGB", (64, 64), "white").save(source)
+
+        self.run_async(bfl_async.revise_sketch("add stubble", source, self.output_path))
+
+        upload = base64.b64decode(self.stub.submissions[0]["input_image"])
+        with Image.open(io.BytesIO(upload)) as image:
+            self.assertEqual(image.size, (64, 64))
+        self.assertTrue(os.path.exists(self.output_path))
+
+    def test_polling_backs_off_until_the_deadline(self):
+        self.stub.status = "Pending"
+
+        with self.assertRaisesMessage(Exception, "Generation timed out"):
+            self.run_async(
+                bfl_async._run_dev_generate("oval face", self.output_path, timeout=0.5)
+            )
+
+        # A fixed 0.01s interval would have polled about 50 times
+        self.assertGreater(self.stub.polls, 2)
+        self.assertLessEqual(self.stub.polls, 10)
+        self.assertFalse(os.path.exists(self.output_path))
+
+
+class AsyncJobTests(TransactionTestCase):
+    def setUp(self):
+        self.stub = StubBFL()
+        self.stub.status = "Ready"
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(self.stub.close)
+        self.addCleanup(shutil.rmtree, self.media, True)
+
+        overrides = override_settings(
+            BFL_API_KEY="test", BFL_WEBHOOK_BASE_URL="", MEDIA_ROOT=self.media
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        for module, name, value in (
+            (bfl_flux, "BFL_API_BASE", self.stub.url),
+            (bfl_async, "POLL_MIN_INTERVAL", 0.01),
+            (bfl_scheduler, "_models", {}),
+            (bfl_scheduler, "_slots", {}),
+            (bfl_scheduler, "_waiters", []),
+            (jobs, "_event_loop", None),
+        ):
+            patcher = mock.patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.composition = FaceComposition.objects.create()
+
+    def create_job(self):
+        return GenerationJob.objects.create(
+            composition=self.composition,
+            kind="sketch",
+            params={
+                "features_description": "round face",
+                "output_path": os.path.join(self.media, "sketches", "sketch.png"),
+                "user_prompt": "",
+                "reference_image_path": None,
+                "method": "flux_dev",
+            },
+        )
+
+    def wait_for(self, job, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job.refresh_from_db()
+            if job.status in ("succeeded", "failed"):
+                return job.status
+            time.sleep(0.05)
+        self.fail(f"Job still {job.status} after {timeout}s")
+
+    def test_job_runs_on_the_event_loop(self):
+        job = self.create_job()
+
+        async def main():
+            try:
+                await jobs.run_job_async(job.id)
+            finally:
+                await bfl_async._get_client().aclose()
+
+        asyncio.run(main())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "succeeded")
+        self.assertEqual(self.composition.versions.count(), 1)
+        self.assertEqual(bfl_scheduler.held_slots(), [])
+
+    def test_attached_loop_runs_queued_and_new_jobs(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop_loop():
+            async def close_client():
+                await bfl_async._get_client().aclose()
+
+            asyncio.run_coroutine_threadsafe(close_client(), loop).result(5)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(5)
+            loop.close()
+
+        self.addCleanup(stop_loop)
+
+        left_queued = self.create_job()
+        with mock.patch.object(jobs, "_get_executor") as executor:
+            jobs.attach_event_loop(loop)
+            self.assertEqual(self.wait_for(left_queued), "succeeded")
+
+            new_job = self.create_job()
+            jobs.enqueue(new_job)
+            self.assertEqual(self.wait_for(new_job), "succeeded")
+
+        executor.assert_not_called()
+        self.assertIs(jobs._event_loop, loop)
+        self.assertEqual(self.composition.versions.count(), 2)
+
+
+class AsgiTests(SimpleTestCase):
+    async def test_requests_hand_the_event_loop_to_the_job_runner(self):
+        messages = []
+        requests_left = [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if requests_left:
+                return requests_left.pop()
+            # The client stays connected until the response is sent
+            await asyncio.Future()
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/no-such-page/",
+            "raw_path": b"/no-such-page/",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"testserver")],
+            "client": ("127.0.0.1", 50000),
+            "server": ("testserver", 80),
+        }
+        with mock.patch.object(asgi, "attach_event_loop") as attach:
+            await asgi.application(scope, receive, send)
+
+        attach.assert_called_once_with(asyncio.get_running_loop())
+        self.assertEqual(messages[0]["type"], "http.response.start")
+        self.assertEqual(messages[0]["status"], 404)
@@ -1,35 +1,112 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Exists, OuterRef, Prefetch
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from .models import FaceFeatureCategory, FaceFeature, FaceComposition, GenerationVersion
+from .models import (
+    FaceFeatureCategory,
+    FaceFeature,
+    FaceComposition,
+    GenerationJob,
+    GenerationVersion,
+)
+from .pagination import HistoryCursorPagination
 from .serializers import (
+    CompositionHistorySerializer,
     FaceFeatureCategorySerializer,
     FaceFeatureSerializer,
     FaceCompositionSerializer,
+    GenerationJobSerializer,
     GenerationVersionSerializer,
+    GenerationVersionSummarySerializer,
 )
 from PIL import Image, ImageDraw
 import requests
 import io
+import asyncio
+import json
 import os
 import base64
+import random
+import time
 from django.core.files.base import ContentFile
 from django.conf import settings
-from .bfl_flux import (
-    generate_sketch,
-    revise_sketch,
-    colorize_sketch,
+from .catalogue import get_catalogue
+from .jobs import enqueue, fail_stale_jobs, handle_webhook, is_stale
+from .face_matcher import (
+    cache_info,
+    match_face_with_stats,
+    match_faces_batch_with_stats,
 )
-from .face_matcher import match_face
+
+# Most sketch variants one generate_variants request may ask for
+MAX_SKETCH_VARIANTS = 8
+
+# How often a variant stream checks its jobs, and how long it stays open
+# before leaving the rest to be polled through /api/jobs/ (seconds)
+VARIANT_POLL_INTERVAL = 0.5
+VARIANT_STREAM_TIMEOUT = 300
+
+
+def _is_id_list(value) -> bool:
+    """True for a list of integer ids (JSON booleans don't count)"""
+    return isinstance(value, list) and all(
+        isinstance(item, int) and not isinstance(item, bool) for item in value
+    )
+
+
+def _requester(request) -> str:
+    """Who asked for a job: the logged-in user, else the client address"""
+    if request.user.is_authenticated:
+        return f"user:{request.user.pk}"
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def _request_catalogue(request) -> dict:
+    """get_catalogue(), looked up once per request"""
+    if not hasattr(request, "_catalogue"):
+        request._catalogue = get_catalogue()
+    return request._catalogue
+
+
+def _catalogue_etag(request, *args, **kwargs):
+    return _request_catalogue(request)["etag"]
+
+
+def _catalogue_last_modified(request, *args, **kwargs):
+    return _request_catalogue(request)["last_modified"]
 
 
 class FaceFeatureCategoryViewSet(viewsets.ReadOnlyModelViewSet):
     """API endpoint for facial feature categories"""
 
-    queryset = FaceFeatureCategory.objects.all()
+    queryset = FaceFeatureCategory.objects.prefetch_related("features")
     serializer_class = FaceFeatureCategorySerializer
 
+    @method_decorator(
+        condition(
+            etag_func=_catalogue_etag, last_modified_func=_catalogue_last_modified
+        )
+    )
+    def list(self, request, *args, **kwargs):
+        """
+        The whole catalogue, served from the cache (see catalogue) with an
+        ETag and Last-Modified; a matching conditional GET gets 304.
+        """
+        response = HttpResponse(
+            _request_catalogue(request)["body"], content_type="application/json"
+        )
+        # Cacheable, but revalidated on every use so edits show up at once
+        patch_cache_control(response, no_cache=True)
+        return response
+
 
 class FaceFeatureViewSet(viewsets.ReadOnlyModelViewSet):
     """API endpoint for individual facial features"""
@@ -44,26 +121,34 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
     queryset = FaceComposition.objects.all()
     serializer_class = FaceCompositionSerializer
 
-    def _next_version(self, composition):
-        """Get next version number for a composition"""
-        last = composition.versions.order_by("-version_number").first()
-        return (last.version_number + 1) if last else 1
+    def get_queryset(self):
+        """
+        List and detail fetch versions and feature ids in one query each, so
+        a page costs the same number of queries however many rows it holds;
+        the prompt comes from the denormalized cached_prompt column.
+        """
+        queryset = super().get_queryset()
+        if self.action in ("list", "retrieve"):
+            queryset = queryset.prefetch_related(
+                "versions",
+                Prefetch("selected_features", queryset=FaceFeature.objects.only("id")),
+            )
+        return queryset
 
-    def _save_version(
-        self, composition, image_path, image_type, prompt_used, parent=None
-    ):
-        """Create a GenerationVersion record"""
-        ver = GenerationVersion(
+    def _enqueue_job(self, composition, kind, params):
+        """Queue a background generation and answer 202 with the job"""
+        job = GenerationJob.objects.create(
             composition=composition,
-            version_number=self._next_version(composition),
-            image_type=image_type,
-            prompt_used=prompt_used,
-            parent_version=parent,
+            kind=kind,
+            params=params,
+            requested_by=_requester(self.request),
+        )
+        enqueue(job)
+        print(f"[Django] Queued {kind} job {job.id} for composition {composition.id}")
+        return Response(
+            {"status": "queued", "job": GenerationJobSerializer(job).data},
+            status=status.HTTP_202_ACCEPTED,
         )
-        rel_path = os.path.relpath(image_path, settings.MEDIA_ROOT)
-        ver.image.name = rel_path
-        ver.save()
-        return ver
 
     @action(detail=True, methods=["post"])
     def generate_composite(self, request, pk=None):
@@ -81,68 +166,127 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
 
         return Response({"status": "composite generated"})
 
+    def _sketch_params(self, composition, output_path):
+        """Inputs of a sketch job for the composition's current features"""
+        features_description = composition.get_prompt()
+
+        # Get optional reference image path
+        ref_image_path = None
+        if composition.reference_image:
+            ref_image_path = composition.reference_image.path
+            if not os.path.exists(ref_image_path):
+                ref_image_path = None
+
+        print(f"[Django] Queueing sketch generation...")
+        print(f"[Django] Features: {features_description[:100]}...")
+        if composition.user_prompt:
+            print(f"[Django] User prompt: {composition.user_prompt[:100]}...")
+        if ref_image_path:
+            print(f"[Django] Reference image: {ref_image_path}")
+
+        return {
+            "features_description": features_description,
+            "output_path": output_path,
+            "user_prompt": composition.user_prompt,
+            "reference_image_path": ref_image_path,
+            "method": "flux_kontext_pro" if ref_image_path else "flux_dev",
+        }
+
     @action(detail=True, methods=["post"])
     def generate_sketch(self, request, pk=None):
-        """Generate realistic pencil sketch mugshot using BFL Flux API"""
+        """Queue a realistic pencil sketch mugshot generation (BFL Flux API)"""
         composition = self.get_object()
-        features_description = composition.get_prompt()
 
-        try:
-            import time as _time
-
-            output_filename = f"sketch_{composition.id}_{int(_time.time())}.png"
-            output_path = os.path.join(settings.MEDIA_ROOT, "sketches", output_filename)
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        output_filename = f"sketch_{composition.id}_{int(time.time())}.png"
+        output_path = os.path.join(settings.MEDIA_ROOT, "sketches", output_filename)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-            # Get optional reference image path
-            ref_image_path = None
-            if composition.reference_image:
-                ref_image_path = composition.reference_image.path
-                if not os.path.exists(ref_image_path):
-                    ref_image_path = None
-
-            print(f"[Django] Starting sketch generation...")
-            print(f"[Django] Features: {features_description[:100]}...")
-            if composition.user_prompt:
-                print(f"[Django] User prompt: {composition.user_prompt[:100]}...")
-            if ref_image_path:
-                print(f"[Django] Reference image: {ref_image_path}")
-
-            generate_sketch(
-                features_description=features_description,
-                output_path=output_path,
-                user_prompt=composition.user_prompt,
-                reference_image_path=ref_image_path,
-            )
+        return self._enqueue_job(
+            composition, "sketch", self._sketch_params(composition, output_path)
+        )
 
-            composition.sketch_image = f"sketches/{output_filename}"
-            composition.save()
+    @action(detail=True, methods=["post"])
+    def generate_variants(self, request, pk=None):
+        """
+        Generate several candidate sketches of the composition at once.
+
+        Body: {"count": N} for N random seeds, or {"seeds": [...]}. One sketch
+        job per seed is queued, so the variants generate in parallel and each
+        becomes its own version of the composition.
+
+        Served through ASGI, the response streams newline-delimited JSON:
+        first the queued jobs, then each job as it finishes (in completion
+        order), then {"status": "done"}, or {"status": "timeout",
+        "pending": [job ids]} if VARIANT_STREAM_TIMEOUT passes first. The
+        stream waits on the event loop, so it holds no worker thread. Under
+        WSGI it would, so the queued jobs are returned straight away to be
+        polled through /api/jobs/.
+        """
+        composition = self.get_object()
 
-            ver = self._save_version(
-                composition, output_path, "sketch", features_description
+        seeds = request.data.get("seeds")
+        if seeds is None:
+            try:
+                count = int(request.data.get("count", 4))
+            except (TypeError, ValueError):
+                count = 0
+            seeds = [random.randrange(2**32) for _ in range(count)]
+        if not isinstance(seeds, list) or not 1 <= len(seeds) <= MAX_SKETCH_VARIANTS:
+            return Response(
+                {"error": f"Give 1-{MAX_SKETCH_VARIANTS} variants (count or seeds)"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-
+        # Each seed names its variant's output file, so they must be distinct
+        if (
+            not all(type(seed) is int and 0 <= seed < 2**32 for seed in seeds)
+            or len(set(seeds)) != len(seeds)
+        ):
             return Response(
-                {
-                    "status": "sketch generated",
-                    "image_url": composition.sketch_image.url,
-                    "method": "flux_kontext_pro" if ref_image_path else "flux_dev",
-                    "version": GenerationVersionSerializer(ver).data,
-                }
+                {"error": "seeds must be distinct integers from 0 to 2**32 - 1"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        except Exception as e:
-            import traceback
+        batch = int(time.time())
+        job_ids = []
+        queued = []
+        for seed in seeds:
+            output_filename = f"sketch_{composition.id}_{batch}_{seed}.png"
+            output_path = os.path.join(settings.MEDIA_ROOT, "sketches", output_filename)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+            params = self._sketch_params(composition, output_path)
+            params["seed"] = seed
+            job = GenerationJob.objects.create(
+                composition=composition,
+                kind="sketch",
+                params=params,
+                requested_by=_requester(request),
+            )
+            enqueue(job)
+            job_ids.append(job.id)
+            queued.append(GenerationJobSerializer(job).data)
+
+        print(
+            f"[Django] Queued {len(seeds)} sketch variants for composition {composition.id}"
+        )
 
-            print(f"[Django] Generation error: {traceback.format_exc()}")
+        if not isinstance(request._request, ASGIRequest):
             return Response(
-                {"error": f"Generation failed: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                {"status": "queued", "jobs": queued}, status=status.HTTP_202_ACCEPTED
             )
 
+        response = StreamingHttpResponse(
+            _stream_variants(queued, job_ids), content_type="application/x-ndjson"
+        )
+        response.status_code = status.HTTP_202_ACCEPTED
+        # Let each line through as soon as it is written
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
     @action(detail=True, methods=["post"])
     def revise_sketch(self, request, pk=None):
-        """Revise/edit an existing sketch using Flux Kontext Pro"""
+        """Queue a revision of the current sketch (Flux Kontext Pro)"""
         composition = self.get_object()
 
         revision_prompt = request.data.get("prompt", "")
@@ -185,7 +329,7 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
             output_filename = f"revised_{composition.id}_{int(_time.time())}.png"
             output_path = os.path.join(settings.MEDIA_ROOT, "sketches", output_filename)
 
-            print(f"[Django] Revising sketch with Kontext Pro...")
+            print(f"[Django] Queueing sketch revision with Kontext Pro...")
             print(f"[Django] Edit: {revision_prompt[:100]}...")
 
             # Find parent version — use the one the frontend is working from if provided
@@ -203,27 +347,17 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
             if not parent:
                 parent = composition.versions.order_by("-version_number").first()
 
-            revise_sketch(
-                edit_instruction=revision_prompt,
-                init_image_path=init_path,
-                output_path=output_path,
-                conversation_history=conversation_history,
-            )
-
-            composition.sketch_image = f"sketches/{output_filename}"
-            composition.save()
-
-            ver = self._save_version(
-                composition, output_path, "revision", revision_prompt, parent=parent
-            )
-
-            return Response(
+            return self._enqueue_job(
+                composition,
+                "revision",
                 {
-                    "status": "sketch revised",
-                    "image_url": composition.sketch_image.url,
+                    "prompt": revision_prompt,
+                    "init_image_path": init_path,
+                    "output_path": output_path,
+                    "conversation_history": conversation_history,
+                    "parent_version_id": parent.id if parent else None,
                     "method": "flux_kontext_pro",
-                    "version": GenerationVersionSerializer(ver).data,
-                }
+                },
             )
 
         except Exception as e:
@@ -255,7 +389,7 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=["post"])
     def colorize(self, request, pk=None):
-        """Colorize a B&W sketch into a realistic mugshot using Kontext Pro"""
+        """Queue colorizing the B&W sketch into a realistic mugshot (Kontext Pro)"""
         composition = self.get_object()
 
         if not composition.sketch_image:
@@ -264,63 +398,37 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        try:
-            import time as _time
-
-            sketch_path = os.path.join(
-                settings.MEDIA_ROOT, str(composition.sketch_image)
-            )
-
-            if not os.path.exists(sketch_path):
-                return Response(
-                    {"error": "Sketch file not found"},
-                    status=status.HTTP_404_NOT_FOUND,
-                )
-
-            features_description = composition.get_prompt()
-
-            output_filename = f"colored_{composition.id}_{int(_time.time())}.png"
-            output_path = os.path.join(settings.MEDIA_ROOT, "final", output_filename)
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-
-            print(f"[Django] Colorizing sketch with Kontext Pro...")
+        import time as _time
 
-            parent = composition.versions.order_by("-version_number").first()
+        sketch_path = os.path.join(settings.MEDIA_ROOT, str(composition.sketch_image))
 
-            colorize_sketch(
-                features_description=features_description,
-                sketch_path=sketch_path,
-                output_path=output_path,
+        if not os.path.exists(sketch_path):
+            return Response(
+                {"error": "Sketch file not found"},
+                status=status.HTTP_404_NOT_FOUND,
             )
 
-            composition.final_image = f"final/{output_filename}"
-            composition.save()
+        features_description = composition.get_prompt()
 
-            ver = self._save_version(
-                composition,
-                output_path,
-                "colorized",
-                f"[colorize] {features_description}",
-                parent=parent,
-            )
+        output_filename = f"colored_{composition.id}_{int(_time.time())}.png"
+        output_path = os.path.join(settings.MEDIA_ROOT, "final", output_filename)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-            return Response(
-                {
-                    "status": "sketch colorized",
-                    "image_url": composition.final_image.url,
-                    "method": "flux_kontext_pro",
-                    "version": GenerationVersionSerializer(ver).data,
-                }
-            )
+        print(f"[Django] Queueing sketch colorization with Kontext Pro...")
 
-        except Exception as e:
-            import traceback
+        parent = composition.versions.order_by("-version_number").first()
 
-            print(f"[Django] Colorization error: {traceback.format_exc()}")
-            return Response(
-                {"error": f"Colorization failed: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            )
+        return self._enqueue_job(
+            composition,
+            "colorize",
+            {
+                "features_description": features_description,
+                "sketch_path": sketch_path,
+                "output_path": output_path,
+                "parent_version_id": parent.id if parent else None,
+                "method": "flux_kontext_pro",
+            },
+        )
 
     @action(detail=True, methods=["post"])
     def match_criminals(self, request, pk=None):
@@ -353,10 +461,13 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
                 )
 
             print(f"[Django] Running face matching against criminal DB...")
-            matches = match_face(
+            matches, stats = match_face_with_stats(
                 query_image_path=colorized_path,
                 criminal_db_path=criminal_db_path,
                 top_k=10,
+                cascade=settings.FACE_MATCH_CASCADE,
+                cascade_keep=settings.FACE_MATCH_CASCADE_KEEP,
+                shards=settings.FACE_MATCH_SHARDS,
             )
 
             # Add image URLs for frontend display
@@ -367,6 +478,8 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
                 {
                     "status": "matching complete",
                     "matches": matches,
+                    "stats": stats,
+                    "cache": cache_info(),
                 }
             )
 
@@ -379,6 +492,108 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
+    @action(detail=False, methods=["post"])
+    def match_batch(self, request):
+        """
+        Match many images against the criminal database in one pass.
+
+        Body: {"composition_ids": [...], "version_ids": [...],
+               "all_versions": false, "top_k": 10}
+        Each composition contributes its colorized final image, or every
+        colorized version when all_versions is true; version_ids add
+        specific versions. Returns one result per query image.
+        """
+        composition_ids = request.data.get("composition_ids", [])
+        version_ids = request.data.get("version_ids", [])
+        all_versions = bool(request.data.get("all_versions", False))
+        try:
+            top_k = int(request.data.get("top_k", 10))
+        except (TypeError, ValueError):
+            top_k = 0
+
+        if not _is_id_list(composition_ids) or not _is_id_list(version_ids):
+            return Response(
+                {"error": "composition_ids and version_ids must be lists of integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if top_k < 1:
+            return Response(
+                {"error": "top_k must be a positive integer"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # (composition_id, version_id, image file) per query
+        queries = []
+        compositions = FaceComposition.objects.filter(id__in=composition_ids)
+        if all_versions:
+            for ver in GenerationVersion.objects.filter(
+                composition__in=compositions, image_type="colorized"
+            ).order_by("composition_id", "version_number"):
+                queries.append((ver.composition_id, ver.id, ver.image))
+        else:
+            for comp in compositions.order_by("id"):
+                if comp.final_image:
+                    queries.append((comp.id, None, comp.final_image))
+        for ver in GenerationVersion.objects.filter(id__in=version_ids).order_by("id"):
+            queries.append((ver.composition_id, ver.id, ver.image))
+
+        if not queries:
+            return Response(
+                {"error": "No colorized images to match."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(queries) > settings.FACE_MATCH_BATCH_LIMIT:
+            return Response(
+                {
+                    "error": f"Too many images ({len(queries)}), "
+                    f"at most {settings.FACE_MATCH_BATCH_LIMIT} per request"
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        criminal_db_path = os.path.join(settings.BASE_DIR, "criminalDB")
+        if not os.path.isdir(criminal_db_path):
+            return Response(
+                {"error": "Criminal database folder not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        try:
+            print(f"[Django] Batch matching {len(queries)} images against criminal DB...")
+            results, stats = match_faces_batch_with_stats(
+                query_image_paths=[image.path for _, _, image in queries],
+                criminal_db_path=criminal_db_path,
+                top_k=top_k,
+                cascade=settings.FACE_MATCH_CASCADE,
+                cascade_keep=settings.FACE_MATCH_CASCADE_KEEP,
+            )
+
+            data = []
+            for (comp_id, version_id, image), matches in zip(queries, results):
+                for m in matches:
+                    m["image_url"] = f"/criminalDB/{m['filename']}"
+                data.append(
+                    {
+                        "composition_id": comp_id,
+                        "version_id": version_id,
+                        "image_url": image.url,
+                        "matches": matches,
+                    }
+                )
+
+            return Response(
+                {"status": "matching complete", "results": data, "stats": stats}
+            )
+
+        except Exception as e:
+            import traceback
+
+            print(f"[Django] Batch matching error: {traceback.format_exc()}")
+            return Response(
+                {"error": f"Matching failed: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
     @action(detail=True, methods=["get"])
     def history(self, request, pk=None):
         """Get all versions for a composition"""
@@ -388,21 +603,34 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=["get"])
     def all_history(self, request):
-        """Get ALL compositions with their versions, for the persistent sidebar"""
-        compositions = FaceComposition.objects.prefetch_related("versions").all()
-        data = []
-        for comp in compositions:
-            versions = comp.versions.all()
-            if not versions.exists():
-                continue  # skip compositions with no generated versions
-            data.append(
-                {
-                    "id": comp.id,
-                    "created_at": comp.created_at.isoformat(),
-                    "versions": GenerationVersionSerializer(versions, many=True).data,
-                }
+        """
+        Compositions with their versions for the persistent sidebar, newest
+        first, one cursor page at a time (see HistoryCursorPagination).
+
+        Compositions without any generated version are left out in SQL; a page
+        costs two queries however large the archive grows.
+        """
+        summary_fields = GenerationVersionSummarySerializer.Meta.fields
+        compositions = (
+            FaceComposition.objects.filter(
+                Exists(GenerationVersion.objects.filter(composition=OuterRef("pk")))
+            )
+            .only("id", "created_at")
+            .prefetch_related(
+                Prefetch(
+                    "versions",
+                    queryset=GenerationVersion.objects.only(
+                        "composition", *summary_fields
+                    ),
+                )
             )
-        return Response(data)
+        )
+
+        paginator = HistoryCursorPagination()
+        page = paginator.paginate_queryset(compositions, request, view=self)
+        return paginator.get_paginated_response(
+            CompositionHistorySerializer(page, many=True).data
+        )
 
     @action(detail=True, methods=["post"], url_path="restore/(?P<version_id>[0-9]+)")
     def restore_version(self, request, pk=None, version_id=None):
@@ -436,6 +664,82 @@ class FaceCompositionViewSet(viewsets.ModelViewSet):
         )
 
 
+class GenerationJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """API endpoint for background generation jobs (poll for status)"""
+
+    queryset = GenerationJob.objects.select_related("version")
+    serializer_class = GenerationJobSerializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        composition_id = self.request.query_params.get("composition")
+        if composition_id:
+            if not composition_id.isdigit():
+                raise ValidationError({"composition": "Must be an integer id."})
+            queryset = queryset.filter(composition_id=composition_id)
+        return queryset
+
+    def retrieve(self, request, *args, **kwargs):
+        job = self.get_object()
+        # A job whose worker died would otherwise be polled forever
+        if is_stale(job) and fail_stale_jobs([job.id]):
+            job.refresh_from_db()
+        return Response(self.get_serializer(job).data)
+
+    @action(
+        detail=True,
+        methods=["post"],
+        authentication_classes=[],
+        permission_classes=[],
+    )
+    def bfl_webhook(self, request, pk=None):
+        """
+        Completion notification from BFL for a job submitted with a webhook.
+
+        The URL carries the job's webhook token (?token=...); the image is
+        downloaded and the version recorded in the background.
+        """
+        job = self.get_object()
+        token = request.query_params.get("token", "")
+
+        if not isinstance(request.data, dict) or not handle_webhook(
+            job, token, request.data
+        ):
+            return Response(
+                {"error": "Unknown webhook token or job not waiting"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        return Response({"status": "accepted"}, status=status.HTTP_202_ACCEPTED)
+
+
+def _finished_variants(job_ids):
+    """Serialized jobs among `job_ids` that have finished, oldest first"""
+    finished = (
+        GenerationJob.objects.select_related("version")
+        .filter(id__in=job_ids, status__in=("succeeded", "failed"))
+        .order_by("finished_at")
+    )
+    return [GenerationJobSerializer(job).data for job in finished]
+
+
+async def _stream_variants(queued, job_ids):
+    """NDJSON lines for generate_variants: queued jobs, then each as it finishes"""
+    yield json.dumps({"status": "queued", "jobs": queued}) + "\n"
+
+    pending = set(job_ids)
+    deadline = time.monotonic() + VARIANT_STREAM_TIMEOUT
+    while pending and time.monotonic() < deadline:
+        await asyncio.sleep(VARIANT_POLL_INTERVAL)
+        for job in await sync_to_async(_finished_variants)(list(pending)):
+            pending.discard(job["id"])
+            yield json.dumps({"status": "finished", "job": job}) + "\n"
+
+    if pending:
+        yield json.dumps({"status": "timeout", "pending": sorted(pending)}) + "\n"
+    else:
+        yield json.dumps({"status": "done"}) + "\n"
+
+
 def index(request):
     """Main page view"""
     return render(request, "index.html")
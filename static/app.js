@@ -1,6 +1,7 @@
 // Criminal Face Generator - Frontend JavaScript
 
 const API_BASE = "/api";
+const JOB_POLL_INTERVAL_MS = 2000;
 let categories = [];
 let selectedFeatures = new Set();
 let currentCompositionId = null;
@@ -8,6 +9,7 @@ let currentPrompt = "";
 
 // All compositions history (persistent across clears)
 let allCompositions = []; // [{id, created_at, versions: [...]}]
+let historyNextUrl = null; // cursor URL of the next (older) history page
 
 // Conversation history for current composition (revision context)
 let conversationHistory = []; // array of past revision prompts
@@ -397,16 +399,34 @@ function getOverlayBase64() {
 }
 
 // ── HISTORY SIDEBAR (PERSISTENT & GROUPED) ──
+// all_history is cursor-paginated: load the newest page, then older pages
+// on demand via historyNextUrl
 async function loadAllHistory() {
     try {
         const resp = await fetch(`${API_BASE}/compositions/all_history/`);
-        allCompositions = await resp.json();
+        const page = await resp.json();
+        allCompositions = page.results;
+        historyNextUrl = page.next;
         renderHistory();
     } catch (err) {
         console.error("Error loading all history:", err);
     }
 }
 
+async function loadOlderHistory() {
+    if (!historyNextUrl) return;
+    try {
+        const resp = await fetch(historyNextUrl);
+        const page = await resp.json();
+        const known = new Set(allCompositions.map((c) => c.id));
+        allCompositions.push(...page.results.filter((c) => !known.has(c.id)));
+        historyNextUrl = page.next;
+        renderHistory();
+    } catch (err) {
+        console.error("Error loading older history:", err);
+    }
+}
+
 function addVersionToCurrentComposition(ver) {
     // Find or create the composition group in allCompositions
     let compGroup = allCompositions.find((c) => c.id === currentCompositionId);
@@ -492,6 +512,14 @@ function renderHistory() {
         group.appendChild(versionsList);
         list.appendChild(group);
     });
+
+    if (historyNextUrl) {
+        const more = document.createElement("button");
+        more.className = "history-more";
+        more.textContent = "Load older";
+        more.addEventListener("click", loadOlderHistory);
+        list.appendChild(more);
+    }
 }
 
 async function restoreVersion(version, compositionId) {
@@ -558,6 +586,27 @@ async function restoreVersion(version, compositionId) {
     }
 }
 
+// ── BACKGROUND JOBS ──
+// Generation endpoints answer 202 with a job; poll it until it finishes and
+// return {image_url, version, method} on success or {error} on failure.
+async function awaitGenerationJob(resp, label) {
+    const data = await resp.json();
+    if (resp.status !== 202 || !data.job) return data;
+
+    let job = data.job;
+    while (job.status === "queued" || job.status === "running") {
+        await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+        const jobResp = await fetch(`${API_BASE}/jobs/${job.id}/`);
+        job = await jobResp.json();
+        if (job.progress) setStatus(`${label}... ${job.progress}`, "loading");
+    }
+
+    if (job.status === "succeeded") {
+        return { image_url: job.image_url, version: job.version, method: job.method };
+    }
+    return { error: job.error ? `${label} failed: ${job.error}` : `${label} failed` };
+}
+
 // ── GENERATE SKETCH ──
 async function generateMugshot() {
     const generateBtn = document.getElementById("generateBtn");
@@ -611,7 +660,7 @@ async function generateMugshot() {
             },
         );
 
-        const result = await sketchResp.json();
+        const result = await awaitGenerationJob(sketchResp, "Generating sketch");
 
         if (result.image_url) {
             showImage(result.image_url);
@@ -668,7 +717,7 @@ async function reviseSketch() {
             },
         );
 
-        const result = await resp.json();
+        const result = await awaitGenerationJob(resp, "Revising sketch");
 
         if (result.image_url) {
             showImage(result.image_url);
@@ -713,7 +762,7 @@ async function colorizeSketch() {
             },
         );
 
-        const result = await resp.json();
+        const result = await awaitGenerationJob(resp, "Colorizing sketch");
 
         if (result.image_url) {
             showImage(result.image_url);